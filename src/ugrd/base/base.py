@@ -1,5 +1,5 @@
 __author__ = 'desultory'
-__version__ = '4.9.0'
+__version__ = '5.1.2'
 
 from importlib.metadata import version
 from pathlib import Path
@@ -52,6 +52,18 @@ def _find_init(self) -> str:
             'return 1']
 
 
+def _stop_trace(self, indent=0) -> list[str]:
+    """
+    Returns bash to stop tracing and close the trace file opened by ugrd.base.debug enable_trace,
+    so the file descriptor is not inherited by the next init.
+    """
+    return [' ' * indent + line for line in ['if [ -n "$UGRD_TRACE_FD" ]; then',
+                                             '    set +x',
+                                             '    exec {UGRD_TRACE_FD}>&-',
+                                             '    unset UGRD_TRACE_FD BASH_XTRACEFD',
+                                             'fi']]
+
+
 @contains('init_target', 'init_target must be set.', raise_exception=True)
 def do_switch_root(self) -> str:
     """
@@ -72,20 +84,26 @@ def do_switch_root(self) -> str:
             r'    einfo "Target root contents:\n$(ls -l "$(readvar MOUNTS_ROOT_TARGET)")"',
             '    if _find_init ; then',  # This redefineds the var, so readvar instaed of using $init_target
             '        einfo "Switching root to: $(readvar MOUNTS_ROOT_TARGET) $(readvar init)"',
+            '        savevars',
+            *_stop_trace(self, 8),
             '        exec switch_root "$(readvar MOUNTS_ROOT_TARGET)" "$(readvar init)"',
             '    fi',
             '    rd_fail "Unable to find init."',
             'else',
             f'    einfo "Completed UGRD v{version("ugrd")}."',
             '    einfo "Switching root to: $(readvar MOUNTS_ROOT_TARGET) $init_target"',
+            '    savevars',
+            *_stop_trace(self, 4),
             '    exec switch_root "$(readvar MOUNTS_ROOT_TARGET)" "$init_target"',
             "fi"]
 
 
 def rd_restart(self) -> str:
-    """ Restart the initramfs, exit if not PID 1, otherwise exec /init. """
+    """ Restart the initramfs, exit if not PID 1, otherwise saves variables and execs /init. """
     return ['if [ "$$" -eq 1 ]; then',
             '    einfo "Restarting init"',
+            '    savevars',
+            *_stop_trace(self, 4),
             '    exec /init ; exit',
             'else',
             '    ewarn "PID is not 1, exiting: $$"',
@@ -106,45 +124,81 @@ def rd_fail(self) -> list[str]:
             r'eerror "Mounts:\n$(mount)"',
             'if [ "$(readvar recovery)" == "1" ]; then',
             '    einfo "Entering recovery shell"',
+            '    savevars',
             '    bash -l',
+            '    loadvars',  # Variables may have been changed in the shell
             'fi',
             'prompt_user "Press enter to restart init."',
             'rd_restart']
 
 
 def setvar(self) -> str:
-    """ Returns a bash function that sets a variable in /run/vars/{name}. """
-    return ['if check_var debug; then',
-            '    edebug "Setting $1 to $2"',
-            'fi',
-            'echo -n "$2" > "/run/vars/${1}"']
+    """
+    Returns a bash function that sets a variable in the UGRD_VARS associative array.
+    Variables are only written to /run/vars/{name} by savevars.
+    """
+    return ['edebug "Setting $1 to $2"',
+            'UGRD_VARS["$1"]="$2"',
+            'if [ "$1" == "quiet" ] || [ "$1" == "debug" ]; then',
+            '    unset UGRD_LOG_LEVEL',  # Resolved again by the next log message
+            'fi']
+
+
+def _load_var(self) -> str:
+    """ Returns bash to load the variable named by $1 from /run/vars/{name} into UGRD_VARS, if it's not set. """
+    return ['if [ -z "${UGRD_VARS[$1]+x}" ] && [ -f "/run/vars/${1}" ]; then',
+            '''    IFS= read -r -d '' "UGRD_VARS[$1]" < "/run/vars/${1}"''',
+            'fi']
 
 
 def readvar(self) -> str:
     """
-    Returns a bash function that reads a variable from /run/vars/{name}.
+    Returns a bash function that reads a variable from UGRD_VARS.
+    Variables saved to /run/vars/{name} by an earlier init, or before a new shell was started, are loaded if not set.
     The second arg can be a default value.
     If no default is supplied, and the variable is not found, it returns an empty string.
     """
-    return 'cat "/run/vars/${1}" 2>/dev/null || echo "${2}"'
+    return _load_var(self) + ['if [ -n "${UGRD_VARS[$1]+x}" ]; then',
+                              '''    printf '%s' "${UGRD_VARS[$1]}"''',
+                              'else',
+                              '''    printf '%s' "${2}"''',
+                              'fi']
+
+
+def savevars(self) -> str:
+    """
+    Returns a bash function that writes every variable in UGRD_VARS to /run/vars/{name}.
+    Used before rd_restart, switch_root, and starting a shell, so variables persist in the new process.
+    """
+    return ['for var in "${!UGRD_VARS[@]}"; do',
+            '''    printf '%s' "${UGRD_VARS[$var]}" > "/run/vars/${var}"''',
+            'done']
+
+
+def loadvars(self) -> str:
+    """
+    Returns a bash function that clears UGRD_VARS, so variables are loaded from /run/vars/{name} again when read.
+    Used after a shell started by the init exits, as interactive shells save their variables when they exit.
+    """
+    return ['UGRD_VARS=()',
+            'unset UGRD_LOG_LEVEL']
 
 
 def check_var(self) -> str:
     """
     Returns a bash function that checks the value of a variable.
-    if it's not set, tries to read the cmdline.
+    if it's not set, checks if it's a flag in the cmdline, which is read once into UGRD_CMDLINE.
+    Only uses builtins, as it is called by every log function.
     """
-    return ['if [ -z "$(readvar "$1")" ]; then',  # preferably the variable is set, because this is slower
-            r'''    cmdline=$(awk -F '--' '{print $1}' /proc/cmdline)''',  # Get everything before '--'
-            r'    if grep -qE "(^|\s)$1(\s|$)" <<< "$cmdline"; then',
-            '        return 0',
-            '    fi',
-            '    return 1',
-            'fi',
-            'if [ "$(readvar "$1")" == "1" ]; then',
-            '    return 0',
-            'fi',
-            'return 1']
+    return _load_var(self) + ['if [ -z "${UGRD_VARS[$1]}" ]; then',
+                              '    if [ -z "${UGRD_CMDLINE+x}" ]; then',
+                              '        read -r UGRD_CMDLINE < /proc/cmdline',
+                              '        UGRD_CMDLINE="${UGRD_CMDLINE%%--*}"',  # Get everything before '--'
+                              '    fi',
+                              '    [[ " $UGRD_CMDLINE " == *" $1 "* ]]',
+                              '    return',
+                              'fi',
+                              '[ "${UGRD_VARS[$1]}" == "1" ]']
 
 
 def prompt_user(self) -> str:
@@ -190,34 +244,48 @@ def retry(self) -> str:
             'return 1']
 
 
-# To feel more at home
-def edebug(self) -> str:
-    """ Returns a bash function like edebug. """
+def set_log_level(self) -> str:
+    """
+    Returns a bash function that sets UGRD_LOG_LEVEL using the quiet and debug vars.
+    Called by the log functions when UGRD_LOG_LEVEL is not set, setvar unsets it when quiet or debug are changed.
+    Levels are 10 for debug, 20 for info, and 30 for quiet.
+    """
     return ['if check_var quiet; then',
-            '    return',
+            '    UGRD_LOG_LEVEL=30',
+            'elif check_var debug; then',
+            '    UGRD_LOG_LEVEL=10',
+            'else',
+            '    UGRD_LOG_LEVEL=20',
+            'fi']
+
+
+def _log_function(self, level: int, message: str) -> list[str]:
+    """ Returns bash for a log function which prints the message if the log level is at or below the level. """
+    if self['force_quiet']:
+        return ['return']  # Avoid an empty function
+    return ['if [ -z "$UGRD_LOG_LEVEL" ]; then',
+            '    set_log_level',
             'fi',
-            'if [ "$(readvar debug)" != "1" ]; then',
+            f'if [ "$UGRD_LOG_LEVEL" -gt {level} ]; then',
             '    return',
             'fi',
-            r'echo -e "\e[1;34m *\e[0m ${*}"'
-            ]
+            message]
+
+
+# To feel more at home
+def edebug(self) -> str:
+    """ Returns a bash function like edebug. """
+    return _log_function(self, 10, r'echo -e "\e[1;34m *\e[0m ${*}"')
 
 
 def einfo(self) -> str:
     """ Returns a bash function like einfo. """
-    return ['if check_var quiet; then',
-            '    return',
-            'fi',
-            r'echo -e "\e[1;32m *\e[0m ${*}"'
-            ]
+    return _log_function(self, 20, r'echo -e "\e[1;32m *\e[0m ${*}"')
 
 
 def ewarn(self) -> str:
     """ Returns a bash function like ewarn. """
-    return ['if check_var quiet; then',
-            '    return',
-            'fi',
-            r'echo -e "\e[1;33m *\e[0m ${*}"']
+    return _log_function(self, 20, r'echo -e "\e[1;33m *\e[0m ${*}"')
 
 
 def eerror(self) -> str:
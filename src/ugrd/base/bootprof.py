@@ -0,0 +1,152 @@
+"""
+Boot time profiling for the generated init.
+
+When enabled, each runlevel block in the init, and each function in the profile, records its start and end time from EPOCHREALTIME.
+Times are in microseconds, function times include the functions they call, functions run in command substitutions are not recorded.
+Before init_final, the table is written to /run/ugrd/boot-profile, which is moved to the real root by switch_root.
+
+analyze_boot_profiles renders a table, or aggregates the tables of many hosts, for 'ugrd --analyze-boot'.
+"""
+
+__author__ = 'desultory'
+__version__ = '0.1.1'
+
+from pathlib import Path
+from statistics import median
+
+
+BOOT_PROFILE = '/run/ugrd/boot-profile'
+
+
+def bootprof_begin(self) -> list[str]:
+    """
+    Returns a bash function which stores the start time of a runlevel.
+    The first call stores the time the init started, the first call after /proc is mounted stores the uptime at that time.
+    """
+    return ['if [ -z "$BOOTPROF_INIT_EPOCH" ]; then',
+            '    BOOTPROF_INIT_EPOCH="${EPOCHREALTIME/./}"',
+            'fi',
+            'if [ -z "$BOOTPROF_INIT_START" ] && read -r BOOTPROF_INIT_START _ 2>/dev/null < /proc/uptime; then',
+            '    BOOTPROF_INIT_START=$((10#${BOOTPROF_INIT_START/./}0000 - ${EPOCHREALTIME/./} + BOOTPROF_INIT_EPOCH))',  # Uptime has two decimal places, 10# as it can start with 0
+            'fi',
+            'BOOTPROF_START["$1"]="${EPOCHREALTIME/./}"']
+
+
+def bootprof_end(self) -> str:
+    """ Returns a bash function which records the time taken by a runlevel. """
+    return 'bootprof_record runlevel "$1" "${BOOTPROF_START[$1]}"'
+
+
+def bootprof_record(self) -> list[str]:
+    """
+    Returns a bash function which adds a call to the boot profile.
+    The arguments are the type, name, and the start time in microseconds.
+    """
+    return [r'''local bootprof_key="$1"$'\t'"$2"''',
+            'if [ -z "${BOOTPROF_CALLS[$bootprof_key]}" ]; then',
+            '    BOOTPROF_KEYS+=("$bootprof_key")',  # Keep the order entries were first recorded
+            'fi',
+            'BOOTPROF_CALLS["$bootprof_key"]=$((${BOOTPROF_CALLS[$bootprof_key]:-0} + 1))',
+            'BOOTPROF_TIME["$bootprof_key"]=$((${BOOTPROF_TIME[$bootprof_key]:-0} + ${EPOCHREALTIME/./} - $3))']
+
+
+def bootprof_save(self) -> list[str]:
+    """
+    Returns a bash function which writes the boot profile table.
+    init_start is the uptime when the init started, init is the time taken until the table is written.
+    """
+    profile = Path(BOOT_PROFILE)
+    return [f'mkdir -p {profile.parent}',
+            '{',
+            r'''    printf '# type\tname\tcalls\ttime_us\n' ''',
+            r'''    printf 'boot\tinit_start\t1\t%s\n' "$BOOTPROF_INIT_START"''',
+            r'''    printf 'boot\tinit\t1\t%s\n' "$((${EPOCHREALTIME/./} - BOOTPROF_INIT_EPOCH))"''',
+            '    for key in "${BOOTPROF_KEYS[@]}"; do',
+            r'''        printf '%s\t%s\t%s\n' "$key" "${BOOTPROF_CALLS[$key]}" "${BOOTPROF_TIME[$key]}"''',
+            '    done',
+            f'}} > {profile}',
+            f'einfo "Wrote boot profile to: {profile}"']
+
+
+def profile_function(self, name: str, lines: list[str]) -> dict[str, list[str]]:
+    """
+    Returns functions for the profile, which record the time taken by the named function.
+    The original function is renamed to _bootprof_<name>, and called by a function with the original name.
+    """
+    return {f'_bootprof_{name}': lines,
+            name: ['local bootprof_start="${EPOCHREALTIME/./}" bootprof_ret',
+                   f'_bootprof_{name} "$@"',
+                   'bootprof_ret=$?',
+                   f'bootprof_record function {name} "$bootprof_start"',
+                   'return "$bootprof_ret"']}
+
+
+def profile_runlevel(self, level: str, lines: list[str]) -> list[str]:
+    """ Returns the lines of a runlevel, between lines which record the time it takes. """
+    return [f'bootprof_begin {level}', *lines, f'bootprof_end {level}']
+
+
+def read_boot_profile(path: Path) -> dict[tuple[str, str], tuple[int, int]]:
+    """ Reads a boot profile table, returns a dict of (type, name): (calls, time_us). """
+    profile = {}
+    for line in Path(path).read_text().splitlines():
+        if not line or line.startswith('#'):
+            continue
+        try:
+            entry_type, name, calls, time_us = line.split('\t')
+            profile[(entry_type, name)] = (int(calls), int(time_us))
+        except ValueError:
+            raise ValueError("[%s] Invalid boot profile line: %s" % (path, line))
+    return profile
+
+
+def _sort_entries(times: dict[tuple[str, str], int]) -> list:
+    """ Sorts boot entries first, then runlevels in boot order, then functions by the time taken, slowest first. """
+    order = {'boot': 0, 'runlevel': 1}
+    keys = list(times)
+    return sorted(keys, key=lambda key: (order.get(key[0], 2), keys.index(key) if key[0] in order else -times[key]))
+
+
+def _format_table(headers: list[str], rows: list[list]) -> str:
+    widths = [max(len(str(row[i])) for row in [headers, *rows]) for i in range(len(headers))]
+    lines = ['  '.join(str(value).ljust(width) for value, width in zip(headers, widths))]
+    lines.append('  '.join('-' * width for width in widths))
+    lines.extend('  '.join(str(value).ljust(width) for value, width in zip(row, widths)) for row in rows)
+    return '\n'.join(lines)
+
+
+def analyze_boot_profiles(paths: list[Path]) -> str:
+    """
+    Returns a table for boot profiles, times are in milliseconds.
+    For a single profile, the calls, time, and percent of the init time are shown for each entry.
+    For multiple profiles, the number of hosts, and the median, mean, and max time of each entry are shown.
+    The init_start entry is the uptime when the init started, init is the time the init took before init_final.
+    """
+    profiles = {str(path): read_boot_profile(path) for path in paths}
+    if not profiles:
+        raise ValueError("No boot profiles specified.")
+
+    if len(profiles) == 1:
+        profile = next(iter(profiles.values()))
+        init_time = profile.get(('boot', 'init'), (0, 0))[1]
+        rows = []
+        for entry_type, name in _sort_entries({key: time_us for key, (calls, time_us) in profile.items()}):
+            calls, time_us = profile[(entry_type, name)]
+            percent = '%.1f' % (100 * time_us / init_time) if init_time and entry_type != 'boot' else ''
+            rows.append([entry_type, name, calls, '%.3f' % (time_us / 1000), percent])
+        return _format_table(['Type', 'Name', 'Calls', 'Time (ms)', '% init'], rows)
+
+    times = {}
+    for path, profile in profiles.items():
+        for key, (calls, time_us) in profile.items():
+            times.setdefault(key, {})[path] = time_us
+
+    rows = []
+    for entry_type, name in _sort_entries({key: sum(host_times.values()) / len(host_times) for key, host_times in times.items()}):
+        host_times = times[(entry_type, name)]
+        slowest = max(host_times, key=host_times.get)
+        rows.append([entry_type, name, len(host_times),
+                     '%.3f' % (median(host_times.values()) / 1000),
+                     '%.3f' % (sum(host_times.values()) / len(host_times) / 1000),
+                     '%.3f' % (host_times[slowest] / 1000), slowest])
+    return _format_table(['Type', 'Name', 'Hosts', 'Median (ms)', 'Mean (ms)', 'Max (ms)', 'Slowest host'], rows)
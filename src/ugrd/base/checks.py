@@ -1,8 +1,9 @@
-__version__ = '0.2.0'
+__version__ = '0.3.1'
 
-from zenlib.util import contains
+from zenlib.util import contains, unset
 
 
+@unset('_build_fingerprint_matched', 'Build was skipped, skipping included funcs check', log_level=20)
 @contains('check_included_funcs', 'Skipping included funcs check', log_level=30)
 def check_included_funcs(self):
     bash_func_names = [func + '() {\n' for func in self.included_functions]
@@ -10,6 +11,7 @@ def check_included_funcs(self):
     return "Included functions check passed"
 
 
+@unset('_build_fingerprint_matched', 'Build was skipped, skipping in file check', log_level=20)
 @contains('check_in_file', 'Skipping in file check')
 def check_in_file(self):
     """ Runs all 'check_in_file' checks. """
@@ -20,13 +22,11 @@ def check_in_file(self):
 
 def _check_in_file(self, file, lines):
     """ Checks that all lines are in the file. """
-    file = self._get_build_path(file)
-    if not file.exists():
+    try:
+        file_lines = self._read_staged(file).splitlines(keepends=True)
+    except FileNotFoundError:
         raise ValueError("File '%s' does not exist" % file)
 
-    with open(file, 'r') as f:
-        file_lines = f.readlines()
-
     for check_line in lines:
         if check_line not in file_lines:
             raise ValueError("Failed to find line '%s' in file '%s'" % (check_line, file))
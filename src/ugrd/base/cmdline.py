@@ -1,44 +1,37 @@
 __author__ = 'desultory'
-__version__ = '2.3.1'
+__version__ = '3.0.0'
 
 
-CMDLINE_BOOLS = ['quiet', 'debug', 'recovery', 'rootwait']
-CMDLINE_STRINGS = ['init', 'root', 'roottype', 'rootflags', 'rootdelay']
-
-
-def parse_cmdline_bool(self) -> str:
-    """
-    Returns a bash script to parse a boolean value from /proc/cmdline
-    The only argument is the name of the variable to be read/set
-    """
-    return ['edebug "Parsing cmdline bool: $1"',
-            r'setvar "$1" "$(grep -qE "(^|\s)$1(\s|$)" /proc/cmdline && echo 1 || echo 0)"']
-
-
-def parse_cmdline_str(self) -> str:
+def parse_cmdline(self) -> str:
     """
-    Returns a bash script to parse a string value from /proc/cmdline
-    The only argument is the name of the variable to be read/set
+    Returns bash script to parse /proc/cmdline in a single pass, using only shell builtins.
+    Flags in cmdline_bools are set to 1 if present, 0 otherwise.
+    Parameters in cmdline_strings are set to their value if present, like root=/dev/sda1.
+    Everything after '--' is set to INIT_ARGS, everything before is stored in UGRD_CMDLINE for check_var.
     """
-    return ['edebug "Parsing cmdline string: $1"',
-            r'val=$(grep -oP "(?<=$1=)[^\s]+" /proc/cmdline)',
-            'if [ -n "$val" ]; then',
-            '    edebug "Parsed $1: $val"',
-            '    setvar "$1" "$val"',
-            'fi']
-
-
-def parse_cmdline(self) -> str:
-    """ Returns bash script to parse /proc/cmdline """
-    return [r'''cmdline=$(awk -F '--' '{print $1}' /proc/cmdline)''',  # Get everything before '--'
-            r'''setvar INIT_ARGS "$(awk -F '--' '{print $2}' /proc/cmdline)"''',  # Get everything after '--'
-            f'''for bool in {" ".join([f'"{bool}"' for bool in CMDLINE_BOOLS])}; do''',
-            '    parse_cmdline_bool "$bool"',
-            'done',
-            f'''for string in {" ".join([f'"{string}"' for string in CMDLINE_STRINGS])}; do''',
-            '    parse_cmdline_str "$string"',
+    out = ['read -ra cmdline_args < /proc/cmdline',
+           'UGRD_CMDLINE=""']
+    out += [f'setvar {bool} 0' for bool in self['cmdline_bools']]
+    out += ['for ((i = 0; i < ${#cmdline_args[@]}; i++)); do',
+            '    arg="${cmdline_args[$i]}"',
+            '    case "$arg" in',
+            '        --)',
+            '            setvar INIT_ARGS "${cmdline_args[*]:$((i + 1))}"',
+            '            break',
+            '            ;;']
+    if self['cmdline_bools']:
+        out += [f'        {"|".join(self["cmdline_bools"])})',
+                '            setvar "$arg" 1',
+                '            ;;']
+    if self['cmdline_strings']:
+        out += [f'        {"|".join(string + "=?*" for string in self["cmdline_strings"])})',
+                '            setvar "${arg%%=*}" "${arg#*=}"',
+                '            ;;']
+    out += ['    esac',
+            '    UGRD_CMDLINE+="${UGRD_CMDLINE:+ }$arg"',
             'done',
-            'einfo "Parsed cmdline: $cmdline"']
+            'einfo "Parsed cmdline: $UGRD_CMDLINE"']
+    return out
 
 
 def mount_cmdline_root(self) -> str:
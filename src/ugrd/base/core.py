@@ -1,11 +1,22 @@
 __author__ = 'desultory'
-__version__ = '3.7.3'
+__version__ = '3.14.2'
 
 from pathlib import Path
 from typing import Union
 
 from zenlib.util import contains, unset, NoDupFlatList
 
+from ugrd.elf import ELFResolver, ELFError, NotELFError
+from ugrd.generator_helpers import COPY_MODES, STAGING_MODES
+
+
+DEPENDENCY_RESOLVERS = ['elf', 'lddtree']
+DEP_CACHE_FILE = 'dependencies.json'
+DEP_CACHE_VERSION = 1
+# Files which affect the resolution of every binary, included in every cache entry
+DEP_CACHE_EXTRA_KEYS = ['/etc/ld.so.cache']
+DECOMPRESS_CHUNK_SIZE = 2 ** 20
+
 
 def detect_tmpdir(self) -> None:
     """ Reads TMPDIR from the environment, sets it as the temporary directory. """
@@ -35,25 +46,14 @@ def generate_structure(self) -> None:
         self._mkdir(subdir)
 
 
-def calculate_dependencies(self, binary: str) -> list[Path]:
-    """
-    Calculates the dependencies of a binary using lddtree
-    :param binary: The binary to calculate dependencies for
-    """
-    from shutil import which
+def _calculate_dependencies_lddtree(self, binary_path: Path) -> list[Path]:
+    """ Calculates the dependencies of a binary using lddtree. """
     from subprocess import run
 
-    binary_path = which(binary)
-    if not binary_path:
-        raise RuntimeError("'%s' not found in PATH" % binary)
-
-    binary_path = Path(binary_path)
-
-    self.logger.debug("Calculating dependencies for: %s" % binary_path)
     dependencies = run(['lddtree', '-l', str(binary_path)], capture_output=True)
 
     if dependencies.returncode != 0:
-        self.logger.warning("Unable to calculate dependencies for: %s" % binary)
+        self.logger.warning("Unable to calculate dependencies for: %s" % binary_path)
         raise RuntimeError("Unable to resolve dependencies, error: %s" % dependencies.stderr.decode('utf-8'))
 
     dependency_paths = []
@@ -67,23 +67,154 @@ def calculate_dependencies(self, binary: str) -> list[Path]:
     return dependency_paths
 
 
+def _get_dep_cache_key(path: Union[Path, str]) -> list:
+    """ Returns the cache key for a file, a list of the path, inode, mtime, and size. """
+    from os import stat
+    file_stat = stat(path)
+    return [str(path), file_stat.st_ino, file_stat.st_mtime_ns, file_stat.st_size]
+
+
+@contains('dep_cache', "Dependency cache is disabled, skipping loading.")
+def _load_dep_cache(self) -> None:
+    """ Loads the persistent dependency cache from the cache_dir into _dep_cache. """
+    from json import loads, JSONDecodeError
+
+    cache_file = self['cache_dir'] / DEP_CACHE_FILE
+    try:
+        cache = loads(cache_file.read_text())
+    except FileNotFoundError:
+        return self.logger.debug("Dependency cache does not exist: %s" % cache_file)
+    except (OSError, JSONDecodeError) as e:
+        return self.logger.warning("Unable to read dependency cache '%s': %s" % (cache_file, e))
+
+    if cache.get('version') != DEP_CACHE_VERSION:
+        return self.logger.info("Ignoring dependency cache with a different version: %s" % cache_file)
+
+    self.logger.debug("Loaded %d dependency cache entries from: %s" % (len(cache['entries']), cache_file))
+    self['_dep_cache'] = cache['entries']
+
+
+@contains('dep_cache', "Dependency cache is disabled, skipping saving.")
+def _save_dep_cache(self) -> None:
+    """
+    Writes _dep_cache to the cache_dir.
+    If there are more than dep_cache_size entries, the least recently used entries are evicted.
+    """
+    from json import dumps
+
+    entries = self['_dep_cache']
+    if len(entries) > self['dep_cache_size']:
+        evicted = sorted(entries, key=lambda key: entries[key]['used'])[:len(entries) - self['dep_cache_size']]
+        self.logger.debug("Evicting dependency cache entries: %s" % ', '.join(evicted))
+        for key in evicted:
+            entries.pop(key)
+
+    cache_file = self['cache_dir'] / DEP_CACHE_FILE
+    try:
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        temp_file = cache_file.with_suffix('.tmp')
+        temp_file.write_text(dumps({'version': DEP_CACHE_VERSION, 'entries': entries}))
+        temp_file.replace(cache_file)
+    except OSError as e:
+        return self.logger.warning("Unable to write dependency cache '%s': %s" % (cache_file, e))
+    self.logger.debug("Wrote %d dependency cache entries to: %s" % (len(entries), cache_file))
+
+
+def _get_cached_dependencies(self, binary_path: Path) -> list[Path]:
+    """
+    Returns the cached dependencies of a binary if the cache entry is still valid.
+    Entries are valid if they used the same resolver, and the inode, mtime, and size of every file in the closure
+    (and the ld.so.cache) are unchanged.
+    """
+    if not self['dep_cache']:
+        return
+
+    entry = self['_dep_cache'].get(str(binary_path))
+    if not entry or entry['resolver'] != self['dependency_resolver']:
+        return
+
+    try:
+        if any(_get_dep_cache_key(key[0]) != key for key in entry['files']):
+            return self.logger.debug("Dependency cache entry is stale: %s" % binary_path)
+    except OSError as e:
+        return self.logger.debug("Dependency cache entry is invalid: %s" % e)
+
+    from time import time
+    entry['used'] = time()
+    self.logger.debug("Using cached dependencies for: %s" % binary_path)
+    return [Path(dependency) for dependency in entry['dependencies']]
+
+
+def _cache_dependencies(self, binary_path: Path, dependencies: list[Path]) -> None:
+    """ Adds the dependencies of a binary to _dep_cache, keyed by the state of every file in the closure. """
+    from time import time
+
+    if not self['dep_cache']:
+        return
+
+    files = [*dependencies, *[path for path in DEP_CACHE_EXTRA_KEYS if Path(path).exists()]]
+    try:
+        keys = [_get_dep_cache_key(path) for path in files]
+    except OSError as e:
+        return self.logger.warning("[%s] Unable to cache dependencies: %s" % (binary_path, e))
+
+    self['_dep_cache'][str(binary_path)] = {'resolver': self['dependency_resolver'],
+                                            'dependencies': [str(dependency) for dependency in dependencies],
+                                            'files': keys,
+                                            'used': time()}
+
+
+def calculate_dependencies(self, binary: str) -> list[Path]:
+    """
+    Calculates the dependencies of a binary using the configured dependency_resolver.
+    The 'elf' resolver reads the binary directly, falling back to lddtree if it cannot be used.
+    Results are read from and added to the dependency cache, if enabled.
+    :param binary: The binary to calculate dependencies for
+    """
+    from shutil import which
+
+    binary_path = which(binary)
+    if not binary_path:
+        raise RuntimeError("'%s' not found in PATH" % binary)
+
+    binary_path = Path(binary_path)
+
+    if dependencies := _get_cached_dependencies(self, binary_path):
+        return dependencies
+
+    self.logger.debug("[%s] Calculating dependencies for: %s" % (self['dependency_resolver'], binary_path))
+    dependencies = None
+    if self['dependency_resolver'] == 'elf':
+        try:
+            dependencies = ELFResolver().resolve(binary_path)
+        except NotELFError as e:  # Usually a script
+            self.logger.debug("[%s] Not an ELF file, using lddtree: %s" % (binary, e))
+        except (ELFError, OSError) as e:
+            self.logger.warning("[%s] Unable to resolve dependencies natively, falling back to lddtree: %s" % (binary, e))
+
+    if not dependencies:
+        dependencies = _calculate_dependencies_lddtree(self, binary_path)
+
+    _cache_dependencies(self, binary_path, dependencies)
+    return dependencies
+
+
 def check_usr(self) -> None:
     """ Checks for /bin and /sbin in the build directory.
     If the are not present, it will symlink them to /usr/bin and /usr/sbin. """
-    build_dir = self._get_build_path('/')
-
-    if not (build_dir / 'bin').is_dir():
-        if (build_dir / 'usr/bin').is_dir():
+    if not self._is_dir('bin'):
+        if self._is_dir('usr/bin'):
             self._symlink('/usr/bin', '/bin/')
         else:
             raise RuntimeError("Neither /bin nor /usr/bin exist in the build directory")
 
-    if not (build_dir / 'sbin').is_dir() and (build_dir / 'usr/sbin').is_dir():
+    if not self._is_dir('sbin') and self._is_dir('usr/sbin'):
         self._symlink('/usr/sbin', '/sbin/')
 
 
 def deploy_dependencies(self) -> None:
-    """ Copies all dependencies to the build directory. """
+    """ Copies all dependencies to the build directory, using up to deploy_workers threads. """
+    dependencies = []
     for dependency in self['dependencies']:
         if dependency.is_symlink():
             if self['symlinks'].get(f'_auto_{dependency.name}'):
@@ -92,42 +223,101 @@ def deploy_dependencies(self) -> None:
             else:
                 raise ValueError("Dependency is a symlink and not in the symlinks list: %s" % dependency)
 
-        self._copy(dependency)
+        dependencies.append((dependency, None))
+
+    self._copy_many(dependencies, workers=self['deploy_workers'] or None)
+
+
+def _decompress_file(source: Path, dest: Path, compression: str) -> None:
+    """
+    Decompresses a xz, gz, or zst file to dest, streaming it in chunks so only one chunk is held in memory.
+    zstd uses the zstandard library if available, otherwise the output of the zstd command is written to dest.
+    """
+    from shutil import copyfileobj
+
+    with dest.open('wb') as out_file:
+        if compression == 'xz':
+            from lzma import open as open_compressed
+        elif compression == 'gz':
+            from gzip import open as open_compressed
+        elif compression == 'zst':
+            try:
+                from zstandard import ZstdDecompressor
+            except ImportError:
+                from subprocess import run, PIPE
+                cmd = run(['zstd', '--decompress', '--stdout', '--quiet', str(source)], stdout=out_file, stderr=PIPE)
+                if cmd.returncode != 0:
+                    raise RuntimeError("Failed to decompress '%s': %s" % (source, cmd.stderr.decode()))
+                return
+            with source.open('rb') as in_file:
+                ZstdDecompressor().copy_stream(in_file, out_file, read_size=DECOMPRESS_CHUNK_SIZE, write_size=DECOMPRESS_CHUNK_SIZE)
+            return
+        else:
+            raise ValueError("Unknown compression type: %s" % compression)
+
+        with open_compressed(source, 'rb') as in_file:
+            copyfileobj(in_file, out_file, DECOMPRESS_CHUNK_SIZE)
+
+
+def _deploy_compressed_dependencies(self, compression: str) -> None:
+    """
+    Decompresses all dependencies in self[f'{compression}_dependencies'] into the build directory, removing the extension.
+    Parent directories are created first, then files are decompressed using up to deploy_workers threads.
+    Every file is attempted, failures are logged in order, then the first is raised.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    from lzma import LZMAError
+    from os import makedirs
+    from zlib import error as ZlibError
+
+    dependencies = {dependency: self._get_build_path(str(dependency).removesuffix('.%s' % compression))
+                    for dependency in self['%s_dependencies' % compression]}
+    for parent in sorted({out_path.parent for out_path in dependencies.values()}):
+        makedirs(parent, exist_ok=True)
+
+    def decompress(dependency):
+        out_path = dependencies[dependency]
+        self.logger.debug("[%s] Decompressing: %s" % (compression, dependency))
+        try:
+            if out_path.is_symlink() or out_path.exists():  # Never write through a hardlinked file
+                out_path.unlink()
+            _decompress_file(dependency, out_path, compression)
+        except (OSError, LZMAError, ZlibError, RuntimeError) as e:
+            return e
+        self.logger.info("[%s] Decompressed '%s' to: %s" % (compression, dependency, out_path))
+
+    with ThreadPoolExecutor(max_workers=self['deploy_workers'] or None) as executor:
+        errors = [error for error in executor.map(decompress, dependencies) if error]
+
+    for error in errors:
+        self.logger.error("[%s] Failed to decompress file: %s" % (compression, error))
+    if errors:
+        raise errors[0]
 
 
 def deploy_xz_dependencies(self) -> None:
     """ Decompresses all xz dependencies into the build directory. """
-    from lzma import decompress
-    for xz_dependency in self['xz_dependencies']:
-        self.logger.debug("[xz] Decompressing: %s" % xz_dependency)
-        out_path = self._get_build_path(str(xz_dependency).replace('.xz', ''))
-        if not out_path.parent.is_dir():
-            self.logger.debug("Creating parent directory: %s" % out_path.parent)
-            self._mkdir(out_path.parent, resolve_build=False)
-        with out_path.open('wb') as out_file:
-            out_file.write(decompress(xz_dependency.read_bytes()))
-            self.logger.info("[xz] Decompressed '%s' to: %s" % (xz_dependency, out_path))
+    _deploy_compressed_dependencies(self, 'xz')
 
 
 def deploy_gz_dependencies(self) -> None:
     """ Decompresses all gzip dependencies into the build directory. """
-    from gzip import decompress
-    for gz_dependency in self['gz_dependencies']:
-        self.logger.debug("[gz] Decompressing: %s" % gz_dependency)
-        out_path = self._get_build_path(str(gz_dependency).replace('.gz', ''))
-        if not out_path.parent.is_dir():
-            self.logger.debug("Creating parent directory: %s" % out_path.parent)
-            self._mkdir(out_path.parent, resolve_build=False)
-        with out_path.open('wb') as out_file:
-            out_file.write(decompress(gz_dependency.read_bytes()))
-            self.logger.info("[gz] Decompressed '%s' to: %s" % (gz_dependency, out_path))
+    _deploy_compressed_dependencies(self, 'gz')
+
+
+def deploy_zst_dependencies(self) -> None:
+    """ Decompresses all zstd dependencies into the build directory. """
+    _deploy_compressed_dependencies(self, 'zst')
 
 
 def deploy_copies(self) -> None:
-    """ Copies everything from self['copies'] into the build directory. """
+    """ Copies everything from self['copies'] into the build directory, using up to deploy_workers threads. """
+    copies = []
     for copy_name, copy_parameters in self['copies'].items():
         self.logger.debug("[%s] Copying: %s" % (copy_name, copy_parameters))
-        self._copy(copy_parameters['source'], copy_parameters['destination'])
+        copies.append((copy_parameters['source'], copy_parameters['destination']))
+
+    self._copy_many(copies, workers=self['deploy_workers'] or None)
 
 
 def deploy_symlinks(self) -> None:
@@ -146,6 +336,11 @@ def deploy_nodes(self) -> None:
     for node, config in self['nodes'].items():
         node_path_abs = Path(config['path'])
 
+        if self._manifest_staging():  # mknod is not needed, the node is created when packing
+            self._stage(node_path_abs, {'type': 'chardev', 'mode': config['mode'], 'major': config['major'], 'minor': config['minor']})
+            self.logger.info("Staged device node '%s' at path: %s" % (node, node_path_abs))
+            continue
+
         node_path = self._get_build_path('/') / node_path_abs.relative_to(node_path_abs.anchor)
         node_mode = S_IFCHR | config['mode']
 
@@ -219,8 +414,50 @@ def _process_paths_multi(self, path: Union[Path, str]) -> None:
     self['paths'].append(path)
 
 
+def _add_binary_dependencies(self, binary: str, dependencies: list[Path]) -> None:
+    """ Adds the calculated dependencies of a binary to dependencies, and their parent directories to library_paths. """
+    # The first dependency will be the path of the binary itself, don't add this to the library paths
+    self['dependencies'] = dependencies[0]
+    for dependency in dependencies[1:]:
+        self['dependencies'] = dependency
+        if str(dependency.parent) not in self['library_paths']:
+            self.logger.info("[%s] Adding library path: %s" % (binary, dependency.parent))
+            # Make it a string so NoDupFlatList can handle it
+            # It being derived from a path should ensure it's a proper path
+            self['library_paths'] = str(dependency.parent)
+
+
+def resolve_binaries(self, binaries=None) -> None:
+    """
+    Resolves the dependencies of all binaries defined during config processing, or the passed binaries.
+    Dependencies are calculated concurrently using up to dependency_workers threads,
+    then added in the order the binaries were defined, so the result is deterministic.
+    Binaries added after this runs are resolved as they are added, by calling this with the binary.
+    The dependency cache is loaded before the first resolution, and saved after each.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    if not self['_binaries_resolved']:
+        _load_dep_cache(self)
+
+    binaries = list(self['binaries']) if binaries is None else binaries
+    workers = self['dependency_workers'] or None  # Use the ThreadPoolExecutor default if unset
+    self.logger.info("Resolving dependencies for %d binaries with %s workers." % (len(binaries), workers or 'default'))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # map returns results in order, raising the first failure in binary order
+        results = executor.map(lambda binary: calculate_dependencies(self, binary), binaries)
+        for binary, dependencies in zip(binaries, results):
+            _add_binary_dependencies(self, binary, dependencies)
+
+    self['_binaries_resolved'] = True
+    _save_dep_cache(self)
+
+
 def _process_binaries_multi(self, binary: str) -> None:
-    """ Processes binaries into the binaries list, adding dependencies along the way. """
+    """
+    Processes binaries into the binaries list.
+    Dependencies are resolved in batch by resolve_binaries, or immediately if that has already run.
+    """
     if binary in self['binaries']:
         return self.logger.debug("Binary already in binaries list, skipping: %s" % binary)
 
@@ -229,18 +466,9 @@ def _process_binaries_multi(self, binary: str) -> None:
         if binary in funcs:
             raise ValueError("Binary name collides with import function name: %s" % binary)
 
-    self.logger.debug("Processing binary: %s" % binary)
-
-    dependencies = calculate_dependencies(self, binary)
-    # The first dependency will be the path of the binary itself, don't add this to the library paths
-    self['dependencies'] = dependencies[0]
-    for dependency in dependencies[1:]:
-        self['dependencies'] = dependency
-        if str(dependency.parent) not in self['library_paths']:
-            self.logger.info("Adding library path: %s" % dependency.parent)
-            # Make it a string so NoDupFlatList can handle it
-            # It being derived from a path should ensure it's a proper path
-            self['library_paths'] = str(dependency.parent)
+    if self['_binaries_resolved']:
+        self.logger.debug("Processing binary: %s" % binary)
+        resolve_binaries(self, [binary])
 
     self.logger.debug("Adding binary: %s" % binary)
     self['binaries'].append(binary)
@@ -308,6 +536,17 @@ def _process_gz_dependencies_multi(self, dependency: Union[Path, str]) -> None:
     self['gz_dependencies'].append(dependency)
 
 
+def _process_zst_dependencies_multi(self, dependency: Union[Path, str]) -> None:
+    """
+    Checks that the file is a zst file, and adds it to the zst dependencies list.
+    !! Resolves symlinks implicitly !!
+    """
+    dependency = _validate_dependency(self, dependency)
+    if dependency.suffix != '.zst':
+        self.logger.warning("ZSTD dependency missing zst extension: %s" % dependency)
+    self['zst_dependencies'].append(dependency)
+
+
 def _process_build_logging(self, log_build: bool) -> None:
     """ Sets the build log flag. """
     build_log_level = self.get('_build_log_level', 10)
@@ -393,6 +632,30 @@ def _process_hostonly(self, hostonly: bool) -> None:
         self['validate'] = False
 
 
+def _process_dependency_resolver(self, resolver: str) -> None:
+    """ Sets the backend used to resolve binary dependencies. """
+    if resolver not in DEPENDENCY_RESOLVERS:
+        raise ValueError("Invalid dependency resolver '%s', valid options: %s" % (resolver, ', '.join(DEPENDENCY_RESOLVERS)))
+    self.logger.debug("Using dependency resolver: %s" % resolver)
+    self.data['dependency_resolver'] = resolver
+
+
+def _process_staging_mode(self, mode: str) -> None:
+    """ Sets how files are staged, in the build directory, or in a manifest which is packed from the source files. """
+    if mode not in STAGING_MODES:
+        raise ValueError("Invalid staging mode '%s', valid options: %s" % (mode, ', '.join(STAGING_MODES)))
+    self.logger.debug("Using staging mode: %s" % mode)
+    self.data['staging_mode'] = mode
+
+
+def _process_copy_mode(self, mode: str) -> None:
+    """ Sets the method used to copy files into the build directory. """
+    if mode not in COPY_MODES:
+        raise ValueError("Invalid copy mode '%s', valid options: %s" % (mode, ', '.join(COPY_MODES)))
+    self.logger.debug("Using copy mode: %s" % mode)
+    self.data['copy_mode'] = mode
+
+
 def _process_validate(self, validate: bool) -> None:
     """
     Processes the validate parameter.
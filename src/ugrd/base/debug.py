@@ -1,9 +1,18 @@
 __author__ = "desultory"
-__version__ = "1.3.0"
+__version__ = "1.4.3"
+
+from pathlib import Path
+from re import compile
 
 from zenlib.util import contains
 
 
+TRACE_FILE = '/run/ugrd/trace'
+# PS4 is expanded for each traced command, so it only uses builtins
+TRACE_PS4 = r'+ ${EPOCHREALTIME} ${FUNCNAME[0]:-main} ${BASH_SOURCE[0]:-?}:${LINENO} '
+TRACE_LINE = compile(r'^\++ (\d+)\.(\d{6}) (\S+) (\S+):(\d+) (.*)$')
+
+
 def start_shell(self) -> str:
     """ Start a bash shell at the start of the initramfs. """
     return ['if ! check_var debug; then',
@@ -11,10 +20,72 @@ def start_shell(self) -> str:
             '    return',
             'fi',
             'einfo "Starting debug shell"',
-            'bash -l']
+            'savevars',
+            'bash -l',
+            'loadvars']
 
 
 @contains('start_shell', 'Not enabling the debug shell, as the start_shell option is not set.', log_level=30)
 def enable_debug(self) -> str:
     """ Enable debug mode. """
     return "setvar debug 1"
+
+
+def enable_trace(self) -> list[str]:
+    """
+    Returns bash to trace every command run by the init, if ugrd.trace is set on the cmdline.
+    The trace is appended to TRACE_FILE, so it is kept across rd_restart, and moved to the real root by switch_root.
+    Each line starts with the time in microseconds, the function name, the file, and the line number.
+    The trace file is created with mode 0600, as traced commands may contain secrets.
+    It is closed before switch_root and rd_restart, so the next init doesn't inherit it.
+    """
+    trace_file = Path(TRACE_FILE)
+    return ['if ! check_var ugrd.trace; then',
+            '    return',
+            'fi',
+            f'mkdir -p {trace_file.parent}',
+            'UGRD_TRACE_UMASK="$(umask)"',
+            'umask 077',
+            f'exec {{UGRD_TRACE_FD}}>>{trace_file}',
+            'umask "$UGRD_TRACE_UMASK"',
+            'BASH_XTRACEFD=$UGRD_TRACE_FD',
+            f"PS4='{TRACE_PS4}'",
+            f'einfo "Tracing init to: {trace_file}"',
+            'set -x']
+
+
+def read_trace(path: Path) -> list[tuple[int, str, str, str]]:
+    """
+    Reads an init trace, returns a list of (time_us, function, location, command) for each traced command.
+    Lines which are not traced commands, such as multi-line arguments, are skipped.
+    """
+    commands = []
+    for line in Path(path).read_text(errors='replace').splitlines():
+        if match := TRACE_LINE.match(line):
+            seconds, microseconds, function, source, line_number, command = match.groups()
+            commands.append((int(seconds) * 10 ** 6 + int(microseconds), function, f'{source}:{line_number}', command))
+    return commands
+
+
+def analyze_trace(path: Path, limit=25) -> str:
+    """
+    Returns a report of the lines in an init trace which took the most time, up to 'limit' lines.
+    The time of a command is the time until the next traced command started, so it includes untraced programs it runs.
+    Commands are grouped by their file and line number.
+    """
+    commands = read_trace(path)
+    if len(commands) < 2:
+        raise ValueError("Not enough traced commands in: %s" % path)
+
+    hot_spots = {}
+    for (start, function, location, command), next_command in zip(commands, commands[1:]):
+        total, calls, _, _ = hot_spots.get(location, (0, 0, function, command))
+        hot_spots[location] = (total + next_command[0] - start, calls + 1, function, command)
+
+    trace_time = commands[-1][0] - commands[0][0]
+    lines = ['Traced %d commands over %.3f ms' % (len(commands), trace_time / 1000),
+             '%10s  %6s  %6s  %-20s  %-24s  %s' % ('Time (ms)', '%', 'Calls', 'Location', 'Function', 'Command')]
+    for location, (total, calls, function, command) in sorted(hot_spots.items(), key=lambda item: -item[1][0])[:limit]:
+        lines.append('%10.3f  %6.1f  %6d  %-20s  %-24s  %s' % (total / 1000, 100 * total / trace_time if trace_time else 0,
+                                                                calls, location, function, command))
+    return '\n'.join(lines)
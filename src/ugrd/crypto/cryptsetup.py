@@ -1,5 +1,5 @@
 __author__ = 'desultory'
-__version__ = '2.5.8'
+__version__ = '2.5.9'
 
 from zenlib.util import contains
 
@@ -307,10 +307,15 @@ def open_crypt_device(self, name: str, parameters: dict) -> list[str]:
 
 
 def crypt_init(self) -> list[str]:
-    """ Generates the bash script portion to prompt for keys. """
+    """
+    Generates the bash script portion to prompt for keys.
+    xtrace is disabled until the function returns, so key commands are not written to the ugrd.trace file.
+    """
     if not self['cryptsetup_prompt']:
         self.logger.warning("'cryptsetup_prompt' is disabled, if the 'quiet' kernel parameter is not set, the prompt may be hidden under log messages at runtime.")
-    out = [r'einfo "Unlocking LUKS volumes, ugrd.cryptsetup version: %s"' % __version__]
+    out = ['local -',  # Restores shell options, including xtrace, when the function returns
+           'set +x',
+           r'einfo "Unlocking LUKS volumes, ugrd.cryptsetup version: %s"' % __version__]
     for name, parameters in self['cryptsetup'].items():
         # Check if the volume is already open, if so, skip it
         out += [f'if cryptsetup status {name} > /dev/null 2>&1; then',
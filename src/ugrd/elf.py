@@ -0,0 +1,290 @@
+"""
+Minimal ELF reader and shared library resolver.
+
+Reads the program headers and dynamic section of ELF files, and resolves DT_NEEDED entries
+using the same search order as the glibc dynamic linker:
+DT_RPATH (when DT_RUNPATH is not set), DT_RUNPATH, /etc/ld.so.cache, then the default library paths.
+
+Sections can be read from streamed data, such as decompressed kernel modules, with read_elf_section.
+"""
+
+__author__ = 'desultory'
+__version__ = '0.2.2'
+
+from functools import lru_cache
+from os import stat, uname
+from pathlib import Path
+from struct import unpack_from, calcsize
+from typing import Iterable, Union
+
+
+ELF_MAGIC = b'\x7fELF'
+ELFCLASS32, ELFCLASS64 = 1, 2
+ELFDATA2LSB, ELFDATA2MSB = 1, 2
+
+PT_LOAD, PT_DYNAMIC, PT_INTERP = 1, 2, 3
+DT_NULL, DT_NEEDED, DT_STRTAB, DT_STRSZ, DT_RPATH, DT_RUNPATH = 0, 1, 5, 10, 15, 29
+
+# e_type, e_machine, e_version, e_entry, e_phoff, e_shoff, e_flags, e_ehsize, e_phentsize, e_phnum, e_shentsize, e_shnum, e_shstrndx
+ELF_HEADER = {ELFCLASS32: 'HHIIIIIHHHHHH', ELFCLASS64: 'HHIQQQIHHHHHH'}
+# p_type, p_offset, p_vaddr, p_filesz (other fields are skipped as padding)
+PROGRAM_HEADER = {ELFCLASS32: 'III4xI12x', ELFCLASS64: 'I4xQQ8xQ16x'}
+# sh_name, sh_offset, sh_size (other fields are skipped as padding)
+SECTION_HEADER = {ELFCLASS32: 'I12xII16x', ELFCLASS64: 'I20xQQ24x'}
+DYNAMIC_ENTRY = {ELFCLASS32: 'iI', ELFCLASS64: 'qQ'}
+
+LDSO_CACHE = '/etc/ld.so.cache'
+LDSO_CACHE_MAGIC = b'glibc-ld.so.cache1.1'
+LDSO_CACHE_OLD_MAGIC = b'ld.so-1.7.0'
+DEFAULT_LIBRARY_PATHS = {ELFCLASS32: ['/lib', '/usr/lib'], ELFCLASS64: ['/lib64', '/usr/lib64', '/lib', '/usr/lib']}
+
+
+class ELFError(Exception):
+    pass
+
+
+class NotELFError(ELFError):
+    """ Raised for files which are not ELF files, such as scripts. """
+    pass
+
+
+class ELFFile:
+    """
+    Reads the ELF header, program headers, and dynamic section of a file.
+    Only the information needed for dependency resolution is retained.
+    """
+    def __init__(self, path: Union[Path, str]):
+        self.path = Path(path)
+        self.interpreter = None
+        self.needed = []
+        self.rpath = []
+        self.runpath = []
+        with open(self.path, 'rb') as elf_file:
+            self._read_header(elf_file)
+            self._read_program_headers(elf_file)
+            self._read_dynamic(elf_file)
+
+    def _read_header(self, elf_file) -> None:
+        ident = elf_file.read(16)
+        if len(ident) < 16 or ident[:4] != ELF_MAGIC:
+            raise NotELFError("Not an ELF file: %s" % self.path)
+        self.elf_class, self.elf_data, self.osabi = ident[4], ident[5], ident[7]
+        if self.elf_class not in ELF_HEADER or self.elf_data not in (ELFDATA2LSB, ELFDATA2MSB):
+            raise ELFError("Unsupported ELF class/encoding: %s" % self.path)
+        self.endian = '<' if self.elf_data == ELFDATA2LSB else '>'
+
+        header_format = self.endian + ELF_HEADER[self.elf_class]
+        header = unpack_from(header_format, elf_file.read(calcsize(header_format)))
+        self.elf_type, self.machine = header[0], header[1]
+        self.phoff, self.shoff = header[4], header[5]
+        self.phentsize, self.phnum = header[8], header[9]
+        self.shentsize, self.shnum, self.shstrndx = header[10], header[11], header[12]
+
+    def _read_program_headers(self, elf_file) -> None:
+        """ Reads the program headers, storing PT_LOAD segments and the PT_DYNAMIC/PT_INTERP locations. """
+        self.load_segments = []
+        self.dynamic = None
+        ph_format = self.endian + PROGRAM_HEADER[self.elf_class]
+        elf_file.seek(self.phoff)
+        program_headers = elf_file.read(self.phentsize * self.phnum)
+        for index in range(self.phnum):
+            p_type, p_offset, p_vaddr, p_filesz = unpack_from(ph_format, program_headers, index * self.phentsize)
+            if p_type == PT_LOAD:
+                self.load_segments.append((p_vaddr, p_offset, p_filesz))
+            elif p_type == PT_DYNAMIC:
+                self.dynamic = (p_offset, p_filesz)
+            elif p_type == PT_INTERP:
+                elf_file.seek(p_offset)
+                self.interpreter = elf_file.read(p_filesz).rstrip(b'\0').decode()
+                elf_file.seek(self.phoff)
+
+    def _vaddr_to_offset(self, vaddr: int) -> int:
+        """ Converts a virtual address to a file offset using the PT_LOAD segments. """
+        for p_vaddr, p_offset, p_filesz in self.load_segments:
+            if p_vaddr <= vaddr < p_vaddr + p_filesz:
+                return p_offset + vaddr - p_vaddr
+        raise ELFError("[%s] Unable to map virtual address to file offset: %#x" % (self.path, vaddr))
+
+    def _read_dynamic(self, elf_file) -> None:
+        """ Reads DT_NEEDED, DT_RPATH, and DT_RUNPATH from the dynamic section. """
+        if not self.dynamic:
+            return  # Statically linked
+
+        entry_format = self.endian + DYNAMIC_ENTRY[self.elf_class]
+        entry_size = calcsize(entry_format)
+        elf_file.seek(self.dynamic[0])
+        dynamic = elf_file.read(self.dynamic[1])
+
+        entries = []
+        for offset in range(0, len(dynamic) - entry_size + 1, entry_size):
+            tag, value = unpack_from(entry_format, dynamic, offset)
+            if tag == DT_NULL:
+                break
+            entries.append((tag, value))
+
+        tags = dict(entries)
+        if DT_STRTAB not in tags:
+            raise ELFError("Dynamic section has no string table: %s" % self.path)
+        elf_file.seek(self._vaddr_to_offset(tags[DT_STRTAB]))
+        strtab = elf_file.read(tags.get(DT_STRSZ, 0))
+
+        def get_string(offset):
+            return strtab[offset:strtab.index(b'\0', offset)].decode()
+
+        for tag, value in entries:
+            if tag == DT_NEEDED:
+                self.needed.append(get_string(value))
+            elif tag == DT_RPATH:
+                self.rpath += get_string(value).split(':')
+            elif tag == DT_RUNPATH:
+                self.runpath += get_string(value).split(':')
+
+    def is_compatible(self, other: 'ELFFile') -> bool:
+        """ Checks if another ELF file can be loaded alongside this one. """
+        return (self.elf_class, self.elf_data, self.machine) == (other.elf_class, other.elf_data, other.machine)
+
+    def expand_path(self, path: str) -> str:
+        """ Expands $ORIGIN, $LIB, and $PLATFORM in a search path. """
+        lib = 'lib64' if self.elf_class == ELFCLASS64 else 'lib'
+        for name, value in (('ORIGIN', str(self.path.resolve().parent)), ('LIB', lib), ('PLATFORM', uname().machine)):
+            path = path.replace('${%s}' % name, value).replace('$%s' % name, value)
+        return path
+
+
+def read_elf_section(chunks: Iterable[bytes], name: str) -> bytes:
+    """
+    Reads a section from ELF data provided as an iterable of chunks, such as the output of a streaming decompressor.
+    Chunks are buffered until the section headers, section name table, and requested section have been read.
+    Section headers are usually at the end of the file, so most of the data is buffered.
+    Returns None if the section does not exist.
+    """
+    chunks = iter(chunks)
+    data = bytearray()
+
+    def read_until(size: int) -> None:
+        while len(data) < size:
+            if (chunk := next(chunks, None)) is None:
+                raise ELFError("Unexpected end of ELF data, expected at least %d bytes, got: %d" % (size, len(data)))
+            data.extend(chunk)
+
+    read_until(16)
+    if data[:4] != ELF_MAGIC or data[4] not in ELF_HEADER or data[5] not in (ELFDATA2LSB, ELFDATA2MSB):
+        raise ELFError("Invalid ELF header")
+    endian = '<' if data[5] == ELFDATA2LSB else '>'
+    header_format = endian + ELF_HEADER[data[4]]
+    section_format = endian + SECTION_HEADER[data[4]]
+
+    read_until(16 + calcsize(header_format))
+    header = unpack_from(header_format, data, 16)
+    shoff, shentsize, shnum, shstrndx = header[5], header[10], header[11], header[12]
+
+    read_until(shoff + shentsize * shnum)
+    sections = [unpack_from(section_format, data, shoff + index * shentsize) for index in range(shnum)]
+
+    _, strtab_offset, strtab_size = sections[shstrndx]
+    read_until(strtab_offset + strtab_size)
+    for name_offset, offset, size in sections:
+        name_offset += strtab_offset
+        if data[name_offset:data.index(b'\0', name_offset)].decode() == name:
+            read_until(offset + size)
+            return bytes(data[offset:offset + size])
+
+
+@lru_cache
+def _read_elf(path: str, ino: int, mtime_ns: int) -> ELFFile:
+    return ELFFile(path)
+
+
+def read_elf(path: str) -> ELFFile:
+    """ Reads an ELF file, caching the result by path, inode, and mtime, so files changed between builds are read again. """
+    file_stat = stat(path)
+    return _read_elf(path, file_stat.st_ino, file_stat.st_mtime_ns)
+
+
+@lru_cache
+def read_ldso_cache(cache_file: str = LDSO_CACHE) -> dict[str, list[str]]:
+    """
+    Parses the binary ld.so.cache, returning a dict of sonames to library paths in cache order.
+    Entries for glibc-hwcaps subdirectories are skipped, as they depend on the CPU of the build host.
+    """
+    try:
+        data = Path(cache_file).read_bytes()
+    except FileNotFoundError:
+        return {}
+
+    offset = 0
+    if data.startswith(LDSO_CACHE_OLD_MAGIC):
+        # The old format is followed by the new format, aligned to 8 bytes
+        old_entries = unpack_from('<I', data, len(LDSO_CACHE_OLD_MAGIC) + 1)[0]
+        offset = (len(LDSO_CACHE_OLD_MAGIC) + 5 + old_entries * 12 + 7) & ~7
+
+    if data[offset:offset + len(LDSO_CACHE_MAGIC)] != LDSO_CACHE_MAGIC:
+        raise ELFError("Unsupported ld.so.cache format: %s" % cache_file)
+
+    # Detect the cache endianness using the string table length, which must fit in the file
+    endian = '<' if unpack_from('<I', data, offset + 24)[0] <= len(data) else '>'
+    nlibs = unpack_from(endian + 'I', data, offset + 20)[0]
+
+    def get_string(string_offset):
+        string_offset += offset
+        return data[string_offset:data.index(b'\0', string_offset)].decode()
+
+    libraries = {}
+    for index in range(nlibs):
+        _flags, key, value, _osversion, hwcap = unpack_from(endian + 'iIIIQ', data, offset + 48 + index * 24)
+        if hwcap:
+            continue
+        libraries.setdefault(get_string(key), []).append(get_string(value))
+    return libraries
+
+
+class ELFResolver:
+    """
+    Resolves the shared library dependencies of an ELF file like the dynamic linker would.
+    Returns the same set of paths as 'lddtree -l': the file itself, the interpreter, then every library in the closure.
+    """
+    def __init__(self, ldso_cache: str = LDSO_CACHE):
+        self.ldso_cache = read_ldso_cache(ldso_cache)
+
+    def _find_library(self, soname: str, loader: ELFFile, rpaths: list[str]) -> str:
+        """ Finds a library by soname, using the loader's search paths. """
+        if '/' in soname:
+            return soname
+
+        search_paths = ([] if loader.runpath else rpaths) + [loader.expand_path(path) for path in loader.runpath]
+        candidates = [str(Path(path) / soname) for path in search_paths if path]
+        candidates += self.ldso_cache.get(soname, [])
+        candidates += [str(Path(path) / soname) for path in DEFAULT_LIBRARY_PATHS[loader.elf_class]]
+
+        for candidate in candidates:
+            try:
+                if loader.is_compatible(read_elf(candidate)):
+                    return candidate
+            except (OSError, ELFError):
+                continue
+        raise ELFError("[%s] Unable to find library: %s" % (loader.path, soname))
+
+    def resolve(self, path: Union[Path, str]) -> list[Path]:
+        """ Returns the path, interpreter, and library dependencies of an ELF file, in breadth-first order. """
+        elf = read_elf(str(path))
+        dependencies = [Path(path)]
+        if elf.interpreter:
+            dependencies.append(Path(elf.interpreter))
+
+        # DT_RPATH applies to the object and everything it loads, unless DT_RUNPATH is set
+        queue = [(elf, [elf.expand_path(rpath) for rpath in elf.rpath])]
+        # The interpreter is already loaded, so libraries which need it by soname (like libc) reuse it
+        resolved = {Path(elf.interpreter).name} if elf.interpreter else set()
+        while queue:
+            loader, rpaths = queue.pop(0)
+            for soname in loader.needed:
+                if soname in resolved:
+                    continue
+                resolved.add(soname)
+                library_path = self._find_library(soname, loader, rpaths)
+                library = read_elf(library_path)
+                if Path(library_path) not in dependencies:
+                    dependencies.append(Path(library_path))
+                queue.append((library, [library.expand_path(rpath) for rpath in library.rpath] + rpaths))
+
+        return dependencies
@@ -0,0 +1,165 @@
+"""
+Build fingerprints, used to skip rebuilding the initramfs when its inputs are unchanged.
+
+The fingerprint is a sha256 of the resolved config, the version of ugrd and every loaded module,
+and the path, size, mtime, and inode of every input file.
+It is checked after build_pre, once binaries and kernel modules have been resolved,
+and stored next to the output file with the packed entries, so checks can run against them.
+
+Input files added by build_tasks or build_final are not known when the fingerprint is checked,
+so the input files of the last build are stored with it, and must also be unchanged.
+Builds which use modules listed in _build_fingerprint_unsupported, which stage files ugrd can't see, are never skipped.
+"""
+
+__author__ = 'desultory'
+__version__ = '0.3.0'
+
+from hashlib import sha256
+from json import dumps, loads, JSONDecodeError
+from os import stat
+from pathlib import Path
+from sys import modules
+
+from ugrd.kmod.kconfig import _get_kernel_config_file
+
+
+FINGERPRINT_VERSION = 2
+# Config values which can differ between runs without changing the output, such as caches
+FINGERPRINT_IGNORED_KEYS = ['_processing', '_dep_cache', '_kmod_cache_loaded', '_kmod_closures', '_kmod_modinfo',
+                            '_build_fingerprint', '_build_fingerprint_file', '_build_fingerprint_matched', '_build_outputs']
+
+
+def _normalize(value):
+    """ Converts a config value into a JSON serializable value, which is the same between runs. """
+    if isinstance(value, dict):
+        return {str(key): _normalize(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_normalize(item) for item in value]
+    if isinstance(value, set):
+        return sorted((_normalize(item) for item in value), key=dumps)
+    if isinstance(value, (str, int, float, bool)) or value is None:
+        return value
+    if callable(value):  # Functions and parameter types
+        return '%s.%s' % (getattr(value, '__module__', ''), getattr(value, '__qualname__', type(value).__name__))
+    if ' at 0x' in (value_str := str(value)):  # Don't include memory addresses
+        return type(value).__name__
+    return value_str
+
+
+def _get_module_versions(self) -> dict:
+    """ Returns the version of ugrd, and the __version__ of every module with imported functions. """
+    from importlib.metadata import version, PackageNotFoundError
+
+    try:
+        versions = {'ugrd': version('ugrd')}
+    except PackageNotFoundError:
+        versions = {'ugrd': None}
+
+    functions = [*self['custom_processing'].values()]
+    for hook_functions in self['imports'].values():
+        functions.extend(hook_functions if isinstance(hook_functions, list) else [hook_functions])
+    for function in functions:
+        if module := modules.get(getattr(function, '__module__', None)):
+            versions[module.__name__] = getattr(module, '__version__', None)
+    return versions
+
+
+def _get_input_files(self) -> list[str]:
+    """ Returns every file which is copied or read into the initramfs. """
+    files = [*self['dependencies'], *self['xz_dependencies'], *self['gz_dependencies'], *self['zst_dependencies']]
+    files.extend(copy['source'] for copy in self['copies'].values())
+    files.extend(self.get('early_dependencies', []))
+    for microcode in self.get('_early_microcode', {}).values():
+        files.extend(microcode)
+    if kernel_config := _get_kernel_config_file(self):
+        files.append(kernel_config)
+    return sorted({str(file) for file in files})
+
+
+def _get_file_key(path: str) -> list:
+    """ Returns the size, mtime, and inode of a file, or None if it does not exist. """
+    try:
+        file_stat = stat(path)
+    except FileNotFoundError:
+        return None
+    return [file_stat.st_size, file_stat.st_mtime_ns, file_stat.st_ino]
+
+
+def get_build_fingerprint(self) -> str:
+    """ Returns the build fingerprint for the current config and input files. """
+    config = {key: value for key, value in self.config_dict.data.items() if key not in FINGERPRINT_IGNORED_KEYS}
+    digest = sha256(dumps([FINGERPRINT_VERSION, _normalize(config), _get_module_versions(self)], sort_keys=True).encode())
+    for path in _get_input_files(self):
+        digest.update(dumps([path, _get_file_key(path)]).encode())
+    return digest.hexdigest()
+
+
+def _get_fingerprint_file(out_file: Path) -> Path:
+    return out_file.with_name(out_file.name + '.fingerprint')
+
+
+def check_build_fingerprint(self) -> bool:
+    """
+    Checks if the build fingerprint matches the fingerprint stored by the last build, and the output file is unchanged.
+    If it does, the packed entries of the last build are loaded, so they can be checked, and _build_fingerprint_matched is set.
+    Checks which read the contents of staged files are skipped, as the build directory or manifest is not populated.
+    Stores the fingerprint in _build_fingerprint, so it can be saved after the build.
+    The fingerprint file is named from the output file before packing, as tune_compression may change the extension.
+    """
+    if not self['build_fingerprint'] or not self.get('_archive_out_path'):
+        return False
+    if unsupported := self['_build_fingerprint_unsupported']:
+        return self.logger.info("Not checking the build fingerprint, modules stage files it can't include: %s" % ', '.join(unsupported))
+
+    self['_build_fingerprint'] = get_build_fingerprint(self)
+    self['_build_fingerprint_file'] = fingerprint_file = _get_fingerprint_file(self['_archive_out_path'])
+    try:
+        fingerprint = loads(fingerprint_file.read_text())
+    except FileNotFoundError:
+        return self.logger.debug("Build fingerprint does not exist: %s" % fingerprint_file)
+    except (OSError, JSONDecodeError) as e:
+        return self.logger.warning("Unable to read build fingerprint '%s': %s" % (fingerprint_file, e))
+
+    if fingerprint.get('version') != FINGERPRINT_VERSION or fingerprint.get('fingerprint') != self['_build_fingerprint']:
+        return self.logger.info("Build inputs have changed since the last build.")
+    if not _get_file_key(fingerprint['output']) or _get_file_key(fingerprint['output']) != fingerprint['output_key']:
+        return self.logger.info("Output file has changed since the last build: %s" % fingerprint['output'])
+    for output, output_key in fingerprint['outputs'].items():
+        if not _get_file_key(output) or _get_file_key(output) != output_key:
+            return self.logger.info("Output file has changed since the last build: %s" % output)
+    for path, file_key in fingerprint['input_files'].items():
+        if _get_file_key(path) != file_key:
+            return self.logger.info("Input file has changed since the last build: %s" % path)
+
+    self['_archive_out_path'] = Path(fingerprint['output'])
+    self['_cpio_entries'] = fingerprint['cpio_entries']
+    self['_early_cpio_entries'] = fingerprint['early_cpio_entries']
+    self['_build_fingerprint_matched'] = True
+    return True
+
+
+def save_build_fingerprint(self) -> None:
+    """
+    Writes the build fingerprint, the output files, the packed entries, and the input files to the fingerprint file.
+    The input files are read after the build, so files added by build_tasks and build_final are included.
+    The fingerprint is not written again if the build was skipped, as the input files of the build would be lost.
+    """
+    if not self.get('_build_fingerprint') or self['_build_fingerprint_matched']:
+        return
+
+    fingerprint_file = self['_build_fingerprint_file']
+    output = str(self['_archive_out_path'])
+    if not _get_file_key(output):
+        return self.logger.debug("Output file was not written, not saving the build fingerprint: %s" % output)
+    try:
+        temp_file = fingerprint_file.with_name(fingerprint_file.name + '.tmp')
+        temp_file.write_text(dumps({'version': FINGERPRINT_VERSION, 'fingerprint': self['_build_fingerprint'],
+                                    'output': output, 'output_key': _get_file_key(output),
+                                    'outputs': {str(path): _get_file_key(path) for path in self['_build_outputs']},
+                                    'input_files': {path: _get_file_key(path) for path in _get_input_files(self)},
+                                    'cpio_entries': self.get('_cpio_entries', {}),
+                                    'early_cpio_entries': self.get('_early_cpio_entries', {})}, default=str))
+        temp_file.replace(fingerprint_file)
+    except OSError as e:
+        return self.logger.warning("Unable to write build fingerprint '%s': %s" % (fingerprint_file, e))
+    self.logger.debug("Wrote build fingerprint to: %s" % fingerprint_file)
@@ -1,4 +1,4 @@
-__version__ = '1.8.2'
+__version__ = '1.8.3'
 __author__ = 'desultory'
 
 
@@ -97,7 +97,7 @@ def select_subvol(self) -> str:
             "                    ewarn 'Invalid selection'",
             "                else",
             '                    einfo "Selected subvolume: $subvol"',
-            '                    echo -n ",subvol=$subvol" >> /run/vars/MOUNTS_ROOT_OPTIONS',
+            '                    setvar MOUNTS_ROOT_OPTIONS "$(readvar MOUNTS_ROOT_OPTIONS),subvol=$subvol"',
             "                    break",
             "                fi",
             "                ;;",
@@ -111,5 +111,5 @@ def select_subvol(self) -> str:
 def set_root_subvol(self) -> str:
     """ Adds the root_subvol to the root_mount options. """
     _validate_root_subvol(self)
-    return f'''echo -n ",subvol={self['root_subvol']}" >> /run/vars/MOUNTS_ROOT_OPTIONS'''
+    return f'''setvar MOUNTS_ROOT_OPTIONS "$(readvar MOUNTS_ROOT_OPTIONS),subvol={self['root_subvol']}"'''
 
@@ -0,0 +1,343 @@
+"""
+Compressed output streams for the initramfs archive.
+
+ParallelXZWriter writes a standard multi-block xz stream, compressing blocks concurrently.
+Every block is an independent LZMA2 block with a CRC32 check, which the kernel's xz decompressor supports.
+Block boundaries only depend on the block size, so the output is identical for any number of threads.
+
+ZstdWriter uses the zstandard library if it is installed, otherwise the zstd command.
+lz4 output is written by the lz4 command, gzip by the standard library.
+
+abort_compressed stops a stream without finishing it, so no threads or commands are left running after an error.
+
+read_compressed decompresses a file on a single core, so decompression speed can be compared between formats.
+"""
+
+__author__ = 'desultory'
+__version__ = '0.4.0'
+
+from concurrent.futures import ThreadPoolExecutor
+from gzip import GzipFile
+from lzma import LZMACompressor, FORMAT_RAW, FILTER_LZMA2, CHECK_CRC32
+from lzma import open as lzma_open
+from pathlib import Path
+from struct import pack
+from typing import BinaryIO
+from zlib import crc32
+
+
+XZ_MAGIC = b'\xfd7zXZ\x00'
+XZ_FOOTER_MAGIC = b'YZ'
+XZ_STREAM_FLAGS = b'\x00' + bytes([CHECK_CRC32])
+# (minimum, maximum, default) compression level for each format
+COMPRESSION_LEVELS = {'xz': (0, 9, 6),
+                      'zstd': (1, 22, 3),
+                      'lz4': (1, 12, 9),
+                      'gzip': (1, 9, 6)}
+
+XZ_PRESET_DICT_SIZES = [2 ** 18, 2 ** 20, 2 ** 21, 2 ** 22, 2 ** 22, 2 ** 23, 2 ** 23, 2 ** 24, 2 ** 25, 2 ** 26]
+XZ_ENCODER_DICT_MULTIPLIER = 12  # LZMA2 encoder memory is about 11.5x the dictionary size with the bt4 match finder
+
+
+def _encode_varint(value: int) -> bytes:
+    """ Encodes an integer using the xz multibyte integer encoding. """
+    encoded = bytearray()
+    while value >= 0x80:
+        encoded.append((value & 0x7F) | 0x80)
+        value >>= 7
+    encoded.append(value)
+    return bytes(encoded)
+
+
+def _pad4(size: int) -> bytes:
+    return b'\0' * (-size % 4)
+
+
+def _get_memory_limit() -> int:
+    """ Returns a quarter of the physical memory, the default memory limit of xz --threads. """
+    from os import sysconf
+    try:
+        return sysconf('SC_PAGE_SIZE') * sysconf('SC_PHYS_PAGES') // 4
+    except (ValueError, OSError):
+        return 2 ** 30
+
+
+def _encode_dict_size(dict_size: int) -> int:
+    """ Returns the LZMA2 dictionary size property, the smallest encodable size which fits dict_size. """
+    for bits in range(40):
+        if (2 | (bits & 1)) << (bits // 2 + 11) >= dict_size:
+            return bits
+    return 40
+
+
+class ParallelXZWriter:
+    """
+    File-like object which compresses written data into a multi-block xz stream, with CRC32 checks.
+
+    Data is split into blocks of block_size bytes, which are compressed using up to 'threads' threads.
+    At most threads * 2 blocks are held in memory at once, compressed blocks are written in order.
+    Defaults to 3x the preset dictionary size for the block size, like xz --threads.
+
+    Each thread uses about 12x the dictionary size for the encoder, and 3 blocks for its input and output,
+    168 MiB at preset 6. Like xz, threads are reduced so this fits in memory_limit, which defaults to a quarter of the RAM.
+    The output does not depend on the number of threads.
+    close() writes the index and stream footer, it does not close the output file.
+    """
+    def __init__(self, out_file: BinaryIO, threads: int, preset=6, block_size=None, memory_limit=None):
+        self.out_file = out_file
+        self.preset = preset
+        self.dict_size = XZ_PRESET_DICT_SIZES[preset & 0x1F]
+        self.block_size = block_size or self.dict_size * 3
+        self.dict_size = min(self.dict_size, self.block_size)  # Larger dictionaries than the block are unused
+        self.thread_memory = self.dict_size * XZ_ENCODER_DICT_MULTIPLIER + self.block_size * 3
+        self.threads = max(1, min(threads, (memory_limit or _get_memory_limit()) // self.thread_memory))
+        self.executor = ThreadPoolExecutor(max_workers=self.threads)
+        self.pending = []  # Futures for blocks being compressed, in order
+        self.records = []  # (unpadded size, uncompressed size) for the index
+        self.buffer = bytearray()
+        self.closed = False
+        self.out_file.write(XZ_MAGIC + XZ_STREAM_FLAGS + pack('<I', crc32(XZ_STREAM_FLAGS)))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type:
+            self.abort()
+        else:
+            self.close()
+
+    def abort(self) -> None:
+        """ Cancels pending blocks, without writing the index or footer. """
+        self.executor.shutdown(cancel_futures=True)
+        self.pending = []
+        self.closed = True
+
+    def _compress_block(self, data: bytes) -> tuple[bytes, int, int]:
+        """ Returns the encoded block, its unpadded size, and uncompressed size. """
+        compressor = LZMACompressor(format=FORMAT_RAW, filters=[{'id': FILTER_LZMA2, 'preset': self.preset,
+                                                                  'dict_size': self.dict_size}])
+        compressed = compressor.compress(data) + compressor.flush()
+
+        # Block flags: one filter, with the compressed and uncompressed sizes
+        header = bytes([0xC0]) + _encode_varint(len(compressed)) + _encode_varint(len(data))
+        header += b'\x21\x01' + bytes([_encode_dict_size(self.dict_size)])  # LZMA2 filter ID, properties size, dict size
+        header_size = len(header) + 1  # Add the header size byte
+        header = bytes([(header_size + 3) // 4]) + header + _pad4(header_size)
+        header += pack('<I', crc32(header))
+
+        block = header + compressed + _pad4(len(compressed)) + pack('<I', crc32(data))
+        return block, len(header) + len(compressed) + 4, len(data)
+
+    def _write_completed(self, wait=False) -> None:
+        """ Writes compressed blocks in order, waiting for blocks if there are too many pending, or wait is set. """
+        while self.pending and (wait or self.pending[0].done() or len(self.pending) >= self.threads * 2):
+            block, unpadded_size, uncompressed_size = self.pending.pop(0).result()
+            self.out_file.write(block)
+            self.records.append((unpadded_size, uncompressed_size))
+
+    def write(self, data: bytes) -> int:
+        self.buffer += data
+        while len(self.buffer) >= self.block_size:
+            block, self.buffer = bytes(self.buffer[:self.block_size]), self.buffer[self.block_size:]
+            self.pending.append(self.executor.submit(self._compress_block, block))
+            self._write_completed()
+        return len(data)
+
+    def close(self) -> None:
+        """ Compresses any remaining data, then writes the index and stream footer. """
+        if self.closed:
+            return
+        if self.buffer:
+            self.pending.append(self.executor.submit(self._compress_block, bytes(self.buffer)))
+            self.buffer = bytearray()
+        self._write_completed(wait=True)
+        self.executor.shutdown()
+
+        index = b'\x00' + _encode_varint(len(self.records))
+        for unpadded_size, uncompressed_size in self.records:
+            index += _encode_varint(unpadded_size) + _encode_varint(uncompressed_size)
+        index += _pad4(len(index))
+        index += pack('<I', crc32(index))
+
+        footer = pack('<I', len(index) // 4 - 1) + XZ_STREAM_FLAGS
+        self.out_file.write(index + pack('<I', crc32(footer)) + footer + XZ_FOOTER_MAGIC)
+        self.closed = True
+
+
+class CommandWriter:
+    """
+    File-like object which pipes written data through a compression command, writing its output to out_file.
+    The output is copied by a thread, so out_file does not need to be a real file.
+    close() waits for the command to exit, it does not close the output file.
+    abort() kills the command, so the thread is not left waiting for output.
+    """
+    def __init__(self, out_file: BinaryIO, args: list[str]):
+        from subprocess import Popen, PIPE
+        from shutil import copyfileobj
+        from threading import Thread
+        self.args = args
+        self.process = Popen(args, stdin=PIPE, stdout=PIPE)
+        self.reader = Thread(target=copyfileobj, args=(self.process.stdout, out_file))
+        self.reader.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type:
+            self.abort()
+        else:
+            self.close()
+
+    def write(self, data: bytes) -> int:
+        return self.process.stdin.write(data)
+
+    def abort(self) -> None:
+        self.process.kill()
+        try:
+            self.process.stdin.close()
+        except BrokenPipeError:
+            pass
+        self.reader.join()
+        self.process.wait()
+
+    def close(self) -> None:
+        self.process.stdin.close()
+        self.reader.join()
+        if self.process.wait() != 0:
+            raise RuntimeError("%s exited with code: %d" % (self.args[0], self.process.returncode))
+
+
+class ZstdWriter:
+    """
+    File-like object which compresses written data with zstd, using up to 'threads' threads.
+    Uses the zstandard library if available, otherwise data is piped through the zstd command.
+    close() finishes the zstd frame, it does not close the output file.
+    """
+    def __init__(self, out_file: BinaryIO, threads: int, level=3):
+        try:
+            from zstandard import ZstdCompressor
+            compressor = ZstdCompressor(level=level, threads=threads if threads > 1 else 0)
+            self.writer = compressor.stream_writer(out_file, closefd=False)
+        except ImportError:
+            args = ['zstd', '--quiet', '--stdout', '-%d' % level, '-T%d' % threads]
+            if level > 19:
+                args.insert(1, '--ultra')
+            self.writer = CommandWriter(out_file, args)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type:
+            self.abort()
+        else:
+            self.close()
+
+    def write(self, data: bytes) -> int:
+        return self.writer.write(data)
+
+    def abort(self) -> None:
+        abort_compressed(self.writer)
+
+    def close(self) -> None:
+        self.writer.close()
+
+
+def open_compressed(out_file: BinaryIO, compression: str, threads=1, level=None):
+    """
+    Returns a file-like object which compresses data written to it into out_file.
+    Supports the formats in COMPRESSION_LEVELS, threads may be 0 to use all CPUs.
+    xz threads are also limited by memory, see ParallelXZWriter.
+    If the level is not set, the default level for the format is used.
+
+    xz uses a single stream with the standard library if threads is 1, otherwise ParallelXZWriter.
+    lz4 uses the legacy frame format, as it is the only one the kernel can unpack.
+    gzip and lz4 are always single threaded.
+    """
+    if compression not in COMPRESSION_LEVELS:
+        raise ValueError("Unsupported compression: %s" % compression)
+
+    min_level, max_level, default_level = COMPRESSION_LEVELS[compression]
+    level = default_level if level is None else level
+    if not min_level <= level <= max_level:
+        raise ValueError("Invalid %s compression level %d, must be between %d and %d" % (compression, level, min_level, max_level))
+
+    if not threads:
+        from os import cpu_count
+        threads = cpu_count() or 1
+
+    if compression == 'xz':
+        if threads == 1:
+            return lzma_open(out_file, 'wb', check=CHECK_CRC32, preset=level)  # The kernel xz decompressor only supports CRC32
+        return ParallelXZWriter(out_file, threads, preset=level)
+    if compression == 'zstd':
+        return ZstdWriter(out_file, threads, level)
+    if compression == 'lz4':
+        return CommandWriter(out_file, ['lz4', '-l', '-%d' % level, '--quiet', '--stdout'])
+    if compression == 'gzip':
+        return GzipFile(fileobj=out_file, mode='wb', compresslevel=level, mtime=0)
+
+
+def abort_compressed(archive) -> None:
+    """
+    Stops a stream returned by open_compressed after an error, killing compression commands and threads.
+    Streams without an abort method are closed, as they do not use threads or commands.
+    """
+    if abort := getattr(archive, 'abort', None):
+        return abort()
+    archive.close()
+
+
+def compression_available(compression: str) -> bool:
+    """ Checks if the library or command needed to compress and decompress the format is available. """
+    from shutil import which
+    if compression == 'zstd':
+        try:
+            import zstandard  # noqa: F401
+            return True
+        except ImportError:
+            return bool(which('zstd'))
+    if compression == 'lz4':
+        return bool(which('lz4'))
+    return compression in COMPRESSION_LEVELS
+
+
+def _read_command(args: list[str], source: Path) -> int:
+    """ Runs a decompression command with the source as stdin, returns the number of bytes it output. """
+    from subprocess import Popen, PIPE
+    size = 0
+    with open(source, 'rb') as in_file, Popen(args, stdin=in_file, stdout=PIPE) as process:
+        while chunk := process.stdout.read(2 ** 20):
+            size += len(chunk)
+    if process.returncode != 0:
+        raise RuntimeError("%s exited with code: %d" % (args[0], process.returncode))
+    return size
+
+
+def read_compressed(source: Path, compression: str) -> int:
+    """
+    Decompresses the source file with a single thread, discarding the output.
+    Returns the decompressed size.
+    """
+    if compression == 'zstd':
+        try:
+            from zstandard import ZstdDecompressor
+            reader_context = ZstdDecompressor().stream_reader(open(source, 'rb'), closefd=True)
+        except ImportError:
+            return _read_command(['zstd', '--decompress', '--quiet', '--stdout'], source)
+    elif compression == 'lz4':
+        return _read_command(['lz4', '--decompress', '--quiet', '--stdout'], source)
+    elif compression == 'xz':
+        reader_context = lzma_open(source, 'rb')
+    elif compression == 'gzip':
+        reader_context = GzipFile(source, 'rb')
+    else:
+        raise ValueError("Unsupported compression: %s" % compression)
+
+    size = 0
+    with reader_context as reader:
+        while chunk := reader.read(2 ** 20):
+            size += len(chunk)
+    return size
@@ -1,18 +1,90 @@
 __author__ = 'desultory'
-__version__ = '3.4.1'
+__version__ = '4.8.1'
 
 
-from zenlib.util import contains
+from contextlib import contextmanager
+from hashlib import sha256
+from json import dump, dumps
+from os import fsync, open as os_open, close as os_close, O_RDONLY
+from pathlib import Path
+from shutil import copyfileobj
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+from zenlib.util import contains, unset
+
+from ugrd.base.core import _validate_dependency
+from ugrd.fs.compression import COMPRESSION_LEVELS, abort_compressed, compression_available, open_compressed, read_compressed
+from ugrd.fs.newc import NewcWriter, NEWC_CHUNK_SIZE
+from ugrd.kmod.kconfig import _check_kernel_config, _get_kernel_config_file
+
+
+COMPRESSION_EXTENSIONS = {'zstd': 'zst', 'gzip': 'gz'}
+# The kernel config option needed to unpack an initramfs compressed with each format
+COMPRESSION_KCONFIG = {'xz': 'RD_XZ', 'zstd': 'RD_ZSTD', 'lz4': 'RD_LZ4', 'gzip': 'RD_GZIP'}
+# Levels tried by tune_compression, zstd --ultra levels are skipped as they are very slow and memory hungry
+# xz level 0 is skipped, as a cpio_compression_level of 0 uses the default level, so the selected level could not be used
+TUNE_COMPRESSION_LEVELS = {'xz': range(1, 10), 'zstd': range(1, 20), 'lz4': range(1, 13), 'gzip': range(1, 10)}
+TUNE_DECOMPRESS_RUNS = 3  # The fastest decompression run is used, to reduce noise
+# The microcode firmware directory for each CPU vendor, microcode is packed at kernel/x86/microcode/<vendor>.bin
+MICROCODE_DIRS = {'GenuineIntel': 'intel-ucode', 'AuthenticAMD': 'amd-ucode'}
+MICROCODE_PATTERNS = {'GenuineIntel': '[0-9a-f][0-9a-f]-[0-9a-f][0-9a-f]-[0-9a-f][0-9a-f]', 'AuthenticAMD': 'microcode_amd*.bin'}
+SEGMENT_FORMAT_VERSION = 2  # Included in segment keys, changing the packed format must invalidate cached segments
+
+
+def _get_compression(self) -> str:
+    """ Returns the cpio_compression format, or None if compression is disabled. """
+    compression = self['cpio_compression']
+    if not compression or compression.lower() == 'false':  # The variable is a string, so we need to check for the string 'false'
+        return None
+    return compression.lower()
+
+
+def check_cpio_compression(self) -> None:
+    """
+    Checks that the cpio_compression format and level are supported,
+    and that the target kernel can decompress the format, using the kernel config.
+    Raises a ValueError if the kernel config shows the format is not supported.
+    """
+    if not (compression := _get_compression(self)):
+        return self.logger.debug("CPIO compression is disabled.")
+
+    if compression not in COMPRESSION_LEVELS:
+        raise ValueError("Unsupported cpio_compression '%s', valid options: %s" % (compression, ', '.join(COMPRESSION_LEVELS)))
+
+    if level := self['cpio_compression_level']:
+        min_level, max_level, _ = COMPRESSION_LEVELS[compression]
+        if not min_level <= level <= max_level:
+            raise ValueError("Invalid %s compression level %d, must be between %d and %d" % (compression, level, min_level, max_level))
+
+    if not (config_file := _get_kernel_config_file(self)):
+        return self.logger.warning("[%s] Kernel config file not found, unable to check kernel support for the cpio_compression." % compression)
+
+    if not _check_kernel_config(self, COMPRESSION_KCONFIG[compression]):
+        raise ValueError("[%s] The kernel cannot decompress the initramfs, CONFIG_%s is not set in: %s"
+                         % (compression, COMPRESSION_KCONFIG[compression], config_file))
+    self.logger.debug("[%s] Kernel supports the cpio_compression." % compression)
 
 
 @contains('check_cpio')
 def check_cpio_deps(self) -> None:
-    """ Checks that all dependenceis are in the generated CPIO file. """
+    """
+    Checks that all dependenceis are in the generated CPIO file, and early dependencies are in the early CPIO.
+    Raises a ValueError if early_dependencies are set, but early_cpio is disabled.
+    """
+    if self['early_dependencies'] and not self['early_cpio']:
+        raise ValueError("early_dependencies are set, but early_cpio is not enabled: %s" % ', '.join(map(str, self['early_dependencies'])))
+
     for dep in self['dependencies']:
         _check_in_cpio(self, dep)
+    for dep in self['early_dependencies']:
+        _check_in_cpio(self, dep, entries=self['_early_cpio_entries'])
+    for vendor in self['_early_microcode']:
+        _check_in_cpio(self, 'kernel/x86/microcode/%s.bin' % vendor, entries=self['_early_cpio_entries'])
     return "All dependencies found in CPIO."
 
 
+@unset('_build_fingerprint_matched', "Build was skipped, skipping CPIO function check.", log_level=20)
 @contains('check_cpio')
 def check_cpio_funcs(self) -> None:
     """ Checks that all included functions are in the profile included in the generated CPIO file. """
@@ -20,6 +92,7 @@ def check_cpio_funcs(self) -> None:
     _check_in_cpio(self, 'etc/profile', bash_func_names)
 
 
+@unset('_build_fingerprint_matched', "Build was skipped, skipping CPIO file contents check.", log_level=20)
 @contains('check_in_cpio')
 @contains('check_cpio')
 def check_in_cpio(self) -> None:
@@ -29,18 +102,21 @@ def check_in_cpio(self) -> None:
     return "All files and lines found in CPIO."
 
 
-def _check_in_cpio(self, file, lines=[]):
-    """ Checks that the file is in the CPIO archive, and it contains the specified lines. """
-    cpio = self._cpio_archive
+def _check_in_cpio(self, file, lines=[], entries=None):
+    """
+    Checks that the file is in the CPIO archive, and it contains the specified lines.
+    Checks the entries of the main archive, unless other entries are passed.
+    """
+    entries = self['_cpio_entries'] if entries is None else entries
     file = str(file).lstrip('/')  # Normalize as it may be a path
-    if file not in cpio.entries:
-        self.logger.warning("CPIO entries:\n%s" % '\n'.join(cpio.entries.keys()))
+    if file not in entries:
+        self.logger.warning("CPIO entries:\n%s" % '\n'.join(entries.keys()))
         raise FileNotFoundError("File not found in CPIO: %s" % file)
     else:
         self.logger.debug("File found in CPIO: %s" % file)
 
     if lines:
-        entry_data = cpio.entries[file].data.decode().splitlines()
+        entry_data = _get_entry_data(entries[file]).decode().splitlines()
         for line in lines:
             if line not in entry_data:
                 raise FileNotFoundError("Line not found in CPIO: %s" % line)
@@ -49,6 +125,387 @@ def _check_in_cpio(self, file, lines=[]):
     return "File and lines found in CPIO."
 
 
+def _get_entry_data(entry) -> bytes:
+    """ Returns the data for a packed entry, file data is read from the source file. """
+    if entry['type'] == 'data':
+        return entry['data'].encode()
+    if entry['type'] == 'file':
+        return Path(entry['source']).read_bytes()
+    if entry['type'] == 'symlink':
+        return entry['target'].encode()
+    if entry['type'] == 'concat':
+        return b''.join(Path(source).read_bytes() for source in entry['sources'])
+    return b''
+
+
+def _process_early_dependencies_multi(self, dependency) -> None:
+    """ Validates a dependency for the early CPIO, symlinks are resolved. """
+    dependency = _validate_dependency(self, dependency).resolve()
+    self.logger.debug("Added early dependency: %s" % dependency)
+    self['early_dependencies'].append(dependency)
+
+
+def _get_cpu_info(self) -> dict:
+    """ Returns the fields for the first CPU in /proc/cpuinfo. """
+    cpu_info = {}
+    with open('/proc/cpuinfo', 'r') as f:
+        for line in f:
+            if not line.strip():
+                break
+            key, _, value = line.partition(':')
+            cpu_info[key.strip()] = value.strip()
+    return cpu_info
+
+
+@contains('early_microcode', "early_microcode is disabled, skipping.")
+@contains('early_cpio', "early_cpio is disabled, skipping microcode.")
+def get_early_microcode(self) -> None:
+    """
+    Finds CPU microcode under /lib/firmware for the early CPIO.
+    In hostonly mode, only microcode for the host CPU vendor is used,
+    for Intel CPUs, only the file matching the family, model, and stepping.
+    Otherwise, all Intel and AMD microcode is used.
+    Compressed microcode is not used, as the kernel loads microcode before it can decompress anything.
+    """
+    vendors = list(MICROCODE_DIRS)
+    if self['hostonly']:
+        cpu_info = _get_cpu_info(self)
+        if cpu_info.get('vendor_id') not in MICROCODE_DIRS:
+            return self.logger.warning("No microcode is available for CPU vendor: %s" % cpu_info.get('vendor_id'))
+        vendors = [cpu_info['vendor_id']]
+
+    for vendor in vendors:
+        microcode_dir = Path('/lib/firmware') / MICROCODE_DIRS[vendor]
+        if self['hostonly'] and vendor == 'GenuineIntel':
+            pattern = '%02x-%02x-%02x' % (int(cpu_info['cpu family']), int(cpu_info['model']), int(cpu_info['stepping']))
+        else:
+            pattern = MICROCODE_PATTERNS[vendor]
+
+        if microcode := sorted(str(path) for path in microcode_dir.glob(pattern) if path.is_file()):
+            self.logger.info("[%s] Adding microcode to the early CPIO: %s" % (vendor, ', '.join(microcode)))
+            self['_early_microcode'][vendor] = microcode
+        else:
+            self.logger.warning("[%s] No uncompressed microcode found matching: %s" % (vendor, microcode_dir / pattern))
+
+
+def _get_early_entries(self) -> dict:
+    """ Returns the entries for the early CPIO, microcode files, and early_dependencies at their original paths. """
+    entries = {}
+    for vendor, sources in self['_early_microcode'].items():
+        entries['kernel/x86/microcode/%s.bin' % vendor] = {'type': 'concat', 'sources': sources}
+    for dependency in self['early_dependencies']:
+        entries[str(dependency).lstrip('/')] = {'type': 'file', 'source': str(dependency)}
+
+    for name in list(entries):
+        for parent in Path(name).parents[:-1]:
+            entries.setdefault(str(parent), {'type': 'dir', 'mode': 0o755})
+    return entries
+
+
+def _write_early_cpio(self, out_file) -> None:
+    """
+    Writes the uncompressed early CPIO to the start of the output file, if early_cpio is enabled.
+    The kernel reads microcode from it before the rest of the image is decompressed.
+    The packed entries are stored in _early_cpio_entries, so they can be checked.
+    """
+    if not self['early_cpio']:
+        return
+
+    entries = _get_early_entries(self)
+    if not entries:
+        return self.logger.warning("early_cpio is enabled, but there are no early entries.")
+
+    writer = NewcWriter(out_file)
+    _write_entries(writer, entries, deduplicate=self['cpio_deduplicate'])
+    self['_early_cpio_entries'] = entries
+    self.logger.info("Packed %d entries (%.2f MiB) to the early CPIO." % (writer.entries, writer.size / 2 ** 20))
+
+
+def _files_match(self, file_a: Path, file_b: Path) -> bool:
+    """ Checks if two files have the same contents, comparing the size, then a streamed sha256 of each file. """
+    if file_a.stat().st_size != file_b.stat().st_size:
+        return False
+    return _hash_file(file_a) == _hash_file(file_b)
+
+
+def _fsync_dir(path: Path) -> None:
+    """ Syncs a directory, so renames within it are persisted. """
+    dir_fd = os_open(path, O_RDONLY)
+    try:
+        fsync(dir_fd)
+    finally:
+        os_close(dir_fd)
+
+
+def _replace_output(self, temp_file: Path, out_file: Path) -> None:
+    """
+    Replaces the output file with the written temporary file, unless the contents are identical.
+    If the output file exists, it is replaced, and kept as .old first if cpio_rotate is set.
+    The old file is linked or copied, not renamed, so the output path always has a complete image.
+    """
+    if out_file.exists():
+        if _files_match(self, temp_file, out_file):
+            return self.logger.info("Output file is unchanged, not replacing: %s" % out_file)
+        if self['cpio_rotate']:
+            self._rotate_old(out_file, keep=True)
+        else:
+            self.logger.warning("Replacing existing file: %s" % out_file)
+
+    temp_file.replace(out_file)
+    _fsync_dir(out_file.parent)
+    self.logger.debug("Replaced output file: %s" % out_file)
+
+
+@contextmanager
+def _open_output(self, out_file: Path):
+    """
+    Opens a temporary file in the same directory as the output file for writing.
+    Once written, it is synced, then renamed over the output file, so the output file is never partially written.
+    The temporary file is removed if writing fails, or the output file is unchanged.
+    """
+    temp_file = out_file.with_name('.%s.tmp' % out_file.name)
+    try:
+        with open(temp_file, 'wb') as f:
+            yield f
+            f.flush()
+            fsync(f.fileno())
+        _replace_output(self, temp_file, out_file)
+    finally:
+        temp_file.unlink(missing_ok=True)
+
+
+@contextmanager
+def _open_archive(self, out_cpio: Path, compress=True, output=False):
+    """
+    Opens the output file for writing, with the cpio_compression applied, unless compress is False.
+    Compression uses up to cpio_compression_threads threads, at the cpio_compression_level.
+    If output is set, the file is the final image: it is replaced atomically, and the early CPIO is written first, uncompressed.
+    If packing fails, the compressor is aborted, so compression commands and threads don't keep running.
+    """
+    compression = _get_compression(self) if compress else None
+    with (_open_output(self, out_cpio) if output else open(out_cpio, 'wb')) as out_file:
+        if output:
+            _write_early_cpio(self, out_file)
+        if not compression:
+            yield out_file
+            return
+
+        level = self['cpio_compression_level'] or None
+        self.logger.debug("[%s] Compressing archive with %s threads, level: %s" % (compression, self['cpio_compression_threads'] or 'all', level or 'default'))
+        archive = open_compressed(out_file, compression, self['cpio_compression_threads'], level)
+        try:
+            yield archive
+        except BaseException:
+            abort_compressed(archive)
+            raise
+        archive.close()
+
+
+def _get_archive_entries(self) -> dict:
+    """
+    Returns every staged entry, and device nodes if mknod_cpio is set.
+    Missing parent directories are added, so they are created before their contents.
+    """
+    entries = self._get_staged_entries()
+    if self.get('mknod_cpio'):
+        for node in self['nodes'].values():
+            self.logger.debug("Adding CPIO node: %s" % node)
+            entries[str(node['path']).lstrip('/')] = {'type': 'chardev', 'mode': node['mode'], 'major': node['major'], 'minor': node['minor']}
+
+    for name in list(entries):  # Parent directories must be created before their contents
+        for parent in Path(name).parents[:-1]:
+            entries.setdefault(str(parent), {'type': 'dir', 'mode': 0o755})
+    return entries
+
+
+def _get_duplicate_files(entries: dict) -> dict:
+    """
+    Returns a dict of the first name -> the names of all file entries with the same contents and mode, in sorted order.
+    Files are grouped by size and mode first, so only files which may be duplicates are hashed.
+    """
+    candidates = {}
+    for name in sorted(entries):
+        if entries[name]['type'] != 'file':
+            continue
+        source_stat = Path(entries[name]['source']).stat()
+        if source_stat.st_size:  # Nothing is saved by linking empty files
+            candidates.setdefault((source_stat.st_size, source_stat.st_mode & 0o7777), []).append(name)
+
+    duplicates = {}
+    for names in candidates.values():
+        if len(names) < 2:
+            continue
+        hashes = {}
+        for name in names:
+            hashes.setdefault(_hash_file(entries[name]['source']), []).append(name)
+        duplicates.update({group[0]: group for group in hashes.values() if len(group) > 1})
+    return duplicates
+
+
+def _write_entries(writer: NewcWriter, entries: dict, mtime=None, deduplicate=False) -> None:
+    """
+    Writes entries to the archive in sorted order. If mtime is set, it is used for all files.
+    If deduplicate is set, files with the same contents and mode are written once, and later copies are hardlinks.
+    """
+    duplicates = _get_duplicate_files(entries) if deduplicate else {}
+    links = {name: group[0] for group in duplicates.values() for name in group[1:]}
+    inodes = {}
+
+    for name in sorted(entries):
+        entry = entries[name]
+        if entry['type'] == 'dir':
+            writer.add_dir(name, entry['mode'])
+        elif entry['type'] == 'file':
+            if name in links:
+                writer.add_link(name, inodes[links[name]])
+            else:
+                inodes[name] = writer.add_file(name, entry['source'], mtime=mtime, nlink=len(duplicates.get(name, [name])))
+        elif entry['type'] == 'data':
+            writer.add_data(name, entry['data'].encode(), entry['mode'])
+        elif entry['type'] == 'symlink':
+            writer.add_symlink(name, entry['target'])
+        elif entry['type'] == 'chardev':
+            writer.add_chardev(name, entry['mode'], entry['major'], entry['minor'])
+        elif entry['type'] == 'concat':
+            writer.add_files(name, entry['sources'])
+    writer.close()
+
+
+def _log_packed(self, writer: NewcWriter, out_file) -> None:
+    """ Logs the number of entries and size of a packed archive, and the size saved by hardlinking duplicate files. """
+    self.logger.info("Packed %d entries (%.2f MiB) to: %s" % (writer.entries, writer.size / 2 ** 20, out_file))
+    if writer.links:
+        self.logger.info("Deduplicated %d files as hardlinks, saving %.2f MiB." % (writer.links, writer.deduplicated_size / 2 ** 20))
+
+
+def _pack_staged_entries(self, out_cpio: Path, compress=True, output=True) -> None:
+    """
+    Writes every staged entry, and device nodes if mknod_cpio is set, to the output archive.
+    Entries are streamed through the compressor to the output file as they are written,
+    and file contents are read in chunks, so memory use does not grow with the size of the archive.
+    With the manifest staging_mode, files are read from their original source, not a copy in the build directory.
+    If output is set, the file is the final image, see _open_archive.
+    The packed entries are stored in _cpio_entries, so they can be checked.
+    """
+    entries = _get_archive_entries(self)
+    with _open_archive(self, out_cpio, compress, output) as archive:
+        writer = NewcWriter(archive)
+        _write_entries(writer, entries, deduplicate=self['cpio_deduplicate'])
+
+    self['_cpio_entries'] = entries
+    _log_packed(self, writer, out_cpio)
+
+
+def _hash_file(path: Path) -> str:
+    digest = sha256()
+    with open(path, 'rb') as f:
+        while chunk := f.read(NEWC_CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _get_segment_key(self, entries: dict) -> str:
+    """
+    Returns the content address of a segment, a sha256 of every entry, the file contents, and the compression settings.
+    File modification times are not included, as segments are packed with an mtime of 0.
+    """
+    digest = sha256(dumps([SEGMENT_FORMAT_VERSION, _get_compression(self), self['cpio_compression_level'], self['cpio_deduplicate']]).encode())
+    for name in sorted(entries):
+        entry = entries[name]
+        if entry['type'] == 'file':
+            entry = {'type': 'file', 'mode': Path(entry['source']).stat().st_mode & 0o7777, 'sha256': _hash_file(entry['source'])}
+        digest.update(dumps([name, entry], sort_keys=True).encode())
+    return digest.hexdigest()
+
+
+def _pack_segment(self, segment: str, entries: dict) -> Path:
+    """
+    Packs the entries into a segment in the segment cache, if a segment with the same content address is not cached.
+    Every segment is a complete archive, with its own trailer, so segments can be concatenated.
+    Returns the path of the segment file.
+    """
+    extension = COMPRESSION_EXTENSIONS.get(_get_compression(self), _get_compression(self))
+    segment_file = self['cache_dir'] / 'segments' / ('%s-%s.cpio%s' % (segment, _get_segment_key(self, entries), '.' + extension if extension else ''))
+    if segment_file.exists():
+        self.logger.info("[%s] Reusing cached segment: %s" % (segment, segment_file))
+        segment_file.touch()  # Used to evict the least recently used segments
+        return segment_file
+
+    segment_file.parent.mkdir(parents=True, exist_ok=True)
+    temp_file = segment_file.with_name(segment_file.name + '.tmp')
+    with _open_archive(self, temp_file) as archive:
+        writer = NewcWriter(archive)
+        _write_entries(writer, entries, mtime=0, deduplicate=self['cpio_deduplicate'])
+    temp_file.replace(segment_file)
+    _log_packed(self, writer, segment_file)
+    return segment_file
+
+
+def _prune_segment_cache(self) -> None:
+    """ Removes the least recently used segments, if there are more than cpio_segment_cache_size. """
+    segments = sorted((self['cache_dir'] / 'segments').glob('*.cpio*'), key=lambda segment: segment.stat().st_mtime, reverse=True)
+    for segment in segments[self['cpio_segment_cache_size']:]:
+        self.logger.debug("Removing cached segment: %s" % segment)
+        segment.unlink()
+
+
+def _prune_split_segments(self, common_out: Path) -> None:
+    """
+    Removes common segments written to the output directory by earlier builds with cpio_split_segments.
+    The old_count most recently written are kept, as rotated images may use them, if cpio_rotate is set.
+    """
+    keep = self['old_count'] if self['cpio_rotate'] else 0
+    segments = sorted((segment for segment in common_out.parent.glob('ugrd-common-*.cpio*') if segment != common_out),
+                      key=lambda segment: segment.stat().st_mtime, reverse=True)
+    for segment in segments[keep:]:
+        self.logger.warning("Removing old common segment: %s" % segment)
+        segment.unlink()
+
+
+def _is_host_entry(self, name: str) -> bool:
+    """ Checks if an entry belongs in the host segment, based on cpio_host_paths. """
+    return any(name == path or name.startswith(path + '/') for path in self['cpio_host_paths'])
+
+
+def _pack_segments(self, out_cpio: Path) -> None:
+    """
+    Packs the archive as a common segment, then a host segment, which are concatenated into the output file.
+    The host segment contains entries under cpio_host_paths, and the parent directories they need.
+    Segments are content addressed and cached in the cache_dir, so they are only packed and compressed when their contents change.
+    If cpio_split_segments is set, the common segment is written to a separate file in the output directory instead.
+    """
+    entries = _get_archive_entries(self)
+    host_entries = {name: entry for name, entry in entries.items() if _is_host_entry(self, name)}
+    common_entries = {name: entry for name, entry in entries.items() if name not in host_entries}
+    for name in list(host_entries):
+        for parent in Path(name).parents[:-1]:
+            host_entries.setdefault(str(parent), entries[str(parent)])
+
+    common_segment = _pack_segment(self, 'common', common_entries)
+    host_segment = _pack_segment(self, 'host', host_entries)
+
+    segments = [common_segment, host_segment]
+    if self['cpio_split_segments']:
+        common_out = out_cpio.parent / ('ugrd-%s' % common_segment.name)
+        if not common_out.exists():
+            with open(common_segment, 'rb') as segment, _open_output(self, common_out) as out_file:
+                copyfileobj(segment, out_file, NEWC_CHUNK_SIZE)
+        self.logger.info("Common segment written to: %s" % common_out)
+        self['_build_outputs'] = common_out
+        _prune_split_segments(self, common_out)
+        segments = [host_segment]
+
+    with _open_output(self, out_cpio) as out_file:
+        _write_early_cpio(self, out_file)
+        for segment_file in segments:
+            with open(segment_file, 'rb') as segment:
+                copyfileobj(segment, out_file, NEWC_CHUNK_SIZE)
+
+    self['_cpio_entries'] = entries
+    self.logger.info("Wrote %d segments to: %s" % (len(segments), out_cpio))
+    _prune_segment_cache(self)
+
+
 def get_archive_path(self) -> str:
     """ Determines the filename for the output CPIO archive based on the current configuration. """
     if out_file := self.get('out_file'):
@@ -59,39 +516,146 @@ def get_archive_path(self) -> str:
         else:
             out_file = "ugrd.cpio"
 
-        if compression_type := self['cpio_compression']:
-            if compression_type.lower() != 'false':  # The variable is a string, so we need to check for the string 'false'
-                out_file += f".{compression_type}"
+        if compression := _get_compression(self):
+            out_file += f".{COMPRESSION_EXTENSIONS.get(compression, compression)}"
 
     self['_archive_out_path'] = self.out_dir / out_file
 
 
-def make_cpio(self) -> None:
+def _trial_compression(self, archive: Path, compression: str, level: int, trial_file: Path) -> dict:
     """
-    Populates the CPIO archive using the build directory,
-    writes it to the output file, and rotates the output file if necessary.
-    Creates device nodes in the CPIO archive if the mknod_cpio option is set.
-    Raises FileNotFoundError if the output directory does not exist.
+    Compresses the uncompressed archive into the trial_file, then decompresses it with a single thread.
+    Returns the compressed size and the time taken for each step, decompression time is the fastest of TUNE_DECOMPRESS_RUNS.
     """
-    cpio = self._cpio_archive
-    cpio.append_recursive(self._get_build_path('/'), relative=True)
+    start = perf_counter()
+    with open(archive, 'rb') as in_file, open(trial_file, 'wb') as out_file:
+        compressed = open_compressed(out_file, compression, self['cpio_compression_threads'], level)
+        copyfileobj(in_file, compressed, NEWC_CHUNK_SIZE)
+        compressed.close()
+    compress_ms = (perf_counter() - start) * 1000
 
-    if self.get('mknod_cpio'):
-        for node in self['nodes'].values():
-            self.logger.debug("Adding CPIO node: %s" % node)
-            cpio.add_chardev(name=node['path'], mode=node['mode'], major=node['major'], minor=node['minor'])
+    decompress_ms = None
+    for _ in range(TUNE_DECOMPRESS_RUNS):
+        start = perf_counter()
+        decompressed_size = read_compressed(trial_file, compression)
+        run_ms = (perf_counter() - start) * 1000
+        decompress_ms = run_ms if decompress_ms is None else min(decompress_ms, run_ms)
 
-    out_cpio = self['_archive_out_path']
+    if decompressed_size != archive.stat().st_size:
+        raise ValueError("[%s:%d] Decompressed size does not match the archive: %d != %d"
+                         % (compression, level, decompressed_size, archive.stat().st_size))
+
+    size = trial_file.stat().st_size
+    return {'compression': compression, 'level': level, 'size': size,
+            'ratio': round(decompressed_size / size, 3),
+            'compress_ms': round(compress_ms, 1), 'decompress_ms': round(decompress_ms, 1),
+            'decompress_mib_s': round(decompressed_size / 2 ** 20 / (decompress_ms / 1000), 1)}
+
+
+def _select_compression(results: list[dict], max_image_size=0, max_decompress_ms=0) -> dict:
+    """
+    Selects the best trial result within the max_image_size and max_decompress_ms budgets, 0 means no limit.
+    If only max_image_size is set, the fastest result to decompress is selected, otherwise the smallest.
+    Returns None if no results fit the budgets.
+    """
+    candidates = [result for result in results
+                  if (not max_image_size or result['size'] <= max_image_size)
+                  and (not max_decompress_ms or result['decompress_ms'] <= max_decompress_ms)]
+    if not candidates:
+        return None
+    if max_image_size and not max_decompress_ms:
+        return min(candidates, key=lambda result: (result['decompress_ms'], result['size']))
+    return min(candidates, key=lambda result: (result['size'], result['decompress_ms']))
+
+
+def _get_tune_formats(self) -> list[str]:
+    """ Returns the compression formats to try, skipping formats which are unavailable or not supported by the kernel. """
+    formats = []
+    for compression in TUNE_COMPRESSION_LEVELS:
+        if not compression_available(compression):
+            self.logger.warning("[%s] Compression tools not found, skipping." % compression)
+        elif _get_kernel_config_file(self) and not _check_kernel_config(self, COMPRESSION_KCONFIG[compression]):
+            self.logger.info("[%s] Not supported by the kernel, skipping." % compression)
+        else:
+            formats.append(compression)
+    return formats
+
+
+def _prepare_archive_path(self, out_cpio: Path) -> None:
+    """
+    Creates the output directory.
+    Raises a FileExistsError if the output file exists, and it cannot be rotated or replaced.
+    """
     if not out_cpio.parent.exists():
         self._mkdir(out_cpio.parent, resolve_build=False)
 
-    if out_cpio.exists():
-        if self['cpio_rotate']:
-            self._rotate_old(out_cpio)
-        elif self['clean']:
-            self.logger.warning("Removing existing file: %s" % out_cpio)
-            out_cpio.unlink()
+    if out_cpio.exists() and not self['cpio_rotate'] and not self['clean']:
+        raise FileExistsError("File already exists, and cleaning/rotation are disabled: %s" % out_cpio)
+
+
+def tune_compression(self) -> None:
+    """
+    Packs the archive uncompressed, then tries every supported compression format and level.
+    The compressed size and single threaded decompression time of each is measured,
+    and the best option within the max_image_size and max_decompress_ms budgets is used for the output file.
+    If no option fits the budgets, the configured cpio_compression is used.
+    The results are written to a JSON report next to the output file.
+    """
+    out_dir = self['_archive_out_path'].parent
+    if not out_dir.exists():
+        self._mkdir(out_dir, resolve_build=False)
+
+    with TemporaryDirectory(dir=out_dir, prefix='.ugrd-tune-') as tune_dir:
+        archive = Path(tune_dir) / 'archive.cpio'
+        _pack_staged_entries(self, archive, compress=False, output=False)
+
+        results = []
+        for compression in _get_tune_formats(self):
+            for level in TUNE_COMPRESSION_LEVELS[compression]:
+                result = _trial_compression(self, archive, compression, level, Path(tune_dir) / 'trial')
+                self.logger.info("[%s:%d] Size: %.2f MiB, compression time: %.1fms, decompression time: %.1fms"
+                                 % (compression, level, result['size'] / 2 ** 20, result['compress_ms'], result['decompress_ms']))
+                results.append(result)
+
+        if selected := _select_compression(results, self['max_image_size'], self['max_decompress_ms']):
+            self.logger.info("[%s:%d] Selected compression, size: %.2f MiB, decompression time: %.1fms"
+                             % (selected['compression'], selected['level'], selected['size'] / 2 ** 20, selected['decompress_ms']))
+            self['cpio_compression'] = selected['compression']
+            self['cpio_compression_level'] = selected['level']
+            get_archive_path(self)  # The extension depends on the compression
         else:
-            raise FileExistsError("File already exists, and cleaning/rotation are disabled: %s" % out_cpio)
+            self.logger.warning("No compression options fit the budgets, using: %s" % self['cpio_compression'])
+
+        out_cpio = self['_archive_out_path']
+        _prepare_archive_path(self, out_cpio)
+        with open(archive, 'rb') as in_file, _open_archive(self, out_cpio, output=True) as out_file:
+            copyfileobj(in_file, out_file, NEWC_CHUNK_SIZE)
+        uncompressed_size = archive.stat().st_size
+
+    report_file = out_cpio.with_name(out_cpio.name + '.json')
+    with open(report_file, 'w') as report:
+        dump({'archive': str(out_cpio), 'uncompressed_size': uncompressed_size,
+              'max_image_size': self['max_image_size'], 'max_decompress_ms': self['max_decompress_ms'],
+              'selected': selected, 'results': results}, report, indent=2)
+    self.logger.info("Wrote compression report to: %s" % report_file)
 
-    cpio.write_cpio_file(out_cpio, compression=self['cpio_compression'], _log_bump=-10, _log_init=False)
+
+def make_cpio(self) -> None:
+    """
+    Packs the CPIO archive from the build directory and staging manifest, and writes it to the output file.
+    The archive is written to a temporary file, which replaces the output file if the contents changed,
+    rotating the old output file if cpio_rotate is set.
+    Creates device nodes in the CPIO archive if the mknod_cpio option is set.
+    If tune_compression is set, the compression is selected by tune_compression.
+    If cpio_segments is set, the archive is packed as cached common and host segments.
+    Raises FileNotFoundError if the output directory does not exist.
+    """
+    if self['tune_compression']:
+        return tune_compression(self)
+
+    out_cpio = self['_archive_out_path']
+    _prepare_archive_path(self, out_cpio)
+    if self['cpio_segments']:
+        _pack_segments(self, out_cpio)
+    else:
+        _pack_staged_entries(self, out_cpio)
@@ -485,7 +485,7 @@ def autodetect_mounts(self) -> None:
 def mount_base(self) -> list[str]:
     """
     Generates mount commands for the base mounts.
-    Must be run before variables are used, as it creates the /run/vars directory.
+    Creates the /run/vars directory, used by savevars.
     """
     out = []
     for mount in self['mounts'].values():
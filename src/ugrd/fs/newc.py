@@ -0,0 +1,131 @@
+"""
+Minimal streaming writer for newc (SVR4 without CRC) cpio archives, as read by the kernel's initramfs unpacker.
+
+Entries are written to the output file as they are added, file contents are copied in chunks from their source,
+so memory use does not depend on the size of the archive.
+"""
+
+__author__ = 'desultory'
+__version__ = '0.3.1'
+
+from os import fstat, stat
+from pathlib import Path
+from stat import S_IFCHR, S_IFDIR, S_IFLNK, S_IFREG
+from typing import BinaryIO, Union
+
+
+NEWC_MAGIC = b'070701'
+NEWC_TRAILER = 'TRAILER!!!'
+NEWC_CHUNK_SIZE = 2 ** 20
+
+
+def _pad(size: int) -> bytes:
+    """ Returns the padding needed to align size to 4 bytes. """
+    return b'\0' * (-size % 4)
+
+
+class NewcWriter:
+    """
+    Writes newc cpio entries to a binary file object.
+    Inode numbers are assigned sequentially, so the output is reproducible for the same entries.
+    uid and gid are always 0, as everything in the initramfs is owned by root.
+    Hardlinks are written with the data on the first entry, and no data on the links, which the kernel supports.
+    close() must be called to write the trailer, it does not close the output file.
+    """
+    def __init__(self, out_file: BinaryIO):
+        self.out_file = out_file
+        self.next_ino = 1
+        self.entries = 0
+        self.links = 0  # Entries written as hardlinks to an earlier entry
+        self.data_size = 0  # Bytes of file data written
+        self.deduplicated_size = 0  # Bytes of file data not written, as the entry was a hardlink
+        self.size = 0  # Total bytes written
+        self._linked_files = {}  # ino -> (mode, mtime, size, nlink) of files written with nlink > 1
+
+    def _write(self, data: bytes) -> None:
+        self.out_file.write(data)
+        self.size += len(data)
+
+    def _write_header(self, name: str, mode: int, filesize=0, mtime=0, nlink=1, rdevmajor=0, rdevminor=0, ino=None) -> int:
+        """ Writes the header and name for an entry, returns the inode number used. """
+        if ino is None:
+            ino, self.next_ino = self.next_ino, self.next_ino + 1
+        name = name.encode() + b'\0'
+        fields = [ino, mode, 0, 0, nlink, int(mtime), filesize, 0, 0, rdevmajor, rdevminor, len(name), 0]
+        header = NEWC_MAGIC + b''.join(b'%08X' % field for field in fields) + name
+        self._write(header + _pad(len(header)))
+        self.entries += 1
+        return ino
+
+    def add_dir(self, name: str, mode=0o755, mtime=0) -> None:
+        self._write_header(name, S_IFDIR | mode, mtime=mtime, nlink=2)
+
+    def add_symlink(self, name: str, target: Union[Path, str], mtime=0) -> None:
+        target = str(target).encode()
+        self._write_header(name, S_IFLNK | 0o777, filesize=len(target), mtime=mtime)
+        self._write(target + _pad(len(target)))
+
+    def add_chardev(self, name: str, mode: int, major: int, minor: int, mtime=0) -> None:
+        self._write_header(name, S_IFCHR | mode, mtime=mtime, rdevmajor=major, rdevminor=minor)
+
+    def add_data(self, name: str, data: bytes, mode=0o644, mtime=0) -> None:
+        """ Adds a regular file with the passed contents. """
+        self._write_header(name, S_IFREG | mode, filesize=len(data), mtime=mtime)
+        self._write(data + _pad(len(data)))
+        self.data_size += len(data)
+
+    def add_file(self, name: str, source: Union[Path, str], mode=None, mtime=None, nlink=1) -> int:
+        """
+        Adds a regular file, copying the contents from the source file in chunks.
+        The mode and mtime are read from the source file if not passed.
+        If nlink is more than 1, other entries can be added as hardlinks to the returned inode number with add_link.
+        Raises a ValueError if the file size changes while it is being read.
+        """
+        with open(source, 'rb') as source_file:
+            source_stat = fstat(source_file.fileno())
+            mode = source_stat.st_mode & 0o7777 if mode is None else mode
+            mtime = source_stat.st_mtime if mtime is None else mtime
+            ino = self._write_header(name, S_IFREG | mode, filesize=source_stat.st_size, mtime=mtime, nlink=nlink)
+            copied = 0
+            while chunk := source_file.read(NEWC_CHUNK_SIZE):
+                self._write(chunk)
+                copied += len(chunk)
+
+        if copied != source_stat.st_size:
+            raise ValueError("File size changed while archiving '%s': %d != %d" % (source, copied, source_stat.st_size))
+        self._write(_pad(copied))
+        self.data_size += copied
+        if nlink > 1:
+            self._linked_files[ino] = (mode, mtime, copied, nlink)
+        return ino
+
+    def add_link(self, name: str, ino: int) -> None:
+        """ Adds a hardlink to a file added with add_file, using the same inode, mode, and link count, without data. """
+        mode, mtime, size, nlink = self._linked_files[ino]
+        self._write_header(name, S_IFREG | mode, mtime=mtime, nlink=nlink, ino=ino)
+        self.links += 1
+        self.deduplicated_size += size
+
+    def add_files(self, name: str, sources: list[Union[Path, str]], mode=0o644, mtime=0) -> None:
+        """
+        Adds a regular file containing the contents of each source file, in order.
+        Raises a ValueError if the size of the source files changes while they are being read.
+        """
+        filesize = sum(stat(source).st_size for source in sources)
+        self._write_header(name, S_IFREG | mode, filesize=filesize, mtime=mtime)
+        copied = 0
+        for source in sources:
+            with open(source, 'rb') as source_file:
+                while chunk := source_file.read(NEWC_CHUNK_SIZE):
+                    self._write(chunk)
+                    copied += len(chunk)
+
+        if copied != filesize:
+            raise ValueError("File sizes changed while archiving '%s': %d != %d" % (name, copied, filesize))
+        self._write(_pad(copied))
+        self.data_size += copied
+
+    def close(self) -> None:
+        """ Writes the trailer entry. """
+        self._write_header(NEWC_TRAILER, 0, nlink=1, ino=0)
+        self.entries -= 1  # The trailer is not counted as an entry
@@ -1,4 +1,4 @@
-__version__ = "0.5.4"
+__version__ = "0.5.5"
 
 from zenlib.util import contains
 
@@ -11,6 +11,8 @@ def init_banner(self):
 
 def make_test_image(self):
     """ Creates a test image from the build dir """
+    if self._manifest_staging():  # mkfs needs the whole tree in the build dir
+        self._materialize('/')
     build_dir = self._get_build_path('/').resolve()
     self.logger.info("Creating test image from: %s" % build_dir)
 
@@ -4,7 +4,7 @@ from subprocess import run, CompletedProcess, TimeoutExpired
 
 from zenlib.util import pretty_print
 
-__version__ = "1.3.4"
+__version__ = "1.6.2"
 __author__ = "desultory"
 
 
@@ -19,12 +19,173 @@ def get_subpath(path: Path, subpath: Union[Path, str]) -> Path:
         return path / subpath
 
 
+COPY_MODES = ['auto', 'reflink', 'hardlink', 'copy']
+STAGING_MODES = ['directory', 'manifest']
+FICLONE = 0x40049409  # _IOW(0x94, 9, int), from linux/fs.h
+COPY_CHUNK_SIZE = 2 ** 20
+
+
+def _copy_file_data(source_fd: int, dest_fd: int, size: int) -> None:
+    """
+    Copies file data within the kernel using copy_file_range, falling back to sendfile if it is not supported.
+    If the size is 0, the data is read until EOF, as pseudo-files such as those in /proc and /sys report a size of 0.
+    """
+    from os import copy_file_range, sendfile, read, write
+
+    if not size:
+        while chunk := read(source_fd, COPY_CHUNK_SIZE):
+            while chunk:
+                chunk = chunk[write(dest_fd, chunk):]
+        return
+
+    copied = 0
+    try:
+        while copied < size and (count := copy_file_range(source_fd, dest_fd, size - copied)):
+            copied += count
+    except OSError:  # Not supported by the kernel or filesystem, or across filesystems on older kernels
+        while copied < size and (count := sendfile(dest_fd, source_fd, copied, size - copied)):
+            copied += count
+
+
+def copy_file(source: Path, dest: Path, mode='auto') -> str:
+    """
+    Copies a file and its permissions and timestamps, like shutil.copy2.
+    Any existing file at the destination is removed first, so a hardlinked file is never written through.
+
+    'hardlink' tries to hardlink the file, sharing its inode and metadata with the source.
+    'auto' and 'reflink' try to clone the file data with a FICLONE ioctl.
+    All modes fall back to copying the data with copy_file_range or sendfile, or reading it if the size is 0.
+    Returns the mode which was used, 'hardlink', 'reflink', or 'copy'.
+    """
+    from fcntl import ioctl
+    from os import fstat, link
+    from shutil import copystat
+
+    if dest.is_symlink() or dest.exists():
+        dest.unlink()
+
+    if mode == 'hardlink':
+        try:
+            link(source, dest)
+            return 'hardlink'
+        except OSError:  # Usually EXDEV, if the build dir is on another filesystem
+            pass
+
+    used_mode = 'copy'
+    with open(source, 'rb') as source_file, open(dest, 'wb') as dest_file:
+        if mode in ['auto', 'reflink']:
+            try:
+                ioctl(dest_file.fileno(), FICLONE, source_file.fileno())
+                used_mode = 'reflink'
+            except OSError:  # Unsupported by the filesystem, or across filesystems
+                pass
+        if used_mode == 'copy':
+            _copy_file_data(source_file.fileno(), dest_file.fileno(), fstat(source_file.fileno()).st_size)
+
+    copystat(source, dest)
+    return used_mode
+
+
 class GeneratorHelpers:
-    """ Mixin class for the InitramfsGenerator class. """
+    """
+    Mixin class for the InitramfsGenerator class.
+
+    When the staging_mode is 'manifest', _mkdir, _write, _copy, _copy_many, and _symlink record entries in
+    self['_manifest'] instead of writing to the build directory, and the archive is packed from the original files.
+    Anything written to the build directory by other means is still included, with manifest entries taking precedence.
+    """
     def _get_build_path(self, path: Union[Path, str]) -> Path:
         """ Returns the path relative to the build directory, under the tmpdir. """
         return get_subpath(get_subpath(self.tmpdir, self.build_dir), path)
 
+    def _get_manifest_key(self, path: Union[Path, str]) -> str:
+        """ Returns the archive path for a path in the initramfs, relative to the root, like 'usr/bin/bash'. """
+        return str(get_subpath(Path('/'), path)).lstrip('/')
+
+    def _manifest_staging(self) -> bool:
+        return self['staging_mode'] == 'manifest'
+
+    def _stage(self, path: Union[Path, str], entry: dict) -> None:
+        """ Adds an entry to the staging manifest, creating directory entries for its parents. """
+        key = self._get_manifest_key(path)
+        if not key:  # The root is always included
+            return
+        for parent in reversed(Path(key).parents[:-1]):
+            if str(parent) not in self['_manifest']:
+                self['_manifest'][str(parent)] = {'type': 'dir', 'mode': 0o755}
+        self.logger.log(5, "[%s] Staging entry: %s" % (key, entry))
+        self['_manifest'][key] = entry
+
+    def _is_dir(self, path: Union[Path, str]) -> bool:
+        """ Returns True if the path is a directory in the staging manifest or the build directory. """
+        if entry := self['_manifest'].get(self._get_manifest_key(path)):
+            return entry['type'] == 'dir'
+        return self._get_build_path(path).is_dir()
+
+    def _read_staged(self, path: Union[Path, str]) -> str:
+        """ Reads the contents of a staged file, from the staging manifest or the build directory. """
+        entry = self['_manifest'].get(self._get_manifest_key(path))
+        if not entry:
+            return self._get_build_path(path).read_text()
+        if entry['type'] == 'data':
+            return entry['data']
+        if entry['type'] == 'file':
+            return Path(entry['source']).read_text()
+        raise ValueError("Staged entry is not a file: %s" % path)
+
+    def _get_staged_entries(self) -> dict:
+        """
+        Returns a dict of archive path -> entry for everything in the build directory and staging manifest.
+        Entries have a 'type' of 'dir', 'file' (with a 'source' path), 'data', 'symlink' (with a 'target'), or 'chardev'.
+        """
+        from os import walk, readlink, major, minor
+        from stat import S_ISCHR, S_ISDIR, S_ISLNK, S_ISREG
+
+        entries = {}
+        build_dir = self._get_build_path('/')
+        for root, dirs, files in walk(build_dir):
+            for name in [*dirs, *files]:
+                path = Path(root) / name
+                key, path_stat = str(path.relative_to(build_dir)), path.lstat()
+                if S_ISLNK(path_stat.st_mode):
+                    entries[key] = {'type': 'symlink', 'target': readlink(path)}
+                elif S_ISDIR(path_stat.st_mode):
+                    entries[key] = {'type': 'dir', 'mode': path_stat.st_mode & 0o7777}
+                elif S_ISREG(path_stat.st_mode):
+                    entries[key] = {'type': 'file', 'source': str(path)}
+                elif S_ISCHR(path_stat.st_mode):
+                    entries[key] = {'type': 'chardev', 'mode': path_stat.st_mode & 0o7777,
+                                    'major': major(path_stat.st_rdev), 'minor': minor(path_stat.st_rdev)}
+                else:
+                    self.logger.warning("Skipping unsupported file type in the build directory: %s" % path)
+
+        entries.update(self['_manifest'])
+        return entries
+
+    def _materialize(self, path: Union[Path, str]) -> None:
+        """ Writes manifest entries under a path to the build directory, so they can be used by external tools. """
+        from os import symlink
+        prefix = self._get_manifest_key(path)
+        for key, entry in sorted(self['_manifest'].items()):
+            if prefix and key != prefix and not key.startswith(prefix + '/'):
+                continue
+            build_path = self._get_build_path(key)
+            build_path.parent.mkdir(parents=True, exist_ok=True)
+            if entry['type'] == 'dir':
+                build_path.mkdir(mode=entry['mode'], exist_ok=True)
+            elif entry['type'] == 'file':
+                copy_file(Path(entry['source']), build_path, self['copy_mode'])
+            elif entry['type'] == 'data':
+                build_path.unlink(missing_ok=True)
+                build_path.write_text(entry['data'])
+                build_path.chmod(entry['mode'])
+            elif entry['type'] == 'symlink':
+                build_path.unlink(missing_ok=True)
+                symlink(entry['target'], build_path)
+            else:
+                self.logger.warning("[%s] Unable to materialize entry: %s" % (key, entry))
+        self.logger.debug("Materialized manifest entries under: %s" % (prefix or '/'))
+
     def _mkdir(self, path: Path, resolve_build=True) -> None:
         """
         Creates a directory within the build directory.
@@ -34,6 +195,8 @@ class GeneratorHelpers:
         from os.path import isdir
         from os import mkdir
         if resolve_build:
+            if self._manifest_staging():
+                return self._stage(path, {'type': 'dir', 'mode': 0o755})
             path = self._get_build_path(path)
 
         self.logger.log(5, "Creating directory: %s" % path)
@@ -60,6 +223,9 @@ class GeneratorHelpers:
         If the first line is a shebang, bash -n is run on the file.
         """
         from os import chmod
+        if self._manifest_staging():
+            return self._write_manifest(file_name, contents, chmod_mask)
+
         file_path = self._get_build_path(file_name)
 
         if not file_path.parent.is_dir():
@@ -71,6 +237,9 @@ class GeneratorHelpers:
             if self.clean:
                 self.logger.warning("Deleting file: %s" % file_path)
                 file_path.unlink()
+            elif file_path.stat().st_nlink > 1:
+                self.logger.warning("Unlinking hardlinked file, so the source is not modified: %s" % file_path)
+                file_path.unlink()
 
         self.logger.debug("[%s] Writing contents:\n%s" % (file_path, contents))
         with open(file_path, 'w') as file:
@@ -87,10 +256,25 @@ class GeneratorHelpers:
         chmod(file_path, chmod_mask)
         self.logger.debug("[%s] Set file permissions: %s" % (file_path, chmod_mask))
 
-    def _copy(self, source: Union[Path, str], dest=None) -> None:
-        """ Copies a file into the initramfs build directory. """
-        from shutil import copy2
+    def _write_manifest(self, file_name: Union[Path, str], contents: list[str], chmod_mask=0o644) -> None:
+        """ Adds a file with the passed contents to the staging manifest, validating bash scripts like _write. """
+        key = self._get_manifest_key(file_name)
+        if key in self['_manifest']:
+            self.logger.warning("File already exists: %s" % key)
 
+        data = "\n".join(contents)
+        if contents[0].startswith("#!/bin/bash"):
+            self.logger.debug("Running bash -n on file: %s" % file_name)
+            try:
+                self._run(['bash', '-n'], input=data.encode())
+            except RuntimeError as e:
+                raise RuntimeError("Failed to validate bash script: %s" % pretty_print(contents)) from e
+
+        self._stage(key, {'type': 'data', 'data': data, 'mode': chmod_mask})
+        self.logger.info("Staged file: %s" % key)
+
+    def _copy(self, source: Union[Path, str], dest=None) -> None:
+        """ Copies a file into the initramfs build directory, using the copy_mode. """
         if not isinstance(source, Path):
             source = Path(source)
 
@@ -98,6 +282,9 @@ class GeneratorHelpers:
             self.logger.log(5, "No destination specified, using source: %s" % source)
             dest = source
 
+        if self._manifest_staging():
+            return self._copy_manifest([(source, dest)])
+
         dest_path = self._get_build_path(dest)
 
         if not dest_path.parent.is_dir():
@@ -111,7 +298,83 @@ class GeneratorHelpers:
             dest_path = dest_path / source.name
 
         self.logger.log(self['_build_log_level'], "Copying '%s' to '%s'" % (source, dest_path))
-        copy2(source, dest_path)
+        copy_file(source, dest_path, self['copy_mode'])
+
+    def _copy_many(self, copies: list[tuple], workers=None) -> None:
+        """
+        Copies many files into the initramfs build directory.
+        Takes a list of (source, dest) tuples, where dest may be None to use the source path, like _copy.
+
+        All parent directories are created first, then files are copied concurrently using up to 'workers' threads.
+        Every copy is attempted, failures are logged in the order the copies were passed, then the first is raised.
+        The number of files, bytes, and time spent copying with each copy mode is logged.
+        """
+        from concurrent.futures import ThreadPoolExecutor
+        from os import makedirs
+        from time import perf_counter
+
+        if self._manifest_staging():
+            return self._copy_manifest(copies)
+
+        planned = [(Path(source), self._get_build_path(dest or source)) for source, dest in copies]
+        for parent in sorted({dest_path.parent for _, dest_path in planned}):
+            makedirs(parent, exist_ok=True)
+
+        resolved = {}  # dest_path -> source, in the order the copies were passed
+        for source, dest_path in planned:
+            if dest_path.is_dir():
+                self.logger.debug("Destination is a directory, adding source filename: %s" % source.name)
+                dest_path = dest_path / source.name
+            if dest_path in resolved or dest_path.is_file():
+                self.logger.warning("File already exists: %s" % dest_path)
+            resolved[dest_path] = source
+
+        def copy(dest_path):
+            """ Returns the copy mode used, size, and time taken, or the exception if the copy failed. """
+            source = resolved[dest_path]
+            self.logger.log(self['_build_log_level'], "Copying '%s' to '%s'" % (source, dest_path))
+            try:
+                start_time = perf_counter()
+                used_mode = copy_file(source, dest_path, self['copy_mode'])
+                return used_mode, dest_path.stat().st_size, perf_counter() - start_time
+            except OSError as e:
+                return e
+
+        self.logger.debug("[%s] Copying %d files with %s workers." % (self['copy_mode'], len(resolved), workers or 'default'))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(copy, resolved))
+
+        stats = {}  # mode -> [files, bytes, seconds]
+        for result in results:
+            if not isinstance(result, OSError):
+                mode_stats = stats.setdefault(result[0], [0, 0, 0.0])
+                mode_stats[0] += 1
+                mode_stats[1] += result[1]
+                mode_stats[2] += result[2]
+        for mode, (files, size, seconds) in stats.items():
+            self.logger.info("[%s] Staged %d files (%.2f MiB), copy time: %.3fs" % (mode, files, size / 2 ** 20, seconds))
+
+        errors = [result for result in results if isinstance(result, OSError)]
+        for error in errors:
+            self.logger.error("Failed to copy file: %s" % error)
+        if errors:
+            raise errors[0]
+
+    def _copy_manifest(self, copies: list[tuple]) -> None:
+        """ Adds (source, dest) copies to the staging manifest, handling destination directories like _copy. """
+        for source, dest in copies:
+            source = Path(source)
+            key = self._get_manifest_key(dest or source)
+            if self._is_dir(key):
+                self.logger.debug("Destination is a directory, adding source filename: %s" % source.name)
+                key = self._get_manifest_key(Path(key) / source.name)
+            if key in self['_manifest']:
+                self.logger.warning("File already exists: %s" % key)
+            if not source.is_file():
+                raise FileNotFoundError("Source file does not exist: %s" % source)
+            self._stage(key, {'type': 'file', 'source': str(source)})
+            self.logger.log(self['_build_log_level'], "Staged '%s' as '%s'" % (source, key))
+        self.logger.info("[manifest] Staged %d files" % len(copies))
 
     def _symlink(self, source: Union[Path, str], target: Union[Path, str]) -> None:
         """ Creates a symlink """
@@ -120,6 +383,17 @@ class GeneratorHelpers:
         if not isinstance(source, Path):
             source = Path(source)
 
+        if self._manifest_staging():
+            key = self._get_manifest_key(target)
+            if entry := self['_manifest'].get(key):
+                if entry['type'] == 'symlink' and entry['target'] == str(source):
+                    return self.logger.debug("Symlink already exists: %s -> %s" % (key, source))
+                elif not self.clean:
+                    raise RuntimeError("Symlink already exists: %s -> %s" % (key, entry))
+                self.logger.warning("Replacing staged entry: %s" % key)
+            self.logger.debug("Staging symlink: %s -> %s" % (key, source))
+            return self._stage(key, {'type': 'symlink', 'target': str(source)})
+
         target = self._get_build_path(target)
 
         if not target.parent.is_dir():
@@ -138,12 +412,12 @@ class GeneratorHelpers:
         self.logger.debug("Creating symlink: %s -> %s" % (target, source))
         symlink(source, target)
 
-    def _run(self, args: list[str], timeout=15) -> CompletedProcess:
-        """ Runs a command, returns the CompletedProcess object """
+    def _run(self, args: list[str], timeout=15, input=None) -> CompletedProcess:
+        """ Runs a command, returns the CompletedProcess object. input is passed to stdin, if set. """
         cmd_args = [str(arg) for arg in args]
         self.logger.debug("Running command: %s" % ' '.join(cmd_args))
         try:
-            cmd = run(cmd_args, capture_output=True, timeout=timeout)
+            cmd = run(cmd_args, capture_output=True, timeout=timeout, input=input)
         except TimeoutExpired as e:
             raise RuntimeError("[%ds] Command timed out: %s" % (timeout, [str(arg) for arg in cmd_args])) from e
 
@@ -155,8 +429,12 @@ class GeneratorHelpers:
 
         return cmd
 
-    def _rotate_old(self, file_name: Path, sequence=0) -> None:
-        """ Copies a file to file_name.old then file_nane.old.n, where n is the next number in the sequence """
+    def _rotate_old(self, file_name: Path, sequence=0, keep=False) -> None:
+        """
+        Copies a file to file_name.old then file_nane.old.n, where n is the next number in the sequence
+        If keep is set, the file is hardlinked (or copied) to file_name.old instead of being renamed,
+        so it stays in place until it is atomically replaced.
+        """
         # Nothing to do if the file doesn't exist
         if not file_name.is_file():
             self.logger.debug("File does not exist: %s" % file_name)
@@ -164,7 +442,10 @@ class GeneratorHelpers:
 
         # If the cycle count is not set, attempt to clean
         if not self.old_count:
-            if self.clean:
+            if keep and self.clean:
+                self.logger.debug("Not keeping an old copy, as old_count is not set: %s" % file_name)
+                return
+            elif self.clean:
                 self.logger.warning("Deleting file: %s" % file_name)
                 file_name.unlink()
                 return
@@ -196,4 +477,13 @@ class GeneratorHelpers:
 
         # Finally, rename the file
         self.logger.info("[%d] Cycling file: %s -> %s" % (sequence, file_name, target_file))
-        file_name.rename(target_file)
+        if keep and sequence == 0:
+            from os import link
+            try:
+                link(file_name, target_file)
+            except OSError as e:
+                self.logger.debug("Unable to hardlink '%s', copying: %s" % (file_name, e))
+                from shutil import copy2
+                copy2(file_name, target_file)
+        else:
+            file_name.rename(target_file)
@@ -1,5 +1,5 @@
 __author__ = "desultory"
-__version__ = "2.1.0"
+__version__ = "2.1.1"
 
 from tomllib import load, TOMLDecodeError
 from pathlib import Path
@@ -130,7 +130,6 @@ class InitramfsConfigDict(UserDict):
         Updates the custom_parameters attribute.
         Sets the initial value of the parameter based on the type.
         """
-        from pycpio import PyCPIO
         from .initramfs_generator import InitramfsGenerator  # import here for eval'ing
 
         self['custom_parameters'][parameter_name] = eval(parameter_type)
@@ -151,8 +150,6 @@ class InitramfsConfigDict(UserDict):
                 self.data[parameter_name] = ""
             case "Path":
                 self.data[parameter_name] = Path()
-            case "PyCPIO":
-                self.data[parameter_name] = PyCPIO(logger=self.logger, _log_init=False, _log_bump=10)
             case _:  # For strings and things, don't init them so they are None
                 self.logger.warning("Leaving '%s' as None" % parameter_name)
                 self.data[parameter_name] = None
@@ -3,6 +3,7 @@ from tomllib import load, TOMLDecodeError
 from zenlib.logging import loggify
 from zenlib.util import pretty_print
 
+from ugrd.fingerprint import check_build_fingerprint, save_build_fingerprint
 from ugrd.initramfs_dict import InitramfsConfigDict
 from .generator_helpers import GeneratorHelpers
 
@@ -16,7 +17,8 @@ class InitramfsGenerator(GeneratorHelpers):
         self.included_functions = {}
 
         # Used for functions that are run as part of the build process, build_final is run after init generation
-        self.build_tasks = ['build_pre', 'build_tasks']
+        # build_pre is always run, the build fingerprint is checked after it, to determine if the rest of the build is needed
+        self.build_tasks = ['build_tasks']
 
         # init_pre and init_final are run as part of generate_initramfs_main
         self.init_types = ['init_debug', 'init_early', 'init_main', 'init_late', 'init_premount', 'init_mount', 'init_mount_late', 'init_cleanup']
@@ -71,15 +73,24 @@ class InitramfsGenerator(GeneratorHelpers):
         return super().__getattr__(item)
 
     def build(self) -> None:
-        """ Builds the initramfs. """
+        """
+        Builds the initramfs.
+        If the build fingerprint matches the last build, and the output is unchanged, only checks and tests are run.
+        The fingerprint is saved after the checks pass, so a build which fails checks is not skipped the next time.
+        """
         self.logger.info("Building initramfs")
-        for hook in self.build_tasks:
-            self.logger.debug("Running build hook: %s" % hook)
-            self.run_hook(hook)
-        self.generate_init()
-        self.run_hook('build_final')
-        self.pack_build()
+        self.run_hook('build_pre')
+        if check_build_fingerprint(self):
+            self.logger.info("Build inputs are unchanged, using the existing image: %s" % self['_archive_out_path'])
+        else:
+            for hook in self.build_tasks:
+                self.logger.debug("Running build hook: %s" % hook)
+                self.run_hook(hook)
+            self.generate_init()
+            self.run_hook('build_final')
+            self.pack_build()
         self.run_checks()
+        save_build_fingerprint(self)
         self.run_tests()
 
     def run_func(self, function, force_include=False) -> list[str]:
@@ -125,6 +136,9 @@ class InitramfsGenerator(GeneratorHelpers):
         """ Runs the specified init hook, returning the output. """
         if runlevel := self.run_hook(level):
             out = ['\n# Begin %s' % level]
+            if self.get('bootprof') and level != 'init_final':  # init_final ends with switch_root
+                from ugrd.base.bootprof import profile_runlevel
+                runlevel = profile_runlevel(self, level, runlevel)
             out += runlevel
             return out
         else:
@@ -142,8 +156,20 @@ class InitramfsGenerator(GeneratorHelpers):
         library_paths = ":".join(self['library_paths'])
         self.logger.debug("Library paths: %s" % library_paths)
         out.append(f"export LD_LIBRARY_PATH={library_paths}")
-
-        for func_name, func_content in self.included_functions.items():
+        for array in self['shell_arrays']:
+            out.append(f"declare -A {array}")
+
+        functions = self.included_functions
+        if self.get('bootprof'):
+            from ugrd.base.bootprof import profile_function
+            functions = {}
+            for func_name, func_content in self.included_functions.items():
+                if func_name.startswith('bootprof_'):
+                    functions[func_name] = func_content
+                else:
+                    functions.update(profile_function(self, func_name, func_content))
+
+        for func_name, func_content in functions.items():
             out.append("\n\n" + func_name + "() {")
             if isinstance(func_content, str):
                 out.append(f"    {func_content}")
@@ -154,6 +180,9 @@ class InitramfsGenerator(GeneratorHelpers):
                 raise TypeError("Function content is not a string or list: %s" % func_content)
             out.append("}")
 
+        if 'savevars' in functions:  # Keep variables set in recovery and debug shells
+            out += ["\n\nif [[ $- == *i* ]]; then", "    trap savevars EXIT", "fi"]
+
         return out
 
     def generate_init_main(self) -> list[str]:
@@ -189,6 +218,8 @@ class InitramfsGenerator(GeneratorHelpers):
         else:
             init.extend(self.generate_init_main())
 
+        if self.get('bootprof'):
+            init.append('bootprof_save')
         init.extend(self.run_init_hook('init_final'))
         init += ["\n\n# END INIT"]
 
@@ -0,0 +1,78 @@
+"""
+Kernel module dependency graph.
+
+Modules are resolved once, and walked iteratively so shared dependencies are not visited again for every parent.
+Modules are returned in load order, with dependencies before the modules which use them.
+"""
+
+__author__ = 'desultory'
+__version__ = '0.1.0'
+
+from typing import Callable
+
+
+class KmodGraph:
+    """
+    Lazily built kernel module dependency graph.
+
+    get_dependencies is called once per module, and should return the module's dependencies, or raise an exception.
+    If a module, or anything it depends on, fails to resolve, the exception is stored for it and every module on the
+    path to it, and is raised again when they are walked.
+
+    Dependency cycles (possible with softdeps) are recorded in self.cycles, the edge which closes the cycle is skipped.
+    """
+    def __init__(self, get_dependencies: Callable[[str], list[str]]):
+        self.get_dependencies = get_dependencies
+        self.dependencies = {}  # module -> list[str]
+        self.errors = {}  # module -> Exception
+        self.order = []  # Every resolved module, dependencies first
+        self.cycles = []  # list[list[str]], each starting and ending with the same module
+        self._resolved = set()
+
+    def __contains__(self, module: str) -> bool:
+        """ Returns True if the module has been walked, whether or not it resolved. """
+        return module in self._resolved or module in self.errors
+
+    def _get_dependencies(self, module: str) -> list[str]:
+        if module not in self.dependencies:
+            self.dependencies[module] = list(self.get_dependencies(module))
+        return self.dependencies[module]
+
+    def walk(self, module: str) -> list[str]:
+        """
+        Resolves a module and everything it depends on.
+        Returns the modules which were resolved by this walk, in load order.
+        Dependencies which resolved are returned even if the module itself failed, check self.errors for the module.
+        """
+        new_modules = []
+        if module in self._resolved or module in self.errors:
+            return new_modules
+
+        path, pending = [], []  # The current module path, and the remaining dependencies of each module on it
+        dependency = module
+        while True:
+            if dependency is not None:
+                try:
+                    pending.append(iter(self._get_dependencies(dependency)))
+                    path.append(dependency)
+                except Exception as e:
+                    self.errors[dependency] = e
+                if dependency in self.errors:  # Mark every module on the path as failed
+                    for failed in path:
+                        self.errors[failed] = self.errors[dependency]
+                    return new_modules
+
+            dependency = next(pending[-1], None)
+            if dependency is None:  # All dependencies are resolved
+                pending.pop()
+                resolved = path.pop()
+                self._resolved.add(resolved)
+                self.order.append(resolved)
+                new_modules.append(resolved)
+                if not path:
+                    return new_modules
+            elif dependency in self._resolved:
+                dependency = None
+            elif dependency in path:
+                self.cycles.append(path[path.index(dependency):] + [dependency])
+                dependency = None
@@ -0,0 +1,174 @@
+"""
+Kernel module metadata index.
+
+Built from the depmod output under /lib/modules/<kernel_version>, so module filenames,
+dependencies, softdeps, and built-in modules can be looked up without running modinfo.
+The .modinfo section of individual modules can be read with read_kmod_modinfo.
+"""
+
+__author__ = 'desultory'
+__version__ = '0.2.1'
+
+from functools import lru_cache
+from pathlib import Path
+from typing import Iterator, Union
+
+from ugrd.elf import read_elf_section
+
+
+KMOD_READ_CHUNK_SIZE = 2 ** 16
+
+
+def kmod_name_from_path(path: Union[Path, str]) -> str:
+    """ Returns the normalized module name for a module path, like kernel/fs/ext4/ext4.ko.xz -> ext4 """
+    return Path(path).name.split('.ko')[0].replace('-', '_')
+
+
+class KmodIndex:
+    """
+    Reads modules.dep, modules.softdep, modules.builtin, and modules.builtin.modinfo from a kernel module directory.
+    Missing files are treated as empty, lookups for unknown modules return None.
+    """
+    def __init__(self, kmod_dir: Union[Path, str]):
+        self.kmod_dir = Path(kmod_dir)
+        self.modules = {}  # name -> {'filename': str, 'depends': list[str]}
+        self.softdeps = {}  # name -> list[str]
+        self.builtin = set()
+        self.builtin_modinfo = {}  # name -> {key: list[str]}
+        self._read_modules_dep()
+        self._read_modules_softdep()
+        self._read_modules_builtin()
+        self._read_modules_builtin_modinfo()
+
+    def _read_lines(self, file_name: str) -> list[str]:
+        try:
+            return (self.kmod_dir / file_name).read_text().splitlines()
+        except FileNotFoundError:
+            return []
+
+    def _read_modules_dep(self) -> None:
+        """ Each line is 'path: dependency_path dependency_path ...', paths are relative to the kmod dir. """
+        for line in self._read_lines('modules.dep'):
+            if ':' not in line:
+                continue
+            path, _, depends = line.partition(':')
+            filename = path if path.startswith('/') else str(self.kmod_dir / path)
+            self.modules[kmod_name_from_path(path)] = {'filename': filename,
+                                                       'depends': [kmod_name_from_path(dep) for dep in depends.split()]}
+
+    def _read_modules_softdep(self) -> None:
+        """ Each line is 'softdep module pre: module module post: module'. """
+        for line in self._read_lines('modules.softdep'):
+            fields = line.split()
+            if len(fields) < 3 or fields[0] != 'softdep':
+                continue
+            softdeps = [field.replace('-', '_') for field in fields[2:] if not field.endswith(':')]
+            self.softdeps.setdefault(fields[1].replace('-', '_'), []).extend(softdeps)
+
+    def _read_modules_builtin(self) -> None:
+        for line in self._read_lines('modules.builtin'):
+            if line := line.strip():
+                self.builtin.add(kmod_name_from_path(line))
+
+    def _read_modules_builtin_modinfo(self) -> None:
+        """ The file contains NUL separated 'module.key=value' entries. """
+        try:
+            data = (self.kmod_dir / 'modules.builtin.modinfo').read_bytes()
+        except FileNotFoundError:
+            return
+
+        for entry in data.split(b'\0'):
+            name, _, value = entry.decode(errors='replace').partition('=')
+            module, _, key = name.partition('.')
+            if key:
+                self.builtin_modinfo.setdefault(module.replace('-', '_'), {}).setdefault(key, []).append(value)
+
+    def get_module_info(self, module: str) -> dict:
+        """
+        Returns a modinfo style dict with the filename, depends, and softdep for a module.
+        Built-in modules have the filename '(builtin)'.
+        Returns None if the module is not in the index, such as when an alias is used.
+        """
+        if module in self.modules:
+            module_info = {'filename': self.modules[module]['filename']}
+            if depends := self.modules[module]['depends']:
+                module_info['depends'] = depends
+            if softdeps := self.softdeps.get(module):
+                module_info['softdep'] = softdeps
+            return module_info
+
+        if module in self.builtin:
+            module_info = {'filename': '(builtin)'}
+            softdeps = []
+            for softdep in self.builtin_modinfo.get(module, {}).get('softdep', []):
+                softdeps += [field.replace('-', '_') for field in softdep.split() if not field.endswith(':')]
+            if softdeps:
+                module_info['softdep'] = softdeps
+            return module_info
+
+
+@lru_cache
+def get_kmod_index(kmod_dir: str) -> KmodIndex:
+    """ Returns the KmodIndex for a kernel module directory, building it once per directory. """
+    return KmodIndex(kmod_dir)
+
+
+def _read_kmod_chunks(path: str) -> Iterator[bytes]:
+    """
+    Yields the decompressed contents of a kernel module in chunks, based on the file extension.
+    zstd uses the zstandard library if available, otherwise the zstd command output is streamed.
+    """
+    if path.endswith('.zst'):
+        try:
+            from zstandard import ZstdDecompressor
+        except ImportError:
+            from subprocess import Popen, PIPE, DEVNULL
+            process = Popen(['zstd', '--decompress', '--stdout', '--quiet', path], stdout=PIPE, stderr=DEVNULL)
+            try:
+                while chunk := process.stdout.read(KMOD_READ_CHUNK_SIZE):
+                    yield chunk
+            finally:  # Stop decompressing once the caller is done
+                process.kill()
+                process.wait()
+            return
+        with open(path, 'rb') as kmod_file:
+            yield from ZstdDecompressor().read_to_iter(kmod_file, read_size=KMOD_READ_CHUNK_SIZE)
+        return
+
+    if path.endswith('.xz'):
+        from lzma import LZMADecompressor
+        decompressor = LZMADecompressor()
+    elif path.endswith('.gz'):
+        from zlib import decompressobj, MAX_WBITS
+        decompressor = decompressobj(16 + MAX_WBITS)  # Expect a gzip header
+    else:
+        decompressor = None
+
+    with open(path, 'rb') as kmod_file:
+        while chunk := kmod_file.read(KMOD_READ_CHUNK_SIZE):
+            yield decompressor.decompress(chunk) if decompressor else chunk
+
+
+def read_kmod_modinfo(path: Union[Path, str]) -> dict:
+    """
+    Reads the .modinfo section of a kernel module, which may be xz, gzip, or zstd compressed.
+    The module is decompressed in chunks, but section headers are at the end of the module,
+    so the whole decompressed module is held in memory while it is read.
+    Returns a modinfo style dict with the filename, and depends, softdep, and firmware if defined.
+    """
+    chunks = _read_kmod_chunks(str(path))
+    try:
+        modinfo = read_elf_section(chunks, '.modinfo')
+    finally:
+        chunks.close()
+
+    module_info = {'filename': str(path)}
+    for entry in (modinfo or b'').split(b'\0'):
+        key, _, value = entry.decode(errors='replace').partition('=')
+        if key == 'depends' and value:
+            module_info['depends'] = [dep.replace('-', '_') for dep in value.split(',')]
+        elif key == 'softdep':
+            module_info.setdefault('softdep', []).extend(field.replace('-', '_') for field in value.split() if not field.endswith(':'))
+        elif key == 'firmware':
+            module_info.setdefault('firmware', []).append(value)
+    return module_info
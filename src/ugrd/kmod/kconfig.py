@@ -1,7 +1,7 @@
 __author__ = 'desultory'
-__version__ = '0.1.0'
+__version__ = '0.2.1'
 
-from zenlib.util import contains
+from pathlib import Path
 
 
 def _normalize_kconfig_option(self, option: str) -> str:
@@ -12,15 +12,26 @@ def _normalize_kconfig_option(self, option: str) -> str:
     return option
 
 
-@contains('kernel_config_file', "Cannot check config, kernel config file not found.")
+def _get_kernel_config_file(self) -> Path:
+    """
+    Returns the kernel config file if it is a file, otherwise None.
+    kernel_config_file is initialized to Path(), which is truthy, so it must not be checked by value.
+    """
+    if (config_file := self.get('kernel_config_file')) and Path(config_file).is_file():
+        return Path(config_file)
+
+
 def _check_kernel_config(self, option: str):
     """
     Checks if an option is set in the kernel config file.
     Checks that the line starts with the option, and is set to 'y' or 'm'.
     If a match is found, return the line, otherwise return None
     """
+    if not (config_file := _get_kernel_config_file(self)):
+        return self.logger.debug("Cannot check config, kernel config file not found.")
+
     option = _normalize_kconfig_option(self, option)
-    with open(self['kernel_config_file'], 'r') as f:
+    with open(config_file, 'r') as f:
         for line in f.readlines():
             if line.startswith(option):
                 if line.split('=')[1].strip()[0] in ['y', 'm']:
@@ -32,15 +43,21 @@ def _check_kernel_config(self, option: str):
 
 
 def find_kernel_config(self) -> None:
-    """ Tries to find the kernel config file associated with the current kernel version. """
+    """
+    Tries to find the kernel config file associated with the current kernel version.
+    Checks the kernel build and source directories, then /boot/config-<kernel_version>.
+    """
+    if config_file := _get_kernel_config_file(self):
+        return self.logger.info("Using specified kernel config file: %s" % config_file)
+    elif self['kernel_config_file'] != Path():
+        self.logger.warning("Specified kernel config file not found, searching for it: %s" % self['kernel_config_file'])
+
     build_dir = self['_kmod_dir'] / 'build'
     source_dir = self['_kmod_dir'] / 'source'
-    for d in [build_dir, source_dir]:
-        if d.exists():
-            config_file = d / '.config'
-            if config_file.exists():
-                self.logger.info("Found kernel config file: %s" % config_file)
-                self['kernel_config_file'] = config_file
-                break
+    for config_file in [build_dir / '.config', source_dir / '.config', Path('/boot') / f"config-{self['kernel_version']}"]:
+        if config_file.is_file():
+            self.logger.info("Found kernel config file: %s" % config_file)
+            self['kernel_config_file'] = config_file
+            break
     else:
         self.logger.warning("Kernel config file not found.")
@@ -1,5 +1,5 @@
 __author__ = 'desultory'
-__version__ = '2.15.1'
+__version__ = '2.21.0'
 
 from pathlib import Path
 from subprocess import run
@@ -7,8 +7,15 @@ from typing import Union
 
 from zenlib.util import contains, unset
 
+from ugrd.elf import ELFError
+from ugrd.kmod.graph import KmodGraph
+from ugrd.kmod.index import get_kmod_index, read_kmod_modinfo
+
 
 MODULE_METADATA_FILES = ['modules.order', 'modules.builtin', 'modules.builtin.modinfo']
+# Files read to build the kernel module index, the kmod cache is invalidated if any of them change
+KMOD_INDEX_FILES = ['modules.dep', 'modules.softdep', 'modules.builtin', 'modules.builtin.modinfo']
+KMOD_CACHE_VERSION = 1
 
 
 def _normalize_kmod_name(module: Union[str, list]) -> str:
@@ -63,14 +70,11 @@ def _process__kmod_auto_multi(self, module: str) -> None:
     self['_kmod_auto'].append(module)
 
 
-def _get_kmod_info(self, module: str):
+def _get_kmod_info_modinfo(self, module: str) -> dict:
     """
-    Runs modinfo on a kernel module, parses the output and stored the results in self['_kmod_modinfo'].
+    Runs modinfo on a kernel module, parses the output and returns a dict of the module info.
     !!! Should be run after metadata is processed so the kver is set properly !!!
     """
-    module = _normalize_kmod_name(module)
-    if module in self['_kmod_modinfo']:
-        return self.logger.debug("[%s] Module info already exists." % module)
     args = ['modinfo', module, '--set-version', self['kernel_version']]
 
     try:
@@ -103,10 +107,153 @@ def _get_kmod_info(self, module: str):
     if not module_info.get('filename'):
         raise DependencyResolutionError("[%s] Failed to process modinfo output: %s" % (module, cmd.stdout.decode()))
 
+    return module_info
+
+
+def _get_kmod_info(self, module: str):
+    """
+    Gets the info for a kernel module, and stores the results in self['_kmod_modinfo'].
+    The filename, dependencies and softdeps are read from the kernel module index,
+    firmware is read from the .modinfo section of the module file.
+    modinfo is only used for modules which are not in the index (such as aliases).
+    Safe to run from multiple threads, as each module only writes its own entry.
+    !!! Should be run after metadata is processed so the kver is set properly !!!
+    """
+    module = _normalize_kmod_name(module)
+    if module in self['_kmod_modinfo']:
+        return self.logger.debug("[%s] Module info already exists." % module)
+
+    if module_info := get_kmod_index(str(self['_kmod_dir'])).get_module_info(module):
+        if module_info['filename'] != '(builtin)' and self['kmod_pull_firmware']:
+            try:
+                if firmware := read_kmod_modinfo(module_info['filename']).get('firmware'):
+                    module_info['firmware'] = firmware
+            except (OSError, ELFError) as e:
+                raise DependencyResolutionError("[%s] Failed to read module info from: %s" % (module, module_info['filename'])) from e
+    else:
+        self.logger.debug("[%s] Module not found in the kernel module index, using modinfo." % module)
+        module_info = _get_kmod_info_modinfo(self, module)
+
     self.logger.debug("[%s] Module info: %s" % (module, module_info))
     self['_kmod_modinfo'][module] = module_info
 
 
+def _prefetch_kmod_info(self, modules: list[str]) -> None:
+    """
+    Gets the info for the passed kernel modules and everything they depend on, using the kernel module index.
+    Module files are read concurrently using up to dependency_workers threads.
+    Errors are ignored here, so they are raised when the module is processed.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    closure_key = _get_kmod_closure_key(self, modules)
+    if closure := self['_kmod_closures'].get(closure_key):
+        if all(module in self['_kmod_modinfo'] for module in closure):
+            return self.logger.debug("Using cached info for %d kernel modules." % len(closure))
+
+    index = get_kmod_index(str(self['_kmod_dir']))
+    pending, closure = [_normalize_kmod_name(module) for module in modules], set()
+    while pending:
+        module = pending.pop()
+        if module in closure or module in self['kmod_ignore']:
+            continue
+        closure.add(module)
+        if module_info := index.get_module_info(module):
+            pending += module_info.get('depends', []) + module_info.get('softdep', [])
+    self['_kmod_closures'][closure_key] = sorted(closure)
+
+    def prefetch(module):
+        try:
+            _get_kmod_info(self, module)
+        except DependencyResolutionError as e:
+            self.logger.debug("[%s] Failed to prefetch module info: %s" % (module, e))
+
+    self.logger.debug("Prefetching info for %d kernel modules." % len(closure))
+    with ThreadPoolExecutor(max_workers=self['dependency_workers'] or None) as executor:
+        list(executor.map(prefetch, sorted(closure)))
+
+
+def _get_kmod_closure_key(self, modules: list[str]) -> str:
+    """ Returns the key used to cache the dependency closure of a set of kernel modules. """
+    return ' '.join(sorted(set(_normalize_kmod_name(list(modules))))) + ' / ' + ' '.join(sorted(self['kmod_ignore']))
+
+
+def _get_kmod_cache_key(self) -> dict:
+    """
+    Returns a dict with the path, inode, mtime, and size of each kernel module index file,
+    and the sha256 hash of modules.dep, so the cache is invalidated whenever depmod rewrites the metadata.
+    """
+    from hashlib import sha256
+
+    key = {}
+    for index_file in KMOD_INDEX_FILES:
+        index_path = self['_kmod_dir'] / index_file
+        try:
+            file_stat = index_path.stat()
+        except FileNotFoundError:
+            continue
+        key[index_file] = [file_stat.st_ino, file_stat.st_mtime_ns, file_stat.st_size]
+    key['modules.dep.sha256'] = sha256((self['_kmod_dir'] / 'modules.dep').read_bytes()).hexdigest()
+    return key
+
+
+def _get_kmod_cache_file(self) -> Path:
+    return self['cache_dir'] / ('kmod-%s.json' % self['kernel_version'])
+
+
+@contains('kmod_cache', "Kernel module cache is disabled, skipping loading.")
+def _load_kmod_cache(self) -> None:
+    """
+    Loads cached kernel module info and dependency closures for the current kernel version.
+    The cache is only used if the kernel module index files are unchanged,
+    and firmware info was read if kmod_pull_firmware is set.
+    """
+    from json import loads, JSONDecodeError
+
+    cache_file = _get_kmod_cache_file(self)
+    try:
+        cache = loads(cache_file.read_text())
+        cache_key = _get_kmod_cache_key(self)
+    except FileNotFoundError:
+        return self.logger.debug("Kernel module cache does not exist: %s" % cache_file)
+    except (OSError, JSONDecodeError) as e:
+        return self.logger.warning("Unable to read kernel module cache '%s': %s" % (cache_file, e))
+
+    if cache.get('version') != KMOD_CACHE_VERSION or cache.get('kernel_version') != self['kernel_version']:
+        return self.logger.info("Ignoring kernel module cache with a different version: %s" % cache_file)
+    if cache['key'] != cache_key:
+        return self.logger.info("Kernel module metadata has changed, ignoring kernel module cache: %s" % cache_file)
+    if self['kmod_pull_firmware'] and not cache['firmware']:
+        return self.logger.info("Kernel module cache does not contain firmware info, ignoring: %s" % cache_file)
+
+    self.logger.debug("Loaded info for %d kernel modules from: %s" % (len(cache['modinfo']), cache_file))
+    self['_kmod_modinfo'] = cache['modinfo']
+    self['_kmod_closures'] = cache['closures']
+    self['_kmod_cache_loaded'] = True
+
+
+@contains('kmod_cache', "Kernel module cache is disabled, skipping saving.")
+def _save_kmod_cache(self) -> None:
+    """ Writes the kernel module info and dependency closures for the current kernel version to the cache_dir. """
+    from json import dumps
+
+    cache_file = _get_kmod_cache_file(self)
+    try:
+        cache = {'version': KMOD_CACHE_VERSION,
+                 'kernel_version': self['kernel_version'],
+                 'key': _get_kmod_cache_key(self),
+                 'firmware': self['kmod_pull_firmware'],
+                 'modinfo': self['_kmod_modinfo'],
+                 'closures': self['_kmod_closures']}
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        temp_file = cache_file.with_suffix('.tmp')
+        temp_file.write_text(dumps(cache))
+        temp_file.replace(cache_file)
+    except OSError as e:
+        return self.logger.warning("Unable to write kernel module cache '%s': %s" % (cache_file, e))
+    self.logger.debug("Wrote info for %d kernel modules to: %s" % (len(self['_kmod_modinfo']), cache_file))
+
+
 @contains('kmod_autodetect_lspci', "kmod_autodetect_lspci is not enabled, skipping.")
 def _autodetect_modules_lspci(self) -> None:
     """ Gets the name of all kernel modules being used by hardware visible in lspci -k. """
@@ -192,6 +339,8 @@ def process_module_metadata(self) -> None:
 def regen_kmod_metadata(self) -> None:
     """ Regenerates kernel module metadata files using depmod. """
     self.logger.info("Regenerating kernel module metadata files.")
+    if self._manifest_staging():  # depmod needs the modules in the build dir
+        self._materialize(Path('/lib/modules') / self['kernel_version'])
     build_dir = self._get_build_path('/')
     self._run(['depmod', '--basedir', build_dir, self['kernel_version']])
 
@@ -217,23 +366,28 @@ def _add_firmware_dep(self, kmod: str, firmware: str) -> None:
     kmod = _normalize_kmod_name(kmod)
     firmware_path = Path('/lib/firmware') / firmware
     if not firmware_path.exists():
-        if firmware_path.with_suffix(firmware_path.suffix + '.xz').exists():
-            firmware_path = firmware_path.with_suffix(firmware_path.suffix + '.xz')
-            if self['kmod_decompress_firmware']:  # otherise, just add it like a normal dependency
-                self['xz_dependencies'] = firmware_path
-                return self.logger.debug("[%s] Found xz compressed firmware file: %s" % (kmod, firmware_path))
+        for compression in ['xz', 'zst']:
+            compressed_path = firmware_path.with_suffix(firmware_path.suffix + '.' + compression)
+            if compressed_path.exists():
+                firmware_path = compressed_path
+                break
         else:
             # Really, this should be a huge error, but with xhci_pci, it wants some renesas firmware that's not in linux-firmware and doesn't seem to matter
             return self.logger.error("[%s] Firmware file does not exist: %s" % (kmod, firmware_path))
+        if self['kmod_decompress_firmware']:  # otherise, just add it like a normal dependency
+            self['%s_dependencies' % compression] = firmware_path
+            return self.logger.debug("[%s] Found %s compressed firmware file: %s" % (kmod, compression, firmware_path))
     self.logger.debug("[%s] Adding firmware file to dependencies: %s" % (kmod, firmware_path))
     self['dependencies'] = firmware_path
 
 
-def _process_kmod_dependencies(self, kmod: str) -> None:
-    """ Processes a kernel module's dependencies. """
-    kmod = _normalize_kmod_name(kmod)
+def _get_kmod_dependencies(self, kmod: str) -> list[str]:
+    """
+    Gets the dependencies of a kernel module, used to build the kernel module graph.
+    Softdeps are included unless kmod_ignore_softdeps is set.
+    Ignored dependencies are skipped if they are built-in, otherwise a DependencyResolutionError is raised.
+    """
     _get_kmod_info(self, kmod)
-    # Add dependencies of the module
     dependencies = []
     if harddeps := self['_kmod_modinfo'][kmod].get('depends'):
         dependencies += harddeps
@@ -245,23 +399,23 @@ def _process_kmod_dependencies(self, kmod: str) -> None:
             dependencies += sofdeps
 
     for dependency in dependencies:
-        if dependency in self['kmod_ignore']:  # Don't add modules with ignored dependencies
-            if modinfo := self['_kmod_modinfo'].get(dependency):
-                if modinfo['filename'] != '(builtin)':  # But if it's ignored because it's built-in, that's fine
-                    raise DependencyResolutionError("[%s] Kernel module dependency is in ignore list: %s" % (kmod, dependency))
-        if dependency in self['kernel_modules']:
-            self.logger.debug("[%s] Dependency is already in kernel_modules: %s" % (kmod, dependency))
-            continue
-        self.logger.debug("[%s] Processing dependency: %s" % (kmod, dependency))
-        self['kernel_modules'] = dependency
-        try:
-            _process_kmod_dependencies(self, dependency)
-        except BuiltinModuleError as e:
-            self.logger.debug(e)
+        if dependency not in self['kmod_ignore']:
             continue
+        try:  # Don't add modules with ignored dependencies
+            _get_kmod_info(self, dependency)
+        except DependencyResolutionError:
+            pass
+        if self['_kmod_modinfo'].get(dependency, {}).get('filename') != '(builtin)':  # But if it's ignored because it's built-in, that's fine
+            raise DependencyResolutionError("[%s] Kernel module dependency is in ignore list: %s" % (kmod, dependency))
+        self.logger.debug("[%s] Ignored dependency is built-in: %s" % (kmod, dependency))
+
+    return [dependency for dependency in dependencies if dependency not in self['kmod_ignore']]
 
+
+def _add_kmod(self, kmod: str) -> None:
+    """ Adds a kernel module file and its firmware to the initramfs dependencies, built-in modules are skipped. """
     if self['_kmod_modinfo'][kmod]['filename'] == '(builtin)':
-        raise BuiltinModuleError("Not adding built-in module to dependencies: %s" % kmod)
+        return self.logger.debug("Not adding built-in module to dependencies: %s" % kmod)
 
     _add_kmod_firmware(self, kmod)
 
@@ -272,11 +426,33 @@ def _process_kmod_dependencies(self, kmod: str) -> None:
         self['xz_dependencies'] = filename
     elif filename.endswith('.ko.gz'):
         self['gz_dependencies'] = filename
+    elif filename.endswith('.ko.zst'):
+        self['zst_dependencies'] = filename
     else:
         self.logger.warning("[%s] Unknown kmod extension: %s" % (kmod, filename))
         self['dependencies'] = filename
 
 
+def _process_kmod_dependencies(self, kmod: str, graph: KmodGraph) -> None:
+    """
+    Resolves a kernel module and its dependencies using the kernel module graph.
+    Modules which were not already resolved are added to kernel_modules and the initramfs dependencies in load order.
+    Raises the resolution error if the module, or any of its dependencies, could not be resolved.
+    Raises a BuiltinModuleError if the module is built-in.
+    """
+    kmod = _normalize_kmod_name(kmod)
+    for module in graph.walk(kmod):
+        self.logger.debug("[%s] Adding resolved kernel module: %s" % (kmod, module))
+        self['kernel_modules'] = module
+        _add_kmod(self, module)
+
+    if error := graph.errors.get(kmod):
+        raise error
+
+    if self['_kmod_modinfo'][kmod]['filename'] == '(builtin)':
+        raise BuiltinModuleError("Not adding built-in module to dependencies: %s" % kmod)
+
+
 def process_ignored_module(self, module: str) -> None:
     """ Processes an ignored module. """
     self.logger.debug("Removing kernel module from all lists: %s", module)
@@ -301,12 +477,20 @@ def process_ignored_modules(self) -> None:
 
 @unset('no_kmod', "no_kmod is enabled, skipping.", log_level=30)
 def process_modules(self) -> None:
-    """ Processes all kernel modules, adding dependencies to the initramfs. """
+    """
+    Processes all kernel modules, adding dependencies to the initramfs.
+    Module info is loaded from and saved to the kernel module cache, if enabled.
+    """
+    _load_kmod_cache(self)
+    cached_modules = len(self['_kmod_modinfo']) if self['_kmod_cache_loaded'] else 0
+    _prefetch_kmod_info(self, [*self['kernel_modules'], *self['_kmod_auto']])
+
+    graph = KmodGraph(lambda kmod: _get_kmod_dependencies(self, kmod))
     self.logger.debug("Processing kernel modules: %s" % self['kernel_modules'])
     for kmod in self['kernel_modules'].copy():
         self.logger.debug("Processing kernel module: %s" % kmod)
         try:
-            _process_kmod_dependencies(self, kmod)
+            _process_kmod_dependencies(self, kmod, graph)
             continue
         except BuiltinModuleError:
             continue  # Don't add built-in modules to the ignore list
@@ -319,12 +503,12 @@ def process_modules(self) -> None:
         self['kmod_ignore'] = kmod
 
     for kmod in self['_kmod_auto']:
-        if kmod in self['kernel_modules']:
+        if kmod in graph:
             self.logger.debug("Autodetected module is already in kernel_modules: %s" % kmod)
             continue
         self.logger.debug("Processing autodetected kernel module: %s" % kmod)
         try:
-            _process_kmod_dependencies(self, kmod)
+            _process_kmod_dependencies(self, kmod, graph)
             self['kmod_init'] = kmod
             continue
         except BuiltinModuleError:
@@ -335,10 +519,20 @@ def process_modules(self) -> None:
             self.logger.warning("[%s] Failed to process autodetected kernel module dependencies: %s" % (kmod, e))
         self['kmod_ignore'] = kmod
 
+    for cycle in graph.cycles:
+        self.logger.warning("Kernel module dependency cycle detected: %s" % ' -> '.join(cycle))
+
+    # Sort kmod_init so modules are loaded after their dependencies
+    load_order = {module: index for index, module in enumerate(graph.order)}
+    self['kmod_init'].sort(key=lambda module: load_order.get(module, len(load_order)))
+
+    if not self['_kmod_cache_loaded'] or len(self['_kmod_modinfo']) != cached_modules:
+        _save_kmod_cache(self)
+
 
 @contains('kmod_init', "No kernel modules to load.", log_level=30)
 def load_modules(self) -> None:
-    """ Creates a bash script which loads all kernel modules in kmod_init. """
+    """ Creates a bash script which loads all kernel modules in kmod_init, in dependency order. """
     self.logger.info("Init kernel modules: %s" % ', '.join(self['kmod_init']))
     if included_kmods := list(set(self['kernel_modules']) ^ set(self['kmod_init'])):
         self.logger.info("Included kernel modules: %s" % ', '.join(included_kmods))
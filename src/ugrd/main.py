@@ -14,8 +14,15 @@ def main():
                  {'flags': ['--no-clean'], 'action': 'store_false', 'help': 'disable build directory cleaning', 'dest': 'clean'},
                  {'flags': ['--compress'], 'action': 'store_true', 'help': 'compress the final image', 'dest': 'cpio_compression'},
                  {'flags': ['--no-compress'], 'action': 'store_false', 'help': "don't compress the final image", 'dest': 'cpio_compression'},
+                 {'flags': ['--tune-compression'], 'action': 'store_true', 'help': 'try every compression format and level, and use the best within the size/decompression time budgets'},
                  {'flags': ['--rotate'], 'action': 'store_true', 'help': 'rotate old cpio images', 'dest': 'cpio_rotate'},
                  {'flags': ['--no-rotate'], 'action': 'store_false', 'help': "don't rotate old cpio images", 'dest': 'cpio_rotate'},
+                 {'flags': ['--dep-cache'], 'action': 'store_true', 'help': 'use the persistent binary dependency cache'},
+                 {'flags': ['--no-dep-cache'], 'action': 'store_false', 'help': 'do not use the persistent binary dependency cache', 'dest': 'dep_cache'},
+                 {'flags': ['--kmod-cache'], 'action': 'store_true', 'help': 'use the persistent kernel module info cache'},
+                 {'flags': ['--no-kmod-cache'], 'action': 'store_false', 'help': 'do not use the persistent kernel module info cache', 'dest': 'kmod_cache'},
+                 {'flags': ['--fingerprint'], 'action': 'store_true', 'help': 'skip the build if the inputs are unchanged since the last build', 'dest': 'build_fingerprint'},
+                 {'flags': ['--no-fingerprint'], 'action': 'store_false', 'help': 'always rebuild the image', 'dest': 'build_fingerprint'},
                  {'flags': ['--validate'], 'action': 'store_true', 'help': 'enable configuration validation'},
                  {'flags': ['--no-validate'], 'action': 'store_false', 'help': 'disable config validation', 'dest': 'validate'},
                  {'flags': ['--hostonly'], 'action': 'store_true', 'help': 'enable hostonly mode, required for automatic kmod detection'},
@@ -39,6 +46,8 @@ def main():
                  {'flags': ['--print-init'], 'action': 'store_true', 'help': 'print the final init structure'},
                  {'flags': {'--test'}, 'action': 'store_true', 'help': 'Tests the image with qemu'},
                  {'flags': {'--test-kernel'}, 'action': 'store', 'help': 'Tests the image with qemu using a specific kernel file.'},
+                 {'flags': ['--analyze-boot'], 'action': 'store', 'nargs': '+', 'help': 'print the boot profiles written by ugrd.base.bootprof, aggregating multiple profiles'},
+                 {'flags': ['--analyze-trace'], 'action': 'store', 'help': 'print the slowest lines in an init trace written when ugrd.trace is set'},
                  {'flags': {'--livecd-label'}, 'action': 'store', 'help': 'Sets the label for the livecd'},
                  {'flags': ['out_file'], 'action': 'store', 'help': 'set the output image location', 'nargs': '?'}]
 
@@ -48,6 +57,16 @@ def main():
     kwargs.pop('print_init', None)  # This is not a valid kwarg for InitramfsGenerator
     test = kwargs.pop('test', False)
 
+    if boot_profiles := kwargs.pop('analyze_boot', None):
+        from ugrd.base.bootprof import analyze_boot_profiles
+        print(analyze_boot_profiles(boot_profiles))
+        return
+
+    if trace_file := kwargs.pop('analyze_trace', None):
+        from ugrd.base.debug import analyze_trace
+        print(analyze_trace(trace_file))
+        return
+
     if kwargs.get('livecd_label') and 'ugrd.fs.livecd' not in kwargs.get('modules', ''):
         kwargs['modules'] = kwargs['modules'] + ',ugrd.fs.livecd' if kwargs.get('modules') else 'ugrd.fs.livecd'
 
@@ -0,0 +1,53 @@
+"""
+Compares the peak RSS of packing a large tree with the streaming newc writer,
+against building the whole archive in memory before compressing it, as PyCPIO does.
+
+Usage: python tests/bench_cpio_rss.py [size_mib]
+"""
+
+from io import BytesIO
+from lzma import open as lzma_open, CHECK_CRC32
+from os import urandom, walk
+from pathlib import Path
+from resource import getrusage, RUSAGE_SELF
+from subprocess import run
+from sys import argv, executable
+from tempfile import TemporaryDirectory
+
+from ugrd.fs.newc import NewcWriter
+
+
+def pack(tree: Path, out_file: Path, in_memory: bool) -> None:
+    """ Packs every file in the tree, either directly to the compressor or to a buffer first. """
+    buffer = BytesIO()
+    with lzma_open(out_file, 'wb', check=CHECK_CRC32, preset=0) as archive:
+        writer = NewcWriter(buffer if in_memory else archive)
+        for root, _, files in walk(tree):
+            for name in sorted(files):
+                path = Path(root) / name
+                writer.add_file(str(path.relative_to(tree)), path)
+        writer.close()
+        if in_memory:
+            archive.write(buffer.getvalue())
+
+
+def main():
+    size_mib = int(argv[1]) if len(argv) > 1 else 256
+    with TemporaryDirectory() as tmpdir:
+        tree = Path(tmpdir) / 'tree'
+        tree.mkdir()
+        for i in range(size_mib // 4):
+            (tree / f'firmware_{i}.bin').write_bytes(urandom(4 * 2 ** 20))
+
+        for mode in ['in_memory', 'streaming']:  # Each mode is packed in a new process, so the peak RSS is separate
+            cmd = run([executable, __file__, '--pack', str(tree), str(Path(tmpdir) / f'{mode}.cpio.xz'), mode],
+                      capture_output=True, check=True)
+            print("%s: %d MiB tree, peak RSS: %.1f MiB" % (mode, size_mib, int(cmd.stdout) / 1024))
+
+
+if __name__ == '__main__':
+    if len(argv) == 5 and argv[1] == '--pack':
+        pack(Path(argv[2]), Path(argv[3]), argv[4] == 'in_memory')
+        print(getrusage(RUSAGE_SELF).ru_maxrss)
+    else:
+        main()
@@ -0,0 +1,82 @@
+"""
+Counts the processes started by the generated init functions, for a simulated boot.
+The boot sets the exports, parses the cmdline, then logs messages and reads variables, like the init does.
+
+Processes are counted using the 'processes' line in /proc/stat, so other activity on the system is included.
+To compare against another version, run it with that version of ugrd on the PYTHONPATH.
+
+Usage: python tests/bench_init_forks.py [log_messages]
+"""
+
+from importlib import import_module
+from importlib.resources import files
+from pathlib import Path
+from subprocess import run
+from sys import argv
+from tempfile import TemporaryDirectory
+from tomllib import loads
+
+CMDLINE = 'root=/dev/vda1 rootflags=ro rootwait console=ttyS0 -- --init-arg'
+EXPORTS = {'MOUNTS_ROOT_SOURCE': '/dev/vda1', 'MOUNTS_ROOT_TYPE': 'ext4', 'MOUNTS_ROOT_OPTIONS': 'ro',
+           'MOUNTS_ROOT_TARGET': '/target_rootfs', 'init': '/sbin/init'}
+
+
+class Config(dict):
+    """ Defaults for config values used by the base and cmdline functions. """
+    def __missing__(self, key):
+        return {'force_quiet': False,
+                'cmdline_bools': ['quiet', 'debug', 'recovery', 'rootwait'],
+                'cmdline_strings': ['init', 'root', 'roottype', 'rootflags', 'rootdelay']}.get(key)
+
+
+def get_functions(module_name: str, names=None) -> list[str]:
+    """ Returns bash function definitions for the named functions, or the functions the module imports. """
+    module = import_module(module_name)
+    if names is None:
+        package, name = module_name.rsplit('.', 1)
+        config = loads(files(package).joinpath(name + '.toml').read_text())
+        names = config['imports'].get('functions', {}).get(module_name, [])
+    out = []
+    for name in names:
+        lines = getattr(module, name)(Config())
+        out += [f'{name}() {{', *(lines if isinstance(lines, list) else [lines]), '}']
+    return out
+
+
+def get_boot_script(run_dir: Path, log_messages: int) -> str:
+    """ Returns a script which defines the functions, then simulates a boot. """
+    script = ['declare -A UGRD_VARS', *get_functions('ugrd.base.base'), *get_functions('ugrd.base.cmdline'),
+              *get_functions('ugrd.base.cmdline', ['parse_cmdline'])]
+    script += [f'setvar {key} "{value}"' for key, value in EXPORTS.items()]
+    script += ['parse_cmdline',
+               f'for ((n = 0; n < {log_messages}; n++)); do',
+               '    einfo "Message: $n"',
+               '    edebug "Debug message: $n"',
+               '    ewarn "Warning: $n"',
+               'done',
+               'einfo "Mounting $(readvar MOUNTS_ROOT_SOURCE) to $(readvar MOUNTS_ROOT_TARGET)"']
+    return '\n'.join(script).replace('/proc/cmdline', str(run_dir / 'cmdline')).replace('/run/vars', str(run_dir / 'vars'))
+
+
+def count_processes() -> int:
+    for line in Path('/proc/stat').read_text().splitlines():
+        if line.startswith('processes '):
+            return int(line.split()[1])
+
+
+def main():
+    log_messages = int(argv[1]) if len(argv) > 1 else 100
+    with TemporaryDirectory() as tmpdir:
+        run_dir = Path(tmpdir)
+        (run_dir / 'vars').mkdir()
+        (run_dir / 'cmdline').write_text(CMDLINE + '\n')
+        (run_dir / 'boot.sh').write_text(get_boot_script(run_dir, log_messages))
+
+        start = count_processes()
+        run(['bash', str(run_dir / 'boot.sh')], check=True, capture_output=True)
+        processes = count_processes() - start - 1  # Don't count bash itself
+    print("%d log messages, processes started: %d" % (log_messages * 3, processes))
+
+
+if __name__ == '__main__':
+    main()
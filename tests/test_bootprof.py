@@ -0,0 +1,73 @@
+from pathlib import Path
+from subprocess import run
+from tempfile import TemporaryDirectory
+from unittest import TestCase, main
+
+from ugrd.base import bootprof
+from ugrd.base.bootprof import analyze_boot_profiles, read_boot_profile, profile_function, profile_runlevel
+
+PROFILE = ("# type\tname\tcalls\ttime_us\n"
+           "boot\tinit_start\t1\t1500000\n"
+           "boot\tinit\t1\t200000\n"
+           "runlevel\tinit_pre\t1\t20000\n"
+           "function\teinfo\t12\t1000\n"
+           "function\tmount_root\t1\t150000\n"
+           "runlevel\tinit_mount\t1\t160000\n")
+
+
+class TestBootProfile(TestCase):
+    def setUp(self):
+        self.tmpdir = TemporaryDirectory()
+        self.profile = Path(self.tmpdir.name) / 'boot-profile'
+        self.profile.write_text(PROFILE)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_read(self):
+        profile = read_boot_profile(self.profile)
+        self.assertEqual(profile[('function', 'einfo')], (12, 1000))
+        self.assertEqual(profile[('boot', 'init')], (1, 200000))
+
+    def test_single(self):
+        """ Runlevels are in boot order, functions are sorted by time, with the percent of the init time """
+        lines = analyze_boot_profiles([self.profile]).splitlines()[2:]
+        self.assertEqual([line.split()[1] for line in lines], ['init_start', 'init', 'init_pre', 'init_mount', 'mount_root', 'einfo'])
+        self.assertEqual(lines[4].split()[-1], '75.0')
+
+    def test_aggregate(self):
+        slow_host = Path(self.tmpdir.name) / 'slow-host'
+        slow_host.write_text(PROFILE.replace('mount_root\t1\t150000', 'mount_root\t1\t450000'))
+        lines = analyze_boot_profiles([self.profile, slow_host]).splitlines()[2:]
+        mount_root = next(line.split() for line in lines if 'mount_root' in line)
+        self.assertEqual(mount_root[2:], ['2', '300.000', '300.000', '450.000', str(slow_host)])
+
+    def get_profile_script(self, uptime: str) -> str:
+        """ Returns a script which records a runlevel and a function, then writes the profile to the tmpdir. """
+        (Path(self.tmpdir.name) / 'uptime').write_text(uptime + ' 1.00\n')
+        functions = {name: getattr(bootprof, name)(None) for name in ['bootprof_begin', 'bootprof_end', 'bootprof_record', 'bootprof_save']}
+        functions.update(profile_function(None, 'mount_root', ['sleep 0.01']))
+        script = ['declare -A BOOTPROF_START BOOTPROF_CALLS BOOTPROF_TIME', 'einfo() { :; }']
+        for name, lines in functions.items():
+            script += [f'{name}() {{', *(lines if isinstance(lines, list) else [lines]), '}']
+        script += profile_runlevel(None, 'init_mount', ['mount_root']) + ['bootprof_save']
+        return '\n'.join(script).replace('/proc/uptime', str(Path(self.tmpdir.name) / 'uptime')).replace(bootprof.BOOT_PROFILE, str(self.profile))
+
+    def test_generated(self):
+        """ Profiles written by the init can be read, uptime under 1s must not be read as octal """
+        for uptime, init_start in [('0.45', 450000), ('0.85', 850000), ('12.34', 12340000)]:
+            with self.subTest(uptime=uptime):
+                run(['bash', '-c', self.get_profile_script(uptime)], check=True)
+                profile = read_boot_profile(self.profile)
+                self.assertAlmostEqual(profile[('boot', 'init_start')][1], init_start, delta=100000)
+                self.assertGreaterEqual(profile[('function', 'mount_root')][1], 10000)
+                self.assertEqual(profile[('runlevel', 'init_mount')][0], 1)
+
+    def test_invalid(self):
+        self.profile.write_text("function\teinfo\tbad\n")
+        with self.assertRaises(ValueError):
+            read_boot_profile(self.profile)
+
+
+if __name__ == '__main__':
+    main()
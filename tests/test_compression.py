@@ -0,0 +1,213 @@
+from gzip import decompress as gzip_decompress
+from io import BytesIO
+from logging import getLogger
+from lzma import decompress
+from os import urandom, utime
+from pathlib import Path
+from shutil import which
+from subprocess import run
+from tempfile import TemporaryDirectory
+from threading import enumerate as enumerate_threads, main_thread
+from unittest import TestCase, main, skipUnless
+
+from ugrd.fs.compression import open_compressed, ParallelXZWriter
+from ugrd.fs.cpio import check_cpio_compression, _open_archive, _prune_split_segments, _replace_output, _select_compression, _write_entries, TUNE_COMPRESSION_LEVELS
+from ugrd.fs.newc import NewcWriter
+from ugrd.generator_helpers import GeneratorHelpers
+
+
+ENTRIES = {'init': b'#!/bin/bash\necho test\n',
+           'lib/firmware/random.bin': urandom(3 * 2 ** 20),
+           'lib/firmware/zeros.bin': bytes(5 * 2 ** 20)}
+
+
+class ArchiveConfig(dict):
+    """ The config values used by _open_archive. """
+    logger = getLogger(__name__)
+
+
+class RotateConfig(ArchiveConfig, GeneratorHelpers):
+    """ The config values used by _replace_output, with cpio_rotate set. """
+    old_count = 2
+    clean = True
+
+
+def pack(compression: str, threads: int, level=None) -> bytes:
+    """ Packs ENTRIES into a compressed newc archive. """
+    out_file = BytesIO()
+    archive = open_compressed(out_file, compression, threads, level)
+    writer = NewcWriter(archive)
+    for name, data in ENTRIES.items():
+        writer.add_data(name, data)
+    writer.close()
+    archive.close()
+    return out_file.getvalue()
+
+
+def read_newc(data: bytes) -> dict:
+    """ Returns a dict of name -> data for every entry in a newc archive. """
+    entries, offset = {}, 0
+    while True:
+        header = data[offset:offset + 110]
+        namesize, filesize = int(header[94:102], 16), int(header[54:62], 16)
+        name = data[offset + 110:offset + 110 + namesize - 1].decode()
+        offset += 110 + namesize
+        offset += -offset % 4
+        if name == 'TRAILER!!!':
+            return entries
+        entries[name] = data[offset:offset + filesize]
+        offset += filesize + (-filesize % 4)
+
+
+class TestCompression(TestCase):
+    def test_xz_threads(self):
+        """ Checks that xz output decompresses to the same entries, and is reproducible, for any thread count. """
+        outputs = {}
+        for threads in [1, 2, 4]:
+            with self.subTest(threads=threads):
+                outputs[threads] = pack('xz', threads)
+                self.assertEqual(read_newc(decompress(outputs[threads])), ENTRIES)
+                self.assertEqual(pack('xz', threads), outputs[threads])
+        self.assertEqual(outputs[2], outputs[4])
+
+    def test_xz_memory_limit(self):
+        """ xz threads are reduced to fit the memory limit, without changing the output """
+        writer = ParallelXZWriter(BytesIO(), 64, preset=6, memory_limit=2 ** 30)
+        self.assertEqual(writer.threads, 6)
+        writer.abort()
+        out_file = BytesIO()
+        writer = ParallelXZWriter(out_file, 4, preset=6, memory_limit=1)
+        self.assertEqual(writer.threads, 1)
+        writer.write(ENTRIES['lib/firmware/random.bin'])
+        writer.close()
+        self.assertEqual(decompress(out_file.getvalue()), ENTRIES['lib/firmware/random.bin'])
+
+    @skipUnless(which('zstd'), "zstd is not installed")
+    def test_zstd_threads(self):
+        for threads in [1, 4]:
+            with self.subTest(threads=threads):
+                compressed = pack('zstd', threads)
+                decompressed = run(['zstd', '--decompress', '--stdout'], input=compressed, capture_output=True, check=True)
+                self.assertEqual(read_newc(decompressed.stdout), ENTRIES)
+                self.assertEqual(pack('zstd', threads), compressed)
+
+    @skipUnless(which('lz4'), "lz4 is not installed")
+    def test_lz4_legacy(self):
+        """ Checks that lz4 output uses the legacy format, which the kernel requires. """
+        for level in [1, 12]:
+            with self.subTest(level=level):
+                compressed = pack('lz4', 1, level)
+                self.assertEqual(compressed[:4], b'\x02\x21\x4c\x18')
+                decompressed = run(['lz4', '--decompress', '--stdout'], input=compressed, capture_output=True, check=True)
+                self.assertEqual(read_newc(decompressed.stdout), ENTRIES)
+
+    def test_gzip(self):
+        compressed = pack('gzip', 1, 9)
+        self.assertEqual(read_newc(gzip_decompress(compressed)), ENTRIES)
+        self.assertEqual(pack('gzip', 1, 9), compressed)
+
+    def test_invalid_level(self):
+        with self.assertRaises(ValueError):
+            open_compressed(BytesIO(), 'gzip', 1, 10)
+
+    def test_select_compression(self):
+        """ Checks that the smallest option is selected within a time budget, and the fastest within a size budget. """
+        results = [{'compression': 'xz', 'level': 9, 'size': 100, 'decompress_ms': 400},
+                   {'compression': 'zstd', 'level': 19, 'size': 120, 'decompress_ms': 100},
+                   {'compression': 'lz4', 'level': 9, 'size': 150, 'decompress_ms': 50}]
+        self.assertEqual(_select_compression(results)['compression'], 'xz')
+        self.assertEqual(_select_compression(results, max_decompress_ms=200)['compression'], 'zstd')
+        self.assertEqual(_select_compression(results, max_image_size=130)['compression'], 'zstd')
+        self.assertEqual(_select_compression(results, max_image_size=200, max_decompress_ms=60)['compression'], 'lz4')
+        self.assertIsNone(_select_compression(results, max_image_size=110, max_decompress_ms=60))
+
+    def test_kernel_config_unset(self):
+        """ kernel_config_file is initialized to Path(), which must be treated as unset, not opened """
+        for config_file in [Path(), Path('/nonexistent/.config')]:
+            with self.subTest(config_file=config_file):
+                config = ArchiveConfig(cpio_compression='xz', cpio_compression_level=0, kernel_config_file=config_file)
+                check_cpio_compression(config)
+
+    def test_kernel_config(self):
+        with TemporaryDirectory() as tmpdir:
+            config_file = Path(tmpdir) / '.config'
+            config_file.write_text("CONFIG_RD_XZ=y\n# CONFIG_RD_LZ4 is not set\n")
+            check_cpio_compression(ArchiveConfig(cpio_compression='xz', cpio_compression_level=0, kernel_config_file=config_file))
+            with self.assertRaises(ValueError):
+                check_cpio_compression(ArchiveConfig(cpio_compression='lz4', cpio_compression_level=0, kernel_config_file=config_file))
+
+    def test_tune_levels(self):
+        """ A cpio_compression_level of 0 uses the default level, so it can't be selected by tune_compression """
+        for compression, levels in TUNE_COMPRESSION_LEVELS.items():
+            self.assertNotIn(0, levels, compression)
+
+    def test_abort_packing(self):
+        """ If packing fails, compression commands and threads are stopped, so ugrd doesn't hang on exit """
+        for compression, threads in [('xz', 2), ('zstd', 2), ('lz4', 1)]:
+            if compression != 'xz' and not which(compression):
+                continue
+            with self.subTest(compression=compression), TemporaryDirectory() as tmpdir:
+                config = ArchiveConfig(cpio_compression=compression, cpio_compression_threads=threads, cpio_compression_level=0)
+                with self.assertRaises(ValueError):
+                    with _open_archive(config, Path(tmpdir) / 'archive') as archive:
+                        archive.write(urandom(2 ** 22))
+                        raise ValueError("File size changed")
+                self.assertEqual([thread for thread in enumerate_threads() if thread is not main_thread()], [])
+
+    def test_replace_rotate(self):
+        """ Checks that the output is rotated to .old while the output path keeps the old image until it's replaced """
+        with TemporaryDirectory() as tmpdir:
+            out_file = Path(tmpdir) / 'initramfs'
+            config = RotateConfig(cpio_rotate=True)
+            for n in range(3):
+                temp_file = Path(tmpdir) / 'initramfs.tmp'
+                temp_file.write_bytes(b'image %d' % n)
+                _replace_output(config, temp_file, out_file)
+            self.assertEqual(out_file.read_bytes(), b'image 2')
+            self.assertEqual((Path(tmpdir) / 'initramfs.old').read_bytes(), b'image 1')
+            self.assertEqual((Path(tmpdir) / 'initramfs.old.1').read_bytes(), b'image 0')
+            self.assertFalse(temp_file.exists())
+
+    def test_prune_split_segments(self):
+        """ Old common segments in the output directory are removed, except the old_count most recent """
+        with TemporaryDirectory() as tmpdir:
+            segments = [Path(tmpdir) / ('ugrd-common-%d.cpio.xz' % n) for n in range(4)]
+            for n, segment in enumerate(segments):
+                segment.touch()
+                utime(segment, (n, n))
+            (Path(tmpdir) / 'ugrd.cpio.xz').touch()
+            _prune_split_segments(RotateConfig(cpio_rotate=True, old_count=2), segments[0])
+            self.assertEqual(sorted(Path(tmpdir).iterdir()), [segments[0], segments[2], segments[3], Path(tmpdir) / 'ugrd.cpio.xz'])
+            _prune_split_segments(RotateConfig(cpio_rotate=False, old_count=2), segments[0])
+            self.assertEqual(sorted(Path(tmpdir).iterdir()), [segments[0], Path(tmpdir) / 'ugrd.cpio.xz'])
+
+    def test_hardlinks(self):
+        """ Checks that duplicate files are packed once, and later copies are hardlinks with the same inode. """
+        with TemporaryDirectory() as tmpdir:
+            entries = {}
+            for name, data in [('a', b'same'), ('b', b'same'), ('c', b'different'), ('d', b'same')]:
+                (Path(tmpdir) / name).write_bytes(data)
+                entries['lib/' + name] = {'type': 'file', 'source': str(Path(tmpdir) / name)}
+            out_file = BytesIO()
+            writer = NewcWriter(out_file)
+            _write_entries(writer, entries, deduplicate=True)
+
+        headers, data, offset = {}, out_file.getvalue(), 0
+        while True:
+            ino, nlink, filesize, namesize = [int(data[offset + start:offset + start + 8], 16) for start in [6, 38, 54, 94]]
+            name = data[offset + 110:offset + 110 + namesize - 1].decode()
+            offset += 110 + namesize
+            offset += (-offset % 4) + filesize + (-filesize % 4)
+            if name == 'TRAILER!!!':
+                break
+            headers[name] = (ino, nlink, filesize)
+
+        self.assertEqual(headers['lib/a'], (headers['lib/b'][0], 3, 4))
+        self.assertEqual(headers['lib/b'], (headers['lib/a'][0], 3, 0))
+        self.assertEqual(headers['lib/d'], (headers['lib/a'][0], 3, 0))
+        self.assertEqual(headers['lib/c'][1:], (1, 9))
+        self.assertEqual((writer.links, writer.deduplicated_size), (2, 8))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,41 @@
+from pathlib import Path
+from shutil import copy2, which
+from subprocess import run
+from tempfile import TemporaryDirectory
+from unittest import TestCase, main, skipUnless
+
+from ugrd.elf import ELFResolver, NotELFError, read_elf
+
+
+BINARIES = ['bash', 'ls', 'cp', 'cat', 'grep', 'mount', 'switch_root']
+
+
+@skipUnless(which('lddtree'), "lddtree is not installed")
+class TestELFResolver(TestCase):
+    def test_matches_lddtree(self):
+        """ Checks that the native resolver finds the same dependencies as lddtree. """
+        resolver = ELFResolver()
+        for binary in BINARIES:
+            if not (binary_path := which(binary)):
+                continue
+            with self.subTest(binary=binary):
+                lddtree = run(['lddtree', '-l', binary_path], capture_output=True, check=True)
+                expected = {Path(dep).resolve() for dep in lddtree.stdout.decode().splitlines()}
+                self.assertEqual({dep.resolve() for dep in resolver.resolve(binary_path)}, expected)
+
+
+class TestReadELF(TestCase):
+    def test_changed_file(self):
+        """ Files which are replaced are read again, not returned from the cache """
+        with TemporaryDirectory() as tmpdir:
+            binary = Path(tmpdir) / 'binary'
+            copy2(which('bash'), binary)
+            self.assertIn('libc.so.6', read_elf(str(binary)).needed)
+            binary.unlink()
+            binary.write_text('#!/bin/sh\n')
+            with self.assertRaises(NotELFError):
+                read_elf(str(binary))
+
+
+if __name__ == '__main__':
+    main()
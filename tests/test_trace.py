@@ -0,0 +1,36 @@
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import TestCase, main
+
+from ugrd.base.debug import analyze_trace, read_trace
+
+TRACE = ("+ 100.000000 main /init:10 mount_root\n"
+         "++ 100.000500 mount_root /etc/profile:20 blkid\n"
+         "/dev/sda1: UUID=\"abc\"\n"  # Output which is not a traced command
+         "++ 100.300500 mount_root /etc/profile:21 mount /dev/sda1 /target_rootfs\n"
+         "+ 100.400500 main /init:11 einfo done\n"
+         "+ 100.401000 main /init:12 exec switch_root /target_rootfs /sbin/init\n")
+
+
+class TestTrace(TestCase):
+    def test_read(self):
+        with TemporaryDirectory() as tmpdir:
+            trace = Path(tmpdir) / 'trace'
+            trace.write_text(TRACE)
+            commands = read_trace(trace)
+        self.assertEqual(len(commands), 5)
+        self.assertEqual(commands[1], (100000500, 'mount_root', '/etc/profile:20', 'blkid'))
+
+    def test_hot_spots(self):
+        """ The slowest lines are first, each takes the time until the next command """
+        with TemporaryDirectory() as tmpdir:
+            trace = Path(tmpdir) / 'trace'
+            trace.write_text(TRACE)
+            report = analyze_trace(trace, limit=2).splitlines()
+        self.assertEqual(len(report), 4)
+        self.assertEqual(report[2].split()[:5], ['300.000', '74.8', '1', '/etc/profile:20', 'mount_root'])
+        self.assertEqual(report[3].split()[3], '/etc/profile:21')
+
+
+if __name__ == '__main__':
+    main()
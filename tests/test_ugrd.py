@@ -11,10 +11,23 @@ class TestCpio(TestCase):
         generator = InitramfsGenerator(logger=self.logger, config='tests/fullauto.toml')
         generator.build()
 
+    def test_default_build_pre(self):
+        """ The default modules must get through build_pre, kernel_config_file starts as Path() when not set """
+        generator = InitramfsGenerator(logger=self.logger, config=None)
+        generator.run_hook('build_pre')
+
     def test_xz(self):
         generator = InitramfsGenerator(logger=self.logger, config='tests/fullauto.toml', cpio_compression='xz')
         generator.build()
 
+    def test_manifest_rebuild(self):
+        """ The second build is skipped by the fingerprint, its checks must not read the unpopulated staging manifest. """
+        kwargs = {'logger': self.logger, 'config': 'tests/fullauto.toml', 'staging_mode': 'manifest', 'build_fingerprint': True}
+        InitramfsGenerator(**kwargs).build()
+        generator = InitramfsGenerator(**kwargs)
+        generator.build()
+        self.assertTrue(generator['_build_fingerprint_matched'])
+
     @expectedFailure
     def test_bad_config(self):
         generator = InitramfsGenerator(logger=self.logger, config='tests/bad_config.toml')